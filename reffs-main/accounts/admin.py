@@ -10,6 +10,7 @@ class CustomUserAdmin(UserAdmin):
     search_fields = ('username', 'email', 'phone_number', 'referral_code')
     list_filter = ('is_active', 'is_staff', 'is_banned', 'date_joined')
     actions = ['ban_users', 'unban_users']
+    readonly_fields = ('referral_earnings',)
     fieldsets = UserAdmin.fieldsets + (
         ('Referral Information', {'fields': ('phone_number', 'referral_code', 'referred_by', 'referral_earnings')}),
         ('Ban Information', {'fields': ('is_banned', 'ban_reason', 'banned_at')}),
@@ -6,6 +6,9 @@ class AccountsConfig(AppConfig):
     name = 'accounts'
 
     def ready(self):
+        from accounts import referral_codes
+
+        referral_codes.check_key()
         try:
             import accounts.signals  # noqa
         except ImportError:
@@ -0,0 +1,199 @@
+"""
+Per-user notification digests.
+
+Pairings, referral bonuses and payment reminders are recorded as
+NotificationEvent rows in the transaction that causes them, instead of
+each sending its own message. Identical unsent events for a user share a
+dedupe key and are stored once.
+
+A user's buffered events go out as one combined email (plus an SMS
+summary when SMS is set up) once the oldest of them is
+NOTIFICATION_DIGEST_WINDOW_SECONDS old; send_notification_digests checks
+for due users every minute. Users who chose immediate delivery, and events
+recorded as urgent, are sent through the transactional outbox as soon as
+the transaction commits instead.
+"""
+import hashlib
+import json
+import logging
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Min
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from accounts import notify, outbox
+from accounts.models import NotificationEvent, User
+
+logger = logging.getLogger(__name__)
+
+
+def window():
+    return timedelta(seconds=getattr(settings, 'NOTIFICATION_DIGEST_WINDOW_SECONDS', 900))
+
+
+def event_key(kind, identity):
+    """Dedupe key of an event; ``identity`` is whatever makes two events the same"""
+    payload = json.dumps([kind, identity], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def event(user_id, kind, payload, identity=None):
+    """An unsaved event; identical ``identity`` (default: the payload) means a duplicate"""
+    return NotificationEvent(
+        user_id=user_id,
+        kind=kind,
+        payload=payload,
+        dedupe_key=event_key(kind, payload if identity is None else identity),
+    )
+
+
+def record(events, urgent=False):
+    """
+    Buffer ``events`` in the current transaction, dropping duplicates of
+    events still waiting. Their users' digests are queued in the outbox
+    straight away if ``urgent`` or if the user prefers immediate delivery.
+    """
+    if not events:
+        return
+    NotificationEvent.objects.bulk_create(events, ignore_conflicts=True)
+    user_ids = {e.user_id for e in events}
+    if not urgent:
+        user_ids = set(User.objects.filter(
+            id__in=user_ids, notification_delivery='immediate'
+        ).values_list('id', flat=True))
+    outbox.enqueue_many([
+        outbox.message('accounts.tasks.send_user_digest', user_id) for user_id in sorted(user_ids)
+    ])
+
+
+def due_users(now=None, limit=500, exclude=()):
+    """Users whose oldest buffered event has waited a full window"""
+    cutoff = (now or timezone.now()) - window()
+    return list(
+        NotificationEvent.objects.filter(sent_at__isnull=True).exclude(user_id__in=exclude)
+        .values('user_id').annotate(first=Min('created_at')).filter(first__lte=cutoff)
+        .order_by('first').values_list('user_id', flat=True)[:limit]
+    )
+
+
+def claim(user_ids):
+    """
+    Mark the users' buffered events as sent and return them, so concurrent
+    flushes never send the same event twice. send_digests() releases the
+    events of digests that fail.
+    """
+    with transaction.atomic():
+        queryset = NotificationEvent.objects.filter(user_id__in=user_ids, sent_at__isnull=True).order_by('id')
+        if connection.features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+        events = list(queryset)
+        NotificationEvent.objects.filter(id__in=[e.id for e in events]).update(sent_at=timezone.now())
+    return events
+
+
+def digest_context(user, events, counterparties):
+    pairings = {}
+    bonuses, reminders, expired = [], [], []
+    for e in events:
+        if e.kind == 'pairing':
+            key = (e.payload['counterparty_id'], e.payload['role'])
+            pairings[key] = pairings.get(key, Decimal('0.00')) + Decimal(e.payload['amount'])
+        elif e.kind == 'referral_bonus':
+            bonuses.append(dict(e.payload, amount=Decimal(e.payload['amount'])))
+        elif e.kind == 'payment_reminder':
+            reminder = dict(e.payload, amount=Decimal(e.payload['amount']), due_at=parse_datetime(e.payload['due_at']))
+            (expired if reminder.get('expired') else reminders).append(reminder)
+
+    receipts, payments = [], []
+    for (counterparty_id, role), amount in pairings.items():
+        line = {'user': counterparties.get(counterparty_id), 'amount': amount}
+        (receipts if role == 'receive' else payments).append(line)
+    return {
+        'user': user,
+        'receipts': receipts,
+        'payments': payments,
+        'total_receive': sum((line['amount'] for line in receipts), Decimal('0.00')),
+        'total_pay': sum((line['amount'] for line in payments), Decimal('0.00')),
+        'bonuses': bonuses,
+        'total_bonus': sum((bonus['amount'] for bonus in bonuses), Decimal('0.00')),
+        'reminders': reminders,
+        'expired': expired,
+        'event_count': len(events),
+        'dashboard_url': f"{settings.SITE_URL}/dashboard",
+    }
+
+
+def send_digests(user_ids):
+    """
+    Send one combined message per user for everything they have buffered.
+    Returns (digests sent, digests failed).
+    """
+    events = claim(user_ids)
+    if not events:
+        return 0, 0
+    by_user = {}
+    for e in events:
+        by_user.setdefault(e.user_id, []).append(e)
+    counterparty_ids = {e.payload['counterparty_id'] for e in events if e.kind == 'pairing'}
+    users = User.objects.in_bulk(set(by_user) | counterparty_ids)
+    sms = notify.sms_enabled()
+
+    notifications, owners = [], []
+    for user_id, user_events in by_user.items():
+        user = users[user_id]
+        context = digest_context(user, user_events, users)
+        if user.email:
+            notifications.append(notify.Notification(
+                'email', user.email,
+                subject=f'Account Updates - {user.username}',
+                html=render_to_string('accounts/email/notification_digest.html', context),
+            ))
+            owners.append((user_id, 'email'))
+        if sms and notify.kenyan_msisdn(user.phone_number):
+            notifications.append(notify.Notification(
+                'sms', user.phone_number, render_to_string('accounts/sms/notification_digest.txt', context).strip()
+            ))
+            owners.append((user_id, 'sms'))
+
+    results, _ = notify.dispatch(notifications)
+    delivered = {user_id for (user_id, _), sent in zip(owners, results) if sent}
+    failed = {user_id for user_id, _ in owners} - delivered
+    if failed:
+        release([e for user_id in failed for e in by_user[user_id]])
+    return len(by_user) - len(failed), len(failed)
+
+
+def release(events):
+    """Put claimed events back into the buffer, except those recorded again meanwhile"""
+    waiting = set(NotificationEvent.objects.filter(
+        user_id__in={e.user_id for e in events}, sent_at__isnull=True
+    ).values_list('user_id', 'dedupe_key'))
+    duplicates = [e.id for e in events if (e.user_id, e.dedupe_key) in waiting]
+    NotificationEvent.objects.filter(id__in=duplicates).delete()
+    NotificationEvent.objects.filter(id__in=[e.id for e in events if e.id not in duplicates]).update(sent_at=None)
+
+
+def flush_due(batch_size=None):
+    """Send every digest whose window has passed, a batch of users at a time"""
+    batch_size = batch_size or getattr(settings, 'NOTIFICATION_DIGEST_BATCH_SIZE', 500)
+    sent = failed = 0
+    attempted = set()
+    while True:
+        user_ids = due_users(limit=batch_size, exclude=attempted)
+        if not user_ids:
+            break
+        attempted.update(user_ids)
+        batch_sent, batch_failed = send_digests(user_ids)
+        sent += batch_sent
+        failed += batch_failed
+    return sent, failed
+
+
+def purge_sent(older_than=None):
+    cutoff = timezone.now() - (older_than or timedelta(days=getattr(settings, 'OUTBOX_RETENTION_DAYS', 7)))
+    return NotificationEvent.objects.filter(sent_at__lt=cutoff).delete()[0]
@@ -0,0 +1,186 @@
+"""
+Liquidity forecast: projected maturity payouts against incoming bids.
+
+Confirmed investments are bucketed by the local day of mature_at, summing
+return_amount. That is compared with the recent daily intake of new bids,
+starting from today's matured backlog and open bids, to find the first day
+cumulative payouts exceed cumulative intake.
+
+The per-day sums are loaded once with two GROUP BY queries, kept as integer
+cent arrays in the cache, and refreshed incrementally. Code that changes a
+day's payouts (start_countdown, the maturity transition) bumps a per-day
+version key with mark_day_dirty(). A refresh re-aggregates only the days
+whose version moved. The projection itself is a few NumPy operations over
+the cached arrays.
+"""
+import time
+from datetime import datetime, time as day_time, timedelta
+from decimal import Decimal
+from functools import reduce
+from operator import or_
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import DecimalField, Q, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from accounts.models import Investment
+
+CACHE_KEY = 'liquidity-forecast'
+DAY_VERSION_KEY = 'liquidity-forecast:day:{}'
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.combine(day, day_time.min))
+
+
+def _cents(value):
+    return int((value or Decimal('0.00')) * 100)
+
+
+def mark_day_dirty(day):
+    """Record that the payouts maturing on ``day`` changed"""
+    key = DAY_VERSION_KEY.format(day.isoformat())
+    if not cache.add(key, 1, timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+
+
+def _payouts_by_day(days=None, start=None, end=None):
+    """{day: cents} of confirmed return_amounts, for given days or a range"""
+    queryset = Investment.objects.filter(status='confirmed')
+    if days is not None:
+        queryset = queryset.filter(reduce(or_, (
+            Q(mature_at__gte=_day_start(day), mature_at__lt=_day_start(day + timedelta(days=1)))
+            for day in days
+        )))
+    else:
+        queryset = queryset.filter(mature_at__gte=_day_start(start), mature_at__lt=_day_start(end))
+    rows = queryset.annotate(day=TruncDate('mature_at')).order_by().values('day').annotate(
+        total=Sum(Coalesce('return_amount', 'amount'))
+    )
+    return {row['day']: _cents(row['total']) for row in rows}
+
+
+def _intake_by_day(start, end):
+    rows = Investment.objects.filter(
+        created_at__gte=_day_start(start), created_at__lt=_day_start(end)
+    ).annotate(day=TruncDate('created_at')).order_by().values('day').annotate(total=Sum('amount'))
+    return {row['day']: _cents(row['total']) for row in rows}
+
+
+def _open_book():
+    """Matured payouts still owed and pending bid amounts not yet paired, in cents"""
+    money = DecimalField(max_digits=14, decimal_places=2)
+    totals = Investment.objects.filter(status__in=['matured', 'pending']).aggregate(
+        backlog=Sum(Coalesce('remaining_amount', 'return_amount', 'amount', output_field=money),
+                    filter=Q(status='matured')),
+        bids=Sum(Coalesce('remn_amount', 'amount', output_field=money), filter=Q(status='pending')),
+    )
+    return _cents(totals['backlog']), _cents(totals['bids'])
+
+
+def _versions(origin, horizon):
+    keys = [DAY_VERSION_KEY.format((origin + timedelta(days=d)).isoformat()) for d in range(horizon)]
+    return cache.get_many(keys)
+
+
+def load_state(today=None):
+    """Full load: the payout array over the horizon and the intake history"""
+    today = today or timezone.localdate()
+    horizon = _setting('LIQUIDITY_FORECAST_HORIZON_DAYS', 90)
+    window = _setting('LIQUIDITY_FORECAST_INTAKE_DAYS', 14)
+    versions = _versions(today, horizon)
+    payouts = np.zeros(horizon, dtype=np.int64)
+    for day, cents in _payouts_by_day(start=today, end=today + timedelta(days=horizon)).items():
+        payouts[(day - today).days] = cents
+    intake = np.zeros(window, dtype=np.int64)
+    for day, cents in _intake_by_day(today - timedelta(days=window), today).items():
+        intake[(day - (today - timedelta(days=window))).days] = cents
+    return {
+        'origin': today,
+        'loaded_at': time.time(),
+        'payouts': payouts,
+        'intake': intake,
+        'versions': versions,
+    }
+
+
+def refresh_state():
+    """
+    Return the cached state brought up to date, re-aggregating only the
+    days marked dirty since it was stored. A new day or an old state is
+    reloaded in full.
+    """
+    today = timezone.localdate()
+    state = cache.get(CACHE_KEY)
+    full_every = _setting('LIQUIDITY_FORECAST_FULL_REFRESH_SECONDS', 3600)
+    if state is None or state['origin'] != today or time.time() - state['loaded_at'] > full_every:
+        state = load_state(today)
+        state['refresh'] = {'mode': 'full', 'days': len(state['payouts'])}
+    else:
+        versions = _versions(today, len(state['payouts']))
+        dirty = [key for key in set(versions) | set(state['versions'])
+                 if versions.get(key) != state['versions'].get(key)]
+        days = [datetime.strptime(key.rsplit(':', 1)[1], '%Y-%m-%d').date() for key in dirty]
+        if days:
+            sums = _payouts_by_day(days=days)
+            for day in days:
+                state['payouts'][(day - today).days] = sums.get(day, 0)
+        state['versions'] = versions
+        state['refresh'] = {'mode': 'incremental', 'days': len(days)}
+    cache.set(CACHE_KEY, state, timeout=None)
+    return state
+
+
+def project(payouts, backlog, open_bids, daily_intake):
+    """
+    Cumulative amounts owed and funded for each day of the horizon, and
+    the index of the first day owed exceeds funded (None if it never does).
+    """
+    owed = backlog + np.cumsum(payouts)
+    funded = open_bids + daily_intake * np.arange(1, len(payouts) + 1)
+    short = np.flatnonzero(owed > funded)
+    return owed, funded, int(short[0]) if len(short) else None
+
+
+def liquidity_forecast(days=30):
+    """
+    The forecast as a JSON-serialisable dict, listing the first ``days``
+    days of the horizon.
+    """
+    started = time.perf_counter()
+    state = refresh_state()
+    backlog, open_bids = _open_book()
+    daily_intake = int(state['intake'].sum()) / max(len(state['intake']), 1)
+    payouts = state['payouts']
+    owed, funded, shortfall = project(payouts, backlog, open_bids, daily_intake)
+    origin = state['origin']
+
+    return {
+        'as_of': timezone.now().isoformat(),
+        'intake_window_days': len(state['intake']),
+        'daily_intake': round(daily_intake / 100, 2),
+        'matured_backlog': backlog / 100,
+        'open_bids': open_bids / 100,
+        'days_until_shortfall': shortfall,
+        'shortfall_date': (origin + timedelta(days=shortfall)).isoformat() if shortfall is not None else None,
+        'days': [
+            {
+                'date': (origin + timedelta(days=d)).isoformat(),
+                'payouts': int(payouts[d]) / 100,
+                'cumulative_owed': int(owed[d]) / 100,
+                'cumulative_funded': round(float(funded[d]) / 100, 2),
+            }
+            for d in range(min(days, len(payouts)))
+        ],
+        'refresh': dict(state['refresh'], ms=round((time.perf_counter() - started) * 1000, 2)),
+    }
@@ -0,0 +1,94 @@
+"""
+Append-only referral bonus ledger.
+
+A user's referral bonus balance (User.referral_earnings) is no longer a
+column that every bonus, confirmation and withdrawal reads, changes and
+saves back. Each of them inserts a BonusLedgerEntry instead: a credit or
+a debit. Inserts never conflict with each other, so concurrent
+confirmations cannot lose an update and do not queue on the user row.
+
+balance() is the user's BonusBalanceSnapshot plus the entries not yet
+folded into it, read in one statement over a partial index of the
+unfolded entries. The snapshot_bonus_balances task folds entries into the
+snapshots every few minutes: in one transaction it locks a batch of
+unfolded entries, adds them to their users' snapshots and flags them
+snapshotted. The flag, not the entry id or its age, says what a snapshot
+holds, so an entry whose transaction commits late is simply folded by a
+later run.
+"""
+import logging
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import DecimalField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from accounts.models import BonusBalanceSnapshot, BonusLedgerEntry, User
+
+logger = logging.getLogger(__name__)
+
+
+def credit(user_id, amount, kind, reference=''):
+    """Record ``amount`` added to the user's balance"""
+    return BonusLedgerEntry.objects.create(user_id=user_id, amount=amount, kind=kind, reference=str(reference))
+
+
+def debit(user_id, amount, kind, reference=''):
+    """Record ``amount`` (positive) leaving the user's balance"""
+    return BonusLedgerEntry.objects.create(user_id=user_id, amount=-amount, kind=kind, reference=str(reference))
+
+
+def balance(user_id):
+    """The user's current bonus balance"""
+    money = DecimalField(max_digits=12, decimal_places=2)
+    opening = BonusBalanceSnapshot.objects.filter(user_id=OuterRef('pk')).values('balance')
+    tail = BonusLedgerEntry.objects.filter(user_id=OuterRef('pk'), snapshotted=False).values(
+        'user_id'
+    ).order_by().annotate(total=Sum('amount')).values('total')
+    # One statement, so a snapshot run committing in between cannot be seen by half of it
+    return User.objects.filter(pk=user_id).values_list(
+        Coalesce(Subquery(opening, output_field=money), Value(0), output_field=money)
+        + Coalesce(Subquery(tail, output_field=money), Value(0), output_field=money),
+        flat=True,
+    ).first() or Decimal('0.00')
+
+
+def take_snapshots(batch_size=None):
+    """
+    Fold every unfolded ledger entry into its user's snapshot, one batch
+    of entries per transaction. Returns the number of snapshots written.
+    """
+    batch_size = batch_size or getattr(settings, 'BONUS_SNAPSHOT_BATCH_SIZE', 1000)
+    written = 0
+    while True:
+        with transaction.atomic():
+            entries = BonusLedgerEntry.objects.filter(snapshotted=False).order_by('id')
+            if connection.features.has_select_for_update_skip_locked:
+                entries = entries.select_for_update(skip_locked=True)
+            else:
+                entries = entries.select_for_update()
+            rows = list(entries.values_list('id', 'user_id', 'amount')[:batch_size])
+            if not rows:
+                break
+            tails = {}
+            for _, user_id, amount in rows:
+                tails[user_id] = tails.get(user_id, Decimal('0.00')) + amount
+            now = timezone.now()
+            snapshots = BonusBalanceSnapshot.objects.select_for_update().in_bulk(sorted(tails))
+            for snapshot in snapshots.values():
+                snapshot.balance += tails[snapshot.user_id]
+                snapshot.taken_at = now
+            BonusBalanceSnapshot.objects.bulk_update(list(snapshots.values()), ['balance', 'taken_at'])
+            BonusBalanceSnapshot.objects.bulk_create([
+                BonusBalanceSnapshot(user_id=user_id, balance=total, taken_at=now)
+                for user_id, total in tails.items() if user_id not in snapshots
+            ])
+            BonusLedgerEntry.objects.filter(id__in=[row[0] for row in rows]).update(snapshotted=True)
+        written += len(tails)
+        if len(rows) < batch_size:
+            break
+    if written:
+        logger.info(f"Bonus ledger: wrote {written} balance snapshots")
+    return written
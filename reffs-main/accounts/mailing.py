@@ -0,0 +1,69 @@
+"""
+Email building and pooled connections.
+"""
+import logging
+import smtplib
+import threading
+
+from django.conf import settings
+from django.core.mail import EmailMessage, EmailMultiAlternatives, get_connection
+
+logger = logging.getLogger(__name__)
+
+
+def html_email(subject, html, recipient):
+    """An HTML-only email, as send_mail(message='', html_message=...) builds"""
+    message = EmailMultiAlternatives(subject, '', settings.DEFAULT_FROM_EMAIL, [recipient])
+    message.attach_alternative(html, 'text/html')
+    return message
+
+
+def text_email(subject, body, recipient):
+    return EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, [recipient])
+
+
+class ConnectionPool:
+    """
+    Open email backend connections shared by concurrent senders. A sender
+    takes an idle connection (or opens one), sends a message and hands it
+    back, so N concurrent senders use at most N connections. A connection
+    that fails for any reason other than a refused recipient is dropped.
+    """
+
+    def __init__(self):
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _take(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        connection = get_connection(fail_silently=False)
+        connection.open()
+        return connection
+
+    def _give(self, connection):
+        with self.lock:
+            self.idle.append(connection)
+
+    def send(self, message):
+        connection = self._take()
+        try:
+            if not connection.send_messages([message]):
+                raise RuntimeError(f"Email backend did not send to {', '.join(message.to)}")
+        except smtplib.SMTPRecipientsRefused:
+            self._give(connection)
+            raise
+        except Exception:
+            connection.close()
+            raise
+        self._give(connection)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            try:
+                connection.close()
+            except Exception as e:
+                logger.error(f"Failed to close email connection: {str(e)}")
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from accounts.referrals import rebuild_closure
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the referral closure table from User.referred_by'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-depth', type=int, default=100,
+                            help='Deepest referral level to follow')
+
+    def handle(self, *args, **options):
+        levels = rebuild_closure(max_depth=options['max_depth'])
+        for depth, rows in enumerate(levels):
+            self.stdout.write(f"  depth {depth}: {rows} links")
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt referral closure: {sum(levels)} links over {len(levels) - 1} levels"
+        ))
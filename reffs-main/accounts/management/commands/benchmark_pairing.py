@@ -0,0 +1,184 @@
+import json
+import time
+import tracemalloc
+from datetime import timedelta
+from decimal import Decimal
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from accounts.matching import POLICIES, get_policy
+from accounts.models import Investment, User
+from accounts.pairing import PairingBook, PairingPlan, run_pairing
+
+# Bid limits enforced by InvestmentSerializer.validate_amount
+MIN_AMOUNT = 100
+MAX_AMOUNT = 30000
+DISTRIBUTIONS = ('uniform', 'small_skewed', 'bimodal')
+
+
+def sample_amounts(rng, size, distribution):
+    """Whole-unit amounts in the 100-30,000 range for the given distribution"""
+    if distribution == 'uniform':
+        amounts = rng.integers(MIN_AMOUNT, MAX_AMOUNT + 1, size)
+    elif distribution == 'small_skewed':
+        amounts = np.rint(rng.lognormal(mean=7.0, sigma=1.0, size=size))
+    elif distribution == 'bimodal':
+        small = rng.integers(MIN_AMOUNT, 1001, size)
+        large = rng.integers(20000, MAX_AMOUNT + 1, size)
+        amounts = np.where(rng.random(size) < 0.8, small, large)
+    else:
+        raise CommandError(f"Unknown distribution '{distribution}'")
+    return np.clip(amounts, MIN_AMOUNT, MAX_AMOUNT).astype(np.int64)
+
+
+def synthetic_book(size, distribution, seed, matured_ratio=0.3, users=None):
+    """
+    Generate a seeded synthetic book as unsaved Investment objects:
+    roughly ``matured_ratio`` matured payouts, the rest pending bids.
+    """
+    rng = np.random.default_rng(seed)
+    users = users or max(2, size // 4)
+    amounts = sample_amounts(rng, size, distribution)
+    periods = rng.choice([5, 10, 20, 30, 60], size)
+    owners = rng.integers(0, users, size)
+    matured_mask = rng.random(size) < matured_ratio
+    now = timezone.now()
+
+    investments = []
+    for i in range(size):
+        amount = Decimal(int(amounts[i]))
+        period = int(periods[i])
+        investment = Investment(
+            user_id=int(owners[i]),
+            amount=amount,
+            maturity_period=period,
+            maturity_date=now + timedelta(days=period),
+            pairing_reference=f"BENCH-{seed}-{i}",
+        )
+        if matured_mask[i]:
+            investment.status = 'matured'
+            investment.return_amount = amount + amount * Decimal('0.02') * period
+            investment.mature_at = now - timedelta(minutes=size - i)
+        else:
+            investment.status = 'pending'
+            investment.remn_amount = amount
+        investments.append(investment)
+    return investments, users
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the pairing engine against seeded synthetic order books'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                            help='Book sizes (matured + pending investments) to generate')
+        parser.add_argument('--distributions', nargs='+', choices=DISTRIBUTIONS, default=['uniform'],
+                            help='Amount distributions to generate')
+        parser.add_argument('--policies', nargs='+', choices=sorted(POLICIES), default=['fifo'],
+                            help='Matching policies to benchmark')
+        parser.add_argument('--seed', type=int, default=1, help='Random seed for the synthetic books')
+        parser.add_argument('--matured-ratio', type=float, default=0.3,
+                            help='Share of the book that is matured payouts')
+        parser.add_argument('--mode', choices=['db', 'memory'], default='db',
+                            help='db: load the book into the database and run the full engine inside '
+                                 'a rolled-back transaction; memory: run the matcher only')
+        parser.add_argument('--no-memory', action='store_true',
+                            help='Skip tracemalloc peak-memory tracking (it slows the run down)')
+        parser.add_argument('--output', default='pairing_benchmark.json',
+                            help='File to write the JSON results to')
+
+    def handle(self, *args, **options):
+        if options['mode'] == 'db' and Investment.objects.filter(status__in=['matured', 'pending']).exists():
+            self.stdout.write(self.style.WARNING(
+                'The database already has matured/pending investments; they will be part of every '
+                'run (everything is rolled back). Use an empty database for comparable numbers.'
+            ))
+        results = []
+        for size in options['sizes']:
+            for distribution in options['distributions']:
+                for policy in options['policies']:
+                    result = self.run_scenario(size, distribution, policy, options)
+                    results.append(result)
+                    self.stdout.write(
+                        f"{size:>8} {distribution:<13} {policy:<15} {result['wall_seconds']:>9.3f}s "
+                        f"{result['rows_written']:>8} rows {result['queries']:>6} queries "
+                        f"{result['peak_memory_mb'] if result['peak_memory_mb'] is not None else '-':>8} MB"
+                    )
+
+        report = {
+            'generated_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'mode': options['mode'],
+            'seed': options['seed'],
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {len(results)} results to {options['output']}"))
+
+    def run_scenario(self, size, distribution, policy, options):
+        investments, users = synthetic_book(size, distribution, options['seed'], options['matured_ratio'])
+        matured = sum(1 for inv in investments if inv.status == 'matured')
+        queries = [0]
+
+        def count_queries(execute, sql, params, many, context):
+            queries[0] += 1
+            return execute(sql, params, many, context)
+
+        with transaction.atomic():
+            if options['mode'] == 'db':
+                self.load_book(investments, users)
+            trace_memory = not options['no_memory']
+            if trace_memory:
+                tracemalloc.start()
+            started = time.perf_counter()
+            with connection.execute_wrapper(count_queries):
+                if options['mode'] == 'db':
+                    plans = run_pairing(policy=policy)
+                else:
+                    plans = [self.match_in_memory(investments, policy)]
+            wall = time.perf_counter() - started
+            peak = None
+            if trace_memory:
+                peak = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+                tracemalloc.stop()
+            transaction.set_rollback(True)
+
+        pairs = sum(len(plan.pairs) for plan in plans)
+        updates = sum(plan.investment_updates for plan in plans)
+        return {
+            'size': size,
+            'distribution': distribution,
+            'policy': policy,
+            'matured': matured,
+            'wall_seconds': round(wall, 4),
+            'match_seconds': round(sum(plan.match_seconds for plan in plans), 4),
+            'pairs': pairs,
+            'rows_written': pairs + updates if options['mode'] == 'db' else 0,
+            'queries': queries[0],
+            'peak_memory_mb': peak,
+        }
+
+    def load_book(self, investments, users):
+        """Insert the synthetic users and investments; rolled back afterwards"""
+        created = User.objects.bulk_create([
+            User(username=f'bench_user_{i}', phone_number=f'bench{i:010d}', password='!')
+            for i in range(users)
+        ], batch_size=2000)
+        ids = [user.id for user in created]
+        for investment in investments:
+            investment.user_id = ids[investment.user_id]
+        Investment.objects.bulk_create(investments, batch_size=2000)
+
+    def match_in_memory(self, investments, policy):
+        book = PairingBook(
+            [inv for inv in investments if inv.status == 'matured'],
+            [inv for inv in investments if inv.status == 'pending'],
+        )
+        policy = get_policy(policy)
+        started = time.perf_counter()
+        allocations = policy.allocate(book)
+        return PairingPlan(book, allocations, policy.name, time.perf_counter() - started)
@@ -1,33 +1,154 @@
-from django.core.management.base import BaseCommand
+import json
+import multiprocessing
+import os
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
 from django.utils import timezone
-from django.db import transaction
-from accounts.models import Investment, Queue
-from datetime import timedelta
+
+from accounts.maturity import due_investments, mature_chunk
+from accounts.pairing import schedule_pairing
+
+
+def _init_worker():
+    import django
+
+    django.setup()
+
+
+def mature_range(job):
+    """Pool worker: mature the due investments in one (after_id, last_id] range"""
+    after_id, last_id, since, until, chunk_size, pairing = job
+    queryset = due_investments(datetime.fromisoformat(until))
+    if since:
+        queryset = queryset.filter(mature_at__gte=datetime.fromisoformat(since))
+    with transaction.atomic():
+        ids = mature_chunk(queryset, after_id, chunk_size, last_id=last_id)
+        if ids and pairing:
+            schedule_pairing(matured_ids=ids)
+    return last_id, len(ids)
+
 
 class Command(BaseCommand):
-    help = 'Check and process matured investments'
+    help = 'Move confirmed investments past their maturity date to matured, in resumable chunks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'MATURITY_CHUNK_SIZE', 1000),
+                            help='Investments matured per UPDATE/transaction')
+        parser.add_argument('--since', help='Only investments maturing at or after this ISO date/time')
+        parser.add_argument('--resume', action='store_true',
+                            help='Continue an interrupted run from its checkpoint')
+        parser.add_argument('--state-file', default=str(settings.BASE_DIR / 'var' / 'check_matured_investments.json'),
+                            help='Checkpoint file used by --resume')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Spread chunks across this many processes (PostgreSQL only)')
+        parser.add_argument('--no-pairing', action='store_true',
+                            help='Do not queue pairing for the matured investments')
 
     def handle(self, *args, **options):
-        # Get all pending investments that have reached maturity
-        matured_investments = Investment.objects.filter(
-            status='pending',
-            created_at__lte=timezone.now() - timedelta(days=F('maturity_period'))
+        state = self.load_state(options) if options['resume'] else self.new_state(options)
+        until = datetime.fromisoformat(state['until'])
+        queryset = due_investments(until)
+        if state['since']:
+            queryset = queryset.filter(mature_at__gte=datetime.fromisoformat(state['since']))
+        total = queryset.filter(id__gt=state['after_id']).count()
+        self.stdout.write(
+            f"{total} investments due by {state['until']}"
+            f"{' since ' + state['since'] if state['since'] else ''}"
+            f"{', resuming after id ' + str(state['after_id']) if options['resume'] else ''}"
         )
 
-        with transaction.atomic():
-            for investment in matured_investments:
-                # Update investment status
-                investment.status = 'matured'
-                investment.save()
-
-                # Create queue entry
-                Queue.objects.create(
-                    user=investment.user,
-                    amount_remaining=investment.return_amount
-                )
-
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f'Processed matured investment {investment.id} for user {investment.user.username}'
-                    )
-                ) 
\ No newline at end of file
+        workers = options['workers']
+        if workers > 1 and connection.vendor == 'sqlite':
+            self.stdout.write(self.style.WARNING('SQLite allows one writer at a time; using a single worker'))
+            workers = 1
+
+        self.started = time.perf_counter()
+        self.done = 0
+        if workers > 1:
+            self.run_pool(queryset, state, options, workers, total)
+        else:
+            self.run_serial(queryset, state, options, total)
+
+        if os.path.exists(options['state_file']):
+            os.remove(options['state_file'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Matured {state['matured']} investments in {time.perf_counter() - self.started:.1f}s"
+        ))
+
+    def new_state(self, options):
+        since = None
+        if options['since']:
+            try:
+                since = datetime.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError(f"Invalid --since value '{options['since']}'")
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            since = since.isoformat()
+        return {'until': timezone.now().isoformat(), 'since': since, 'after_id': 0, 'matured': 0}
+
+    def load_state(self, options):
+        try:
+            with open(options['state_file']) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise CommandError(f"No checkpoint at {options['state_file']} to resume from")
+
+    def save_state(self, state, options):
+        os.makedirs(os.path.dirname(options['state_file']) or '.', exist_ok=True)
+        tmp = f"{options['state_file']}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, options['state_file'])
+
+    def progress(self, state, options, matured, total):
+        self.done += matured
+        state['matured'] += matured
+        self.save_state(state, options)
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(
+            f"  {self.done}/{total} matured ({self.done / elapsed if elapsed else 0:.0f}/s), "
+            f"checkpoint id {state['after_id']}"
+        )
+
+    def run_serial(self, queryset, state, options, total):
+        while True:
+            with transaction.atomic():
+                ids = mature_chunk(queryset, state['after_id'], options['batch_size'])
+                if ids and not options['no_pairing']:
+                    schedule_pairing(matured_ids=ids)
+            if not ids:
+                break
+            state['after_id'] = ids[-1]
+            self.progress(state, options, len(ids), total)
+
+    def run_pool(self, queryset, state, options, workers, total):
+        """
+        Cut the due id range into batch-size slices up front (ids only),
+        then mature the slices in parallel. Results come back in order, so
+        the checkpoint only moves past slices that have all committed.
+        """
+        batch_size = options['batch_size']
+        due_ids = queryset.filter(id__gt=state['after_id']).order_by('id').values_list('id', flat=True)
+        bounds = [pk for position, pk in enumerate(due_ids.iterator(chunk_size=10000), 1)
+                  if position % batch_size == 0]
+        if total % batch_size:
+            bounds.append(None)
+        jobs = []
+        after_id = state['after_id']
+        for last_id in bounds:
+            jobs.append((after_id, last_id, state['since'], state['until'], batch_size,
+                         not options['no_pairing']))
+            after_id = last_id
+
+        # Children must not share the parent's database connections
+        connections.close_all()
+        with multiprocessing.get_context().Pool(workers, initializer=_init_worker) as pool:
+            for last_id, matured in pool.imap(mature_range, jobs):
+                if last_id is not None:
+                    state['after_id'] = last_id
+                self.progress(state, options, matured, total)
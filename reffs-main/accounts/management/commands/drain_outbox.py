@@ -0,0 +1,40 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from accounts import outbox
+
+
+class Command(BaseCommand):
+    help = 'Dispatch the notification calls recorded in the transactional outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'OUTBOX_BATCH_SIZE', 100),
+                            help='Outbox rows claimed per transaction')
+        parser.add_argument('--direct', action='store_true',
+                            help='Run the tasks in this process instead of pushing them to Celery')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep draining until interrupted')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to sleep between drains when the outbox is empty (with --loop)')
+
+    def handle(self, *args, **options):
+        direct = options['direct'] or None
+        total_sent = total_failed = 0
+        try:
+            while True:
+                sent, failed = outbox.drain(batch_size=options['batch_size'], direct=direct)
+                total_sent += sent
+                total_failed += failed
+                if sent or failed:
+                    self.stdout.write(f"  dispatched {sent} ({failed} failed)")
+                if not options['loop']:
+                    break
+                if not sent and not failed:
+                    time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(
+            f"Dispatched {total_sent} outbox messages ({total_failed} failed)"
+        ))
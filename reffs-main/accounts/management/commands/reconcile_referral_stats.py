@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from accounts import referral_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the per-user referral counters and fix any that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report drifted counters without fixing them')
+
+    def handle(self, *args, **options):
+        drifted = referral_stats.reconcile(dry_run=options['dry_run'])
+        for user_id in drifted[:20]:
+            self.stdout.write(f"  user {user_id}: counters drifted")
+        if len(drifted) > 20:
+            self.stdout.write(f"  ... and {len(drifted) - 20} more")
+        verb = 'Found' if options['dry_run'] else 'Fixed'
+        self.stdout.write(self.style.SUCCESS(f"{verb} {len(drifted)} users with drifted referral counters"))
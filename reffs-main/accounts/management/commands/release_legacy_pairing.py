@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.models import PairedInvestment
+from accounts.reminders import release_legacy
+
+
+class Command(BaseCommand):
+    help = ('Release an expired pairing made before its investments were recorded, '
+            'once its matured investment is known')
+
+    def add_arguments(self, parser):
+        parser.add_argument('pairing_id', type=int)
+        parser.add_argument('--matured-investment', type=int, required=True,
+                            help='Id of the investment the pairing paid out')
+        parser.add_argument('--new-investment', type=int,
+                            help="Id of the bidder's investment, if the pairing does not record it")
+
+    def handle(self, *args, **options):
+        try:
+            matured, pending = release_legacy(
+                options['pairing_id'], options['matured_investment'], options['new_investment']
+            )
+        except (PairedInvestment.DoesNotExist, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"Released pairing {options['pairing_id']} to investments {matured[0]} and {pending[0]}"
+        ))
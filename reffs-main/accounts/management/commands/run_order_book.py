@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.matching import POLICIES
+from accounts.orderbook import OrderBookService
+
+
+class Command(BaseCommand):
+    help = 'Run the resident in-memory order book that pairs investments (PAIRING_ENGINE = "resident")'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--data-dir',
+            default=str(getattr(settings, 'PAIRING_BOOK_DIR', 'orderbook')),
+            help='Directory holding the book snapshot and write-ahead log',
+        )
+        parser.add_argument(
+            '--policy',
+            choices=sorted(POLICIES),
+            help='Matching policy to use (defaults to settings.PAIRING_POLICY)',
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help='Events applied per matching round')
+        parser.add_argument('--snapshot-every', type=int, default=10000,
+                            help='Write a snapshot after this many logged book changes')
+        parser.add_argument('--resync-seconds', type=int, default=900,
+                            help='Reload the open book from the database this often (0 to disable)')
+        parser.add_argument('--once', action='store_true',
+                            help='Process the events already queued, pair, snapshot and exit')
+
+    def handle(self, *args, **options):
+        service = OrderBookService(
+            options['data_dir'],
+            policy=options['policy'],
+            snapshot_every=options['snapshot_every'],
+        )
+        self.stdout.write(f"Order book data in {options['data_dir']}")
+        try:
+            service.run(
+                batch_size=options['batch_size'],
+                resync_seconds=options['resync_seconds'],
+                once=options['once'],
+            )
+        except RuntimeError as e:
+            raise CommandError(str(e))
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(
+            f"Order book stopped: {len(service.book.matured)} matured, "
+            f"{len(service.book.pending)} pending open"
+        ))
@@ -1,53 +1,123 @@
-from django.core.management.base import BaseCommand
-from django.db import transaction
-from accounts.models import Investment, Queue
-from decimal import Decimal
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.matching import POLICIES
+from accounts.pairing import PairingLeaseBusy, compare_policies, run_pairing, simulate_pairing
+
 
 class Command(BaseCommand):
     help = 'Pair matured investments with new investors'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Run the matcher against a snapshot of the book and report the result without writing anything',
+        )
+        parser.add_argument(
+            '--policy',
+            choices=sorted(POLICIES),
+            help='Matching policy to use (defaults to settings.PAIRING_POLICY)',
+        )
+        parser.add_argument(
+            '--measure-writes',
+            action='store_true',
+            help='With --dry-run, execute the writes and roll them back to time them. The rows '
+                 'written stay locked until the rollback, and the run waits for no sweep: it '
+                 'fails if one is running',
+        )
+        parser.add_argument(
+            '--show-pairs',
+            type=int,
+            default=20,
+            help='With --dry-run, number of proposed pairs to list (0 for none, -1 for all)',
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='With --dry-run, print the full report as JSON',
+        )
+        parser.add_argument(
+            '--compare',
+            nargs='+',
+            choices=sorted(POLICIES),
+            metavar='POLICY',
+            help='Dry-run these policies against the current book and compare their fragments '
+                 '(reductions are relative to the first one)',
+        )
+
     def handle(self, *args, **options):
-        # Get all pending investments
-        pending_investments = Investment.objects.filter(status='pending')
-        
-        # Get all queue entries
-        queue_entries = Queue.objects.all().order_by('created_at')
-
-        with transaction.atomic():
-            for investment in pending_investments:
-                amount_to_match = investment.amount
-                
-                while amount_to_match > 0 and queue_entries.exists():
-                    queue_entry = queue_entries.first()
-                    
-                    if queue_entry.amount_remaining <= amount_to_match:
-                        # Full match
-                        investment.paired_to = queue_entry.user
-                        investment.status = 'paired'
-                        investment.save()
-                        
-                        queue_entry.delete()
-                        amount_to_match = Decimal('0')
-                        
-                        self.stdout.write(
-                            self.style.SUCCESS(
-                                f'Paired investment {investment.id} with queue entry {queue_entry.id}'
-                            )
-                        )
-                    else:
-                        # Partial match
-                        investment.paired_to = queue_entry.user
-                        investment.status = 'paired'
-                        investment.save()
-                        
-                        queue_entry.amount_remaining -= amount_to_match
-                        queue_entry.save()
-                        amount_to_match = Decimal('0')
-                        
-                        self.stdout.write(
-                            self.style.SUCCESS(
-                                f'Partially paired investment {investment.id} with queue entry {queue_entry.id}'
-                            )
-                        )
-                    
-                    queue_entries = queue_entries.exclude(id=queue_entry.id) 
\ No newline at end of file
+        if options['measure_writes'] and not options['dry_run']:
+            raise CommandError('--measure-writes only applies to --dry-run')
+
+        if options['compare']:
+            self.compare(options['compare'], options['json'])
+            return
+
+        if not options['dry_run']:
+            plans = run_pairing(policy=options['policy'])
+            pairs = sum(len(plan.pairs) for plan in plans)
+            self.stdout.write(self.style.SUCCESS(f'Created {pairs} pairings in {len(plans)} batch(es)'))
+            return
+
+        show_pairs = options['show_pairs']
+        try:
+            report = simulate_pairing(
+                policy=options['policy'],
+                measure_writes=options['measure_writes'],
+                max_pairs=None if show_pairs < 0 or options['json'] else show_pairs,
+            )
+        except PairingLeaseBusy as e:
+            raise CommandError(f"{e}; retry --measure-writes once the sweep is done")
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+
+        self.stdout.write(self.style.SUCCESS(f"=== Pairing dry run ({report['policy']}) ==="))
+        self.stdout.write(f"Book: {report['matured_count']} matured, {report['pending_count']} pending")
+        self.stdout.write(f"Proposed pairs: {report['pair_count']} totalling {report['total_paired']}")
+        unmatched = report['unmatched']
+        self.stdout.write(
+            f"Unmatched matured: {unmatched['matured_count']} ({unmatched['matured_amount']}), "
+            f"unmatched pending: {unmatched['pending_count']} ({unmatched['pending_amount']})"
+        )
+        for side, stats in report['fragments'].items():
+            self.stdout.write(
+                f"Fragments {side.replace('_', ' ')}: max {stats['max']}, avg {stats['avg']} "
+                f"over {stats['investments']} investments"
+            )
+        timing = report['timing']
+        write_label = 'write' if timing['write_executed'] else 'would-be write (row build only)'
+        self.stdout.write(
+            f"Timing: load {timing['load_ms']}ms, match {timing['match_ms']}ms, "
+            f"{write_label} {timing['write_ms']}ms ({report['throughput']} entries/s)"
+        )
+
+        for pair in report['pairs']:
+            self.stdout.write(
+                f"  investment {pair['matured_investment_id']} (user {pair['matured_investor_id']}) "
+                f"<- investment {pair['new_investment_id']} (user {pair['new_investor_id']}): {pair['amount']}"
+            )
+        if len(report['pairs']) < report['pair_count']:
+            self.stdout.write(f"  ... {report['pair_count'] - len(report['pairs'])} more")
+
+    def compare(self, policies, as_json):
+        reports = compare_policies(policies)
+        if as_json:
+            self.stdout.write(json.dumps(reports, indent=2))
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"=== Policy comparison ({reports[0]['matured_count']} matured, "
+            f"{reports[0]['pending_count']} pending) ==="
+        ))
+        for report in reports:
+            per_matured = report['fragments']['per_matured']
+            self.stdout.write(
+                f"{report['policy']:<15} {report['pair_count']:>7} pairs  "
+                f"avg {per_matured['avg']:>5} / max {per_matured['max']:>3} per matured  "
+                f"unmatched {report['unmatched']['matured_amount']:>12}  "
+                f"{report['timing']['match_ms']:>8}ms  "
+                f"{report['fragment_reduction'] * 100:>6.1f}% fewer rows"
+            )
@@ -0,0 +1,367 @@
+"""
+Matching policies for the pairing engine.
+
+A policy turns a PairingBook into a list of (matured_idx, pending_idx, cents)
+allocations. Policies only see plain lists of amounts and user ids, so they
+can be swapped per run and benchmarked against each other.
+"""
+import heapq
+
+import numpy as np
+from django.conf import settings
+from sortedcontainers import SortedList
+
+# Below this many book entries the NumPy set-up costs more than the loop.
+VECTORIZE_THRESHOLD = 256
+# Matured investments in the first merge window after a same-user conflict.
+MERGE_WINDOW = 64
+
+
+def fifo_allocate(matured_cents, matured_users, pending_cents, pending_users, matured_order=None):
+    """
+    Match matured payouts against pending bids, both in FIFO order.
+
+    Returns a list of (matured_idx, pending_idx, cents) allocations. Bids
+    owned by the same user as the matured investment are skipped and stay
+    open for the next matured investment. ``matured_order`` optionally
+    gives the order in which matured investments are served.
+    """
+    open_cents = list(pending_cents)
+    allocations = []
+    head = 0
+    size = len(open_cents)
+    if matured_order is None:
+        matured_order = range(len(matured_cents))
+
+    for mi in matured_order:
+        remaining = matured_cents[mi]
+        while head < size and open_cents[head] <= 0:
+            head += 1
+        ni = head
+        while remaining > 0 and ni < size:
+            available = open_cents[ni]
+            if available <= 0 or pending_users[ni] == matured_users[mi]:
+                ni += 1
+                continue
+            amount = min(available, remaining)
+            allocations.append((mi, ni, amount))
+            open_cents[ni] = available - amount
+            remaining -= amount
+            if open_cents[ni] == 0:
+                ni += 1
+
+    return allocations
+
+
+def _merge_segments(matured, pending):
+    """
+    Merge two FIFO queues given as cent arrays. Every boundary of either
+    cumulative sum starts a new segment; searchsorted maps each segment
+    back to the matured and pending entry it falls in.
+    """
+    matured_cum = np.cumsum(matured)
+    pending_cum = np.cumsum(pending)
+    total = min(matured_cum[-1], pending_cum[-1])
+    starts = np.concatenate((np.zeros(1, np.int64), matured_cum, pending_cum))
+    starts.sort()
+    starts = starts[np.concatenate(([True], starts[1:] != starts[:-1])) & (starts < total)]
+    ends = np.append(starts[1:], total)
+    seg_matured = np.searchsorted(matured_cum, starts, side='right')
+    seg_pending = np.searchsorted(pending_cum, starts, side='right')
+    return seg_matured, seg_pending, ends - starts
+
+
+def fifo_merge_kernel(matured_cents, matured_users, pending_cents, pending_users,
+                      matured_order=None):
+    """
+    NumPy FIFO matcher returning (matured_idx, pending_idx, cents) arrays
+    with the same allocations, in the same order, as fifo_allocate.
+
+    Without same-user conflicts FIFO matching is a merge of the two
+    cumulative-sum arrays. The merge runs over a window of matured
+    investments and just enough open bids to cover them, and the window
+    doubles while it merges cleanly. Segments are accepted up to the first
+    one whose matured and pending owners are the same user. That matured
+    investment is finished with the reference scan (which skips the bid),
+    and the merge resumes right after it with a small window again, so a
+    conflict only costs the run it falls in rather than a pass over the
+    rest of the book.
+
+    The open bids are kept as ``front``, the bids before ``head`` still
+    open (skipped or partly used), followed by every bid from ``head`` on,
+    which are untouched; the prefix sums of the original amounts locate
+    the end of a window's bids without rescanning.
+    """
+    order = np.arange(len(matured_cents)) if matured_order is None else np.asarray(matured_order)
+    matured = np.asarray(matured_cents, dtype=np.int64)[order] if len(order) else np.zeros(0, np.int64)
+    matured_user_arr = np.asarray(matured_users)[order] if len(order) else np.zeros(0, np.int64)
+    open_cents = np.asarray(pending_cents, dtype=np.int64).copy()
+    pending_user_arr = np.asarray(pending_users)
+    bid_cum = np.concatenate((np.zeros(1, np.int64), np.cumsum(np.maximum(open_cents, 0))))
+    size = len(open_cents)
+
+    out_matured, out_pending, out_cents = [], [], []
+    front = np.zeros(0, np.int64)
+    head = 0
+    start, window = 0, MERGE_WINDOW
+    while start < len(matured):
+        stop = min(start + window, len(matured))
+        end = head
+        need = int(matured[start:stop].sum()) - int(open_cents[front].sum())
+        if need > 0:
+            end = min(int(np.searchsorted(bid_cum, bid_cum[head] + need, side='left')), size)
+        queue = np.concatenate((front, np.arange(head, end)))
+        queue = queue[open_cents[queue] > 0]
+        if not len(queue):
+            if matured[start:stop].any():
+                break
+            start = stop
+            continue
+
+        seg_m, seg_n, seg_amt = _merge_segments(matured[start:stop], open_cents[queue])
+        seg_m = seg_m + start
+        seg_n = queue[seg_n]
+        conflicts = np.flatnonzero(matured_user_arr[seg_m] == pending_user_arr[seg_n])
+        cut = conflicts[0] if len(conflicts) else len(seg_amt)
+
+        np.subtract.at(open_cents, seg_n[:cut], seg_amt[:cut])
+        np.subtract.at(matured, seg_m[:cut], seg_amt[:cut])
+        out_matured.append(seg_m[:cut])
+        out_pending.append(seg_n[:cut])
+        out_cents.append(seg_amt[:cut])
+        front = queue[open_cents[queue] > 0]
+        head = end
+        if cut == len(seg_amt):
+            start, window = stop, window * 2
+            continue
+
+        # Finish the conflicting matured investment with the reference scan
+        mi = seg_m[cut]
+        remaining = int(matured[mi])
+        user_id = matured_user_arr[mi]
+        scan_m, scan_n, scan_amt = [], [], []
+
+        def take(ni):
+            if open_cents[ni] <= 0 or pending_user_arr[ni] == user_id:
+                return 0
+            amount = min(int(open_cents[ni]), remaining)
+            open_cents[ni] -= amount
+            scan_m.append(mi)
+            scan_n.append(ni)
+            scan_amt.append(amount)
+            return amount
+
+        for ni in front.tolist():
+            if remaining <= 0:
+                break
+            remaining -= take(ni)
+        scanned = head
+        while remaining > 0 and scanned < size:
+            remaining -= take(scanned)
+            scanned += 1
+        matured[mi] = remaining
+        front = np.concatenate((front, np.arange(head, scanned)))
+        front = front[open_cents[front] > 0]
+        head = scanned
+
+        out_matured.append(np.asarray(scan_m, dtype=np.int64))
+        out_pending.append(np.asarray(scan_n, dtype=np.int64))
+        out_cents.append(np.asarray(scan_amt, dtype=np.int64))
+        start, window = mi + 1, MERGE_WINDOW
+
+    if not out_matured:
+        empty = np.zeros(0, np.int64)
+        return empty, empty, empty
+    return (order[np.concatenate(out_matured)], np.concatenate(out_pending),
+            np.concatenate(out_cents))
+
+
+def fifo_allocate_vectorized(matured_cents, matured_users, pending_cents, pending_users,
+                             matured_order=None):
+    """fifo_merge_kernel with its output converted to fifo_allocate's tuples"""
+    seg_m, seg_n, seg_amt = fifo_merge_kernel(matured_cents, matured_users, pending_cents,
+                                              pending_users, matured_order)
+    return list(zip(seg_m.tolist(), seg_n.tolist(), seg_amt.tolist()))
+
+
+class MatchingPolicy:
+    """Base class for matching policies"""
+    name = None
+
+    def allocate(self, book):
+        raise NotImplementedError
+
+
+class FifoPolicy(MatchingPolicy):
+    """Oldest matured investment first, paid by the oldest bids first"""
+    name = 'fifo'
+
+    def allocate(self, book):
+        allocate = fifo_allocate
+        if len(book.matured_cents) + len(book.pending_cents) >= VECTORIZE_THRESHOLD:
+            allocate = fifo_allocate_vectorized
+        return allocate(book.matured_cents, book.matured_users,
+                        book.pending_cents, book.pending_users)
+
+
+class OldestMaturedFirstPolicy(MatchingPolicy):
+    """
+    Serve matured investments in the order they reached maturity rather
+    than the order they were created, paid by the oldest bids first.
+    """
+    name = 'oldest_matured'
+
+    def allocate(self, book):
+        heap = [
+            (mature_at is None, mature_at or 0, mi)
+            for mi, mature_at in enumerate(book.matured_mature_at)
+        ]
+        heapq.heapify(heap)
+        order = [heapq.heappop(heap)[2] for _ in range(len(heap))]
+        allocate = fifo_allocate
+        if len(book.matured_cents) + len(book.pending_cents) >= VECTORIZE_THRESHOLD:
+            allocate = fifo_allocate_vectorized
+        return allocate(book.matured_cents, book.matured_users,
+                        book.pending_cents, book.pending_users, matured_order=order)
+
+
+class LargestFirstPolicy(MatchingPolicy):
+    """
+    Oldest matured investment first, paid by the largest open bids first
+    (max-heap, ties broken by age) to keep fragments per payout low.
+    """
+    name = 'largest_first'
+
+    def allocate(self, book):
+        heap = [(-cents, ni) for ni, cents in enumerate(book.pending_cents) if cents > 0]
+        heapq.heapify(heap)
+        allocations = []
+
+        for mi, remaining in enumerate(book.matured_cents):
+            skipped = []
+            while remaining > 0 and heap:
+                neg_cents, ni = heapq.heappop(heap)
+                if book.pending_users[ni] == book.matured_users[mi]:
+                    skipped.append((neg_cents, ni))
+                    continue
+                amount = min(-neg_cents, remaining)
+                allocations.append((mi, ni, amount))
+                remaining -= amount
+                if -neg_cents > amount:
+                    heapq.heappush(heap, (neg_cents + amount, ni))
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+
+        return allocations
+
+
+class BestFitPolicy(MatchingPolicy):
+    """
+    Oldest matured investment first. Each step takes the smallest bid that
+    covers what is left of the payout, or the largest bid below it when
+    none does, so exact fits are found before anything is split.
+    """
+    name = 'best_fit'
+
+    def allocate(self, book):
+        bids = SortedList((cents, ni) for ni, cents in enumerate(book.pending_cents) if cents > 0)
+        allocations = []
+
+        for mi, remaining in enumerate(book.matured_cents):
+            user_id = book.matured_users[mi]
+            while remaining > 0 and bids:
+                pos = bids.bisect_left((remaining, -1))
+                entry = self._first_eligible(bids, range(pos, len(bids)), book, user_id)
+                if entry is None:
+                    entry = self._first_eligible(bids, range(pos - 1, -1, -1), book, user_id)
+                if entry is None:
+                    break
+                cents, ni = entry
+                bids.remove(entry)
+                amount = min(cents, remaining)
+                allocations.append((mi, ni, amount))
+                remaining -= amount
+                if cents > amount:
+                    bids.add((cents - amount, ni))
+
+        return allocations
+
+    @staticmethod
+    def _first_eligible(bids, positions, book, user_id):
+        for pos in positions:
+            entry = bids[pos]
+            if book.pending_users[entry[1]] != user_id:
+                return entry
+        return None
+
+
+class MinFragmentsPolicy(MatchingPolicy):
+    """
+    Oldest matured investment first, paid with as few bids as possible so
+    each payout needs fewer PairedInvestment rows, transfers and
+    confirmations: best fit (see BestFitPolicy), except that bids that
+    have waited longer than ``max_wait`` seconds are served first, in FIFO
+    order, so no bid starves behind better-fitting ones.
+
+    Searching for an exact subset of the bids below the remainder was
+    tried too. On the seeded benchmark books it never created fewer rows
+    than best fit and was 2-6x slower, so there is no such search.
+    """
+    name = 'min_fragments'
+
+    def __init__(self, max_wait=None):
+        if max_wait is None:
+            max_wait = getattr(settings, 'PAIRING_MAX_WAIT_SECONDS', 86400)
+        self.max_wait = max_wait
+
+    def allocate(self, book):
+        open_cents = list(book.pending_cents)
+        bids = SortedList((cents, ni) for ni, cents in enumerate(open_cents) if cents > 0)
+        waited = getattr(book, 'pending_waited', None) or [0] * len(open_cents)
+        overdue = [ni for ni, cents in enumerate(open_cents) if cents > 0 and waited[ni] >= self.max_wait]
+        allocations = []
+
+        def take(mi, ni, amount):
+            bids.remove((open_cents[ni], ni))
+            open_cents[ni] -= amount
+            if open_cents[ni] > 0:
+                bids.add((open_cents[ni], ni))
+            allocations.append((mi, ni, amount))
+            return amount
+
+        for mi, remaining in enumerate(book.matured_cents):
+            user_id = book.matured_users[mi]
+            for ni in overdue:
+                if remaining <= 0:
+                    break
+                if open_cents[ni] > 0 and book.pending_users[ni] != user_id:
+                    remaining -= take(mi, ni, min(open_cents[ni], remaining))
+            overdue = [ni for ni in overdue if open_cents[ni] > 0]
+
+            while remaining > 0 and bids:
+                pos = bids.bisect_left((remaining, -1))
+                entry = BestFitPolicy._first_eligible(bids, range(pos, len(bids)), book, user_id)
+                if entry is None:
+                    entry = BestFitPolicy._first_eligible(bids, range(pos - 1, -1, -1), book, user_id)
+                if entry is None:
+                    break
+                remaining -= take(mi, entry[1], min(entry[0], remaining))
+
+        return allocations
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in (FifoPolicy, OldestMaturedFirstPolicy, LargestFirstPolicy, BestFitPolicy,
+                   MinFragmentsPolicy)
+}
+
+
+def get_policy(name=None):
+    """Return a policy instance by name, defaulting to FIFO"""
+    if isinstance(name, MatchingPolicy):
+        return name
+    try:
+        return POLICIES[name or FifoPolicy.name]()
+    except KeyError:
+        raise ValueError(f"Unknown matching policy '{name}'. Choose from: {', '.join(POLICIES)}")
@@ -0,0 +1,188 @@
+"""
+Bulk maturity transitions and the maturity timer wheel.
+
+Confirmed investments whose countdown has ended are moved to 'matured' in
+chunks. Each chunk is one short transaction that claims the next ids and
+flips them with a single UPDATE, so locks are held for one chunk at a time
+however large the backlog is. The affected ids are returned for batch
+follow-up work.
+
+Maturity is driven by a timer wheel rather than by polling. start_countdown
+registers the investment's mature_at minute in a MaturityBucket row. Once a
+bucket is within MATURITY_ARM_HORIZON seconds, one ETA task is queued for
+it (coalesced across every investment in that minute). When the task fires
+it matures just that minute's investments. The periodic
+check_matured_investments sweep remains only as a safety net.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from accounts import outbox
+from accounts.forecast import mark_day_dirty
+from accounts.models import Investment, MaturityBucket
+from accounts.pairing import schedule_pairing
+
+BUCKET_WIDTH = timedelta(minutes=1)
+
+logger = logging.getLogger(__name__)
+
+
+def due_investments(now=None):
+    """Confirmed investments whose countdown has ended by ``now``"""
+    return Investment.objects.filter(
+        is_confirmed=True,
+        status='confirmed',
+        mature_at__lte=now or timezone.now()
+    )
+
+
+def mature_chunk(queryset, after_id=0, chunk_size=1000, last_id=None):
+    """
+    Flip the next ``chunk_size`` rows of ``queryset`` with id > ``after_id``
+    (and <= ``last_id`` if given) to matured and return their ids. Rows
+    locked by another worker are skipped where the database supports SKIP
+    LOCKED. Must run inside a transaction.
+    """
+    claim = queryset.filter(id__gt=after_id).order_by('id')
+    if last_id is not None:
+        claim = claim.filter(id__lte=last_id)
+    if connection.features.has_select_for_update_skip_locked:
+        claim = claim.select_for_update(skip_locked=True)
+    ids = list(claim.values_list('id', flat=True)[:chunk_size])
+    if ids:
+        Investment.objects.filter(id__in=ids, status='confirmed').update(status='matured')
+        # Today's payouts moved into the matured backlog
+        mark_day_dirty(timezone.localdate())
+        # One notification run covers every chunk still waiting in the outbox
+        outbox.enqueue('accounts.tasks.send_maturity_notification')
+    return ids
+
+
+def mature_due_investments(now=None, chunk_size=None, schedule=True, queryset=None):
+    """
+    Move every investment due by ``now`` (optionally narrowed to
+    ``queryset``) to matured, one chunked UPDATE at a time, and return the
+    matured ids. With ``schedule`` each committed chunk is handed to the
+    pairing engine as one batch.
+    """
+    now = now or timezone.now()
+    chunk_size = chunk_size or getattr(settings, 'MATURITY_CHUNK_SIZE', 1000)
+    queryset = due_investments(now) & (queryset if queryset is not None else Investment.objects.all())
+    matured_ids = []
+    after_id = 0
+    while True:
+        with transaction.atomic():
+            ids = mature_chunk(queryset, after_id, chunk_size)
+            if not ids:
+                break
+            if schedule:
+                schedule_pairing(matured_ids=ids)
+        matured_ids.extend(ids)
+        after_id = ids[-1]
+        if len(ids) < chunk_size:
+            break
+    if matured_ids:
+        logger.info(f"Matured {len(matured_ids)} investments")
+    return matured_ids
+
+
+def bucket_start(moment):
+    return moment.replace(second=0, microsecond=0)
+
+
+def arm_horizon():
+    return timedelta(seconds=getattr(settings, 'MATURITY_ARM_HORIZON', 3600))
+
+
+def schedule_maturity(mature_at):
+    """
+    Put a countdown on the timer wheel. The minute bucket is created once
+    and shared by every investment maturing in it; it is armed straight
+    away when it falls inside the arming horizon. A bucket whose minute has
+    already ended may have fired without this investment, so it gets
+    another tick.
+    """
+    if mature_at is None:
+        return
+    bucket, _ = MaturityBucket.objects.get_or_create(bucket=bucket_start(mature_at))
+    now = timezone.now()
+    if bucket.armed_at is None:
+        if bucket.bucket < now + arm_horizon():
+            arm_bucket(bucket)
+    elif bucket.bucket + BUCKET_WIDTH <= now:
+        rearm_bucket(bucket)
+
+
+def arm_bucket(bucket):
+    """
+    Queue the bucket's ETA task once the transaction commits. The
+    conditional UPDATE makes sure only one caller queues it.
+    """
+    if not MaturityBucket.objects.filter(id=bucket.id, armed_at__isnull=True).update(armed_at=timezone.now()):
+        return False
+    queue_tick(bucket.id, bucket.bucket + BUCKET_WIDTH)
+    return True
+
+
+def rearm_bucket(bucket):
+    """
+    Queue another tick for an armed (possibly fired) bucket. Changing
+    armed_at also stops a tick already running from marking the bucket
+    fired, so the new tick always runs.
+    """
+    if not MaturityBucket.objects.filter(id=bucket.id, armed_at=bucket.armed_at).update(
+        armed_at=timezone.now(), fired_at=None
+    ):
+        return False
+    queue_tick(bucket.id, bucket.bucket + BUCKET_WIDTH)
+    return True
+
+
+def queue_tick(bucket_id, eta):
+    """Queue the mature_bucket task for ``eta`` once the transaction commits"""
+    def enqueue():
+        from accounts.tasks import mature_bucket
+
+        try:
+            mature_bucket.apply_async(args=[bucket_id], eta=eta)
+        except Exception as e:
+            # The check_matured_investments sweep picks these up later.
+            logger.error(f"Failed to queue maturity bucket {bucket_id}: {str(e)}")
+
+    transaction.on_commit(enqueue)
+
+
+def arm_due_buckets():
+    """Arm every bucket that has come within the horizon; returns how many were armed"""
+    buckets = MaturityBucket.objects.filter(
+        armed_at__isnull=True, bucket__lt=timezone.now() + arm_horizon()
+    ).order_by('bucket')
+    armed = sum(1 for bucket in buckets if arm_bucket(bucket))
+    MaturityBucket.objects.filter(fired_at__lt=timezone.now() - timedelta(days=1)).delete()
+    return armed
+
+
+def fire_bucket(bucket_id):
+    """
+    Mature the investments of one bucket. Returns the matured ids, or None
+    if the bucket's minute has not ended yet, in which case a fresh tick is
+    queued for the end of the minute.
+    """
+    bucket = MaturityBucket.objects.filter(id=bucket_id, fired_at__isnull=True).first()
+    if bucket is None:
+        return []
+    end = bucket.bucket + BUCKET_WIDTH
+    if timezone.now() < end:
+        # Delivered early (clock skew between beat and workers)
+        queue_tick(bucket.id, end)
+        return None
+    matured_ids = mature_due_investments(
+        queryset=Investment.objects.filter(mature_at__gte=bucket.bucket, mature_at__lt=end)
+    )
+    # Left unfired if the bucket was re-armed meanwhile; that tick finishes it
+    MaturityBucket.objects.filter(id=bucket.id, armed_at=bucket.armed_at).update(fired_at=timezone.now())
+    return matured_ids
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-18 19:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_pairinglease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MaturityBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField(unique=True)),
+                ('armed_at', models.DateTimeField(blank=True, null=True)),
+                ('fired_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['armed_at', 'bucket'], name='accounts_ma_armed_a_49462c_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0009_maturitybucket'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='investment',
+            index=models.Index(fields=['created_at'], name='accounts_in_created_d28b2e_idx'),
+        ),
+    ]
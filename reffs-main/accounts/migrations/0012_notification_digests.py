@@ -0,0 +1,40 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:12
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0011_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='notification_delivery',
+            field=models.CharField(choices=[('immediate', 'Immediate'), ('digest', 'Digest')], default='digest', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='NotificationEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('pairing', 'Pairing'), ('referral_bonus', 'Referral Bonus'), ('payment_reminder', 'Payment Reminder')], max_length=20)),
+                ('payload', models.JSONField(default=dict)),
+                ('dedupe_key', models.CharField(max_length=64)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notification_events', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sent_at', 'user', 'created_at'], name='accounts_no_sent_at_5ab049_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='notificationevent',
+            constraint=models.UniqueConstraint(condition=models.Q(('sent_at__isnull', True)), fields=('user', 'dedupe_key'), name='unique_unsent_notification_event'),
+        ),
+    ]
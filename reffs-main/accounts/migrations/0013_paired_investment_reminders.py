@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0012_notification_digests'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pairedinvestment',
+            name='next_reminder_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pairedinvestment',
+            name='payment_due_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='pairedinvestment',
+            name='reminder_tier',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='pairedinvestment',
+            index=models.Index(fields=['next_reminder_at', 'id'], name='accounts_pa_next_re_1c561e_idx'),
+        ),
+    ]
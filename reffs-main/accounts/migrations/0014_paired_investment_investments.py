@@ -0,0 +1,67 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:19
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+import django.db.models.deletion
+
+
+def link_new_investments(apps, schema_editor):
+    """
+    Existing pairings only record the bidder's pairing_reference, which
+    identifies the new investment. The matured side cannot be recovered.
+    """
+    Investment = apps.get_model('accounts', 'Investment')
+    PairedInvestment = apps.get_model('accounts', 'PairedInvestment')
+    PairedInvestment.objects.filter(new_investment__isnull=True, pairing_reference__isnull=False).update(
+        new_investment=Subquery(
+            Investment.objects.filter(pairing_reference=OuterRef('pairing_reference')).values('id')[:1]
+        )
+    )
+
+
+
+def schedule_pending_payments(apps, schema_editor):
+    """
+    Give pairings still awaiting payment their deadline and first reminder
+    time. Pairings made before the matured investment was recorded get a
+    fresh payment window from now, so their payers are reminded before
+    they expire; expiry cannot release them until their matured investment
+    is resolved (see the release_legacy_pairing command).
+    """
+    PairedInvestment = apps.get_model('accounts', 'PairedInvestment')
+    window = timedelta(hours=getattr(settings, 'PAYMENT_WINDOW_HOURS', 24))
+    first = timedelta(hours=max(getattr(settings, 'PAYMENT_REMINDER_HOURS', [6, 1]) or [0]))
+    unscheduled = PairedInvestment.objects.filter(payment_status='pending', payment_due_at__isnull=True)
+    unscheduled.filter(matured_investment__isnull=False, new_investment__isnull=False).update(
+        payment_due_at=F('paired_at') + window,
+        next_reminder_at=F('paired_at') + (window - first),
+    )
+    start = Greatest(F('paired_at'), Value(timezone.now()))
+    unscheduled.update(payment_due_at=start + window, next_reminder_at=start + (window - first))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0013_paired_investment_reminders'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pairedinvestment',
+            name='matured_investment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payouts', to='accounts.investment'),
+        ),
+        migrations.AddField(
+            model_name='pairedinvestment',
+            name='new_investment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='payments_due', to='accounts.investment'),
+        ),
+        migrations.RunPython(link_new_investments, migrations.RunPython.noop),
+        migrations.RunPython(schedule_pending_payments, migrations.RunPython.noop),
+    ]
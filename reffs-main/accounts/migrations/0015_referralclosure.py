@@ -0,0 +1,31 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0014_paired_investment_investments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralClosure',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='downline_links', to=settings.AUTH_USER_MODEL)),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upline_links', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ancestor', 'depth'], name='accounts_re_ancesto_0c2273_idx'), models.Index(fields=['descendant', 'depth'], name='accounts_re_descend_992851_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='referralclosure',
+            constraint=models.UniqueConstraint(fields=('ancestor', 'descendant'), name='unique_referral_closure'),
+        ),
+    ]
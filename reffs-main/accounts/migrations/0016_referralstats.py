@@ -0,0 +1,46 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:26
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Q, Sum
+
+
+def fill_referral_stats(apps, schema_editor):
+    """Count every user's existing referrals and bonuses"""
+    User = apps.get_model('accounts', 'User')
+    ReferralHistory = apps.get_model('accounts', 'ReferralHistory')
+    ReferralStats = apps.get_model('accounts', 'ReferralStats')
+    stats = {user_id: ReferralStats(user_id=user_id) for user_id in User.objects.values_list('id', flat=True)}
+    for row in ReferralHistory.objects.values('referrer_id').order_by().annotate(
+        referrals=Count('id'),
+        total_earned=Sum('bonus_earned'),
+        available_bonus=Sum('bonus_earned', filter=Q(status='active', payment_confirmed=True)),
+    ):
+        stats[row['referrer_id']].referrals = row['referrals']
+        stats[row['referrer_id']].total_earned = row['total_earned'] or 0
+        stats[row['referrer_id']].available_bonus = row['available_bonus'] or 0
+    for row in User.objects.filter(referred_by__isnull=False).values('referred_by_id').order_by().annotate(n=Count('id')):
+        stats[row['referred_by_id']].referred_users = row['n']
+    ReferralStats.objects.bulk_create(stats.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0015_referralclosure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferralStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='referral_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('referred_users', models.PositiveIntegerField(default=0)),
+                ('referrals', models.PositiveIntegerField(default=0)),
+                ('total_earned', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('available_bonus', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+            ],
+        ),
+        migrations.RunPython(fill_referral_stats, migrations.RunPython.noop),
+    ]
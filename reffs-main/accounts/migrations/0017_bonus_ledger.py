@@ -0,0 +1,70 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:31
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+from django.db.models import Max, Sum
+
+
+def open_ledger(apps, schema_editor):
+    """Carry each user's referral_earnings over as an opening ledger entry and snapshot"""
+    User = apps.get_model('accounts', 'User')
+    BonusLedgerEntry = apps.get_model('accounts', 'BonusLedgerEntry')
+    BonusBalanceSnapshot = apps.get_model('accounts', 'BonusBalanceSnapshot')
+    balances = User.objects.exclude(referral_earnings=0).values_list('id', 'referral_earnings')
+    BonusLedgerEntry.objects.bulk_create([
+        BonusLedgerEntry(user_id=user_id, amount=amount, kind='opening_balance', reference='referral_earnings')
+        for user_id, amount in balances.iterator()
+    ], batch_size=500)
+    BonusBalanceSnapshot.objects.bulk_create([
+        BonusBalanceSnapshot(user_id=row['user_id'], balance=row['balance'], last_entry_id=row['last'])
+        for row in BonusLedgerEntry.objects.values('user_id').order_by()
+        .annotate(balance=Sum('amount'), last=Max('id'))
+    ], batch_size=500)
+
+
+def close_ledger(apps, schema_editor):
+    """Fold the ledger back into referral_earnings"""
+    User = apps.get_model('accounts', 'User')
+    BonusLedgerEntry = apps.get_model('accounts', 'BonusLedgerEntry')
+    for row in BonusLedgerEntry.objects.values('user_id').order_by().annotate(balance=Sum('amount')):
+        User.objects.filter(id=row['user_id']).update(referral_earnings=row['balance'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0016_referralstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BonusBalanceSnapshot',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='bonus_snapshot', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('balance', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('last_entry_id', models.BigIntegerField(db_index=True, default=0)),
+                ('taken_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BonusLedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('kind', models.CharField(choices=[('opening_balance', 'Opening Balance'), ('referral_bonus', 'Referral Bonus'), ('bonus_confirmed', 'Bonus Confirmed'), ('bonus_used', 'Bonus Used'), ('withdrawal', 'Withdrawal')], max_length=20)),
+                ('reference', models.CharField(blank=True, default='', max_length=64)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='bonus_ledger', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'id'], name='accounts_bo_user_id_417f1a_idx'), models.Index(fields=['created_at', 'id'], name='accounts_bo_created_e14d39_idx')],
+            },
+        ),
+        migrations.RunPython(open_ledger, close_ledger),
+        migrations.RemoveField(
+            model_name='user',
+            name='referral_earnings',
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0017_bonus_ledger'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='referralhistory',
+            index=models.Index(fields=['referrer', 'status', 'created_at', 'id'], name='accounts_re_referre_21254c_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.7 on 2026-10-18 20:52
+
+from django.db import migrations, models
+
+
+def mark_expired(apps, schema_editor):
+    """Pairings the payment sweep already expired (failed after a reminder tier)"""
+    PairedInvestment = apps.get_model('accounts', 'PairedInvestment')
+    PairedInvestment.objects.filter(payment_status='failed', reminder_tier__gt=0).update(status='expired')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0018_referral_history_fifo_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='pairedinvestment',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('confirmed', 'Confirmed'), ('completed', 'Completed'), ('expired', 'Expired')], default='pending', max_length=20),
+        ),
+        migrations.RunPython(mark_expired, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.7 on 2026-10-18 21:21
+
+from django.db import migrations, models
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def flag_folded_entries(apps, schema_editor):
+    """Entries up to each user's snapshot watermark are already in the snapshot"""
+    BonusLedgerEntry = apps.get_model('accounts', 'BonusLedgerEntry')
+    BonusBalanceSnapshot = apps.get_model('accounts', 'BonusBalanceSnapshot')
+    BonusLedgerEntry.objects.filter(
+        id__lte=Subquery(BonusBalanceSnapshot.objects.filter(user_id=OuterRef('user_id')).values('last_entry_id'))
+    ).update(snapshotted=True)
+
+
+def restore_watermarks(apps, schema_editor):
+    BonusLedgerEntry = apps.get_model('accounts', 'BonusLedgerEntry')
+    BonusBalanceSnapshot = apps.get_model('accounts', 'BonusBalanceSnapshot')
+    BonusBalanceSnapshot.objects.update(last_entry_id=Coalesce(Subquery(
+        BonusLedgerEntry.objects.filter(user_id=OuterRef('user_id'), snapshotted=True)
+        .values('user_id').order_by().annotate(last=Max('id')).values('last')
+    ), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0019_paired_investment_expired_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bonusledgerentry',
+            name='snapshotted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(flag_folded_entries, restore_watermarks),
+        migrations.RemoveIndex(
+            model_name='bonusledgerentry',
+            name='accounts_bo_created_e14d39_idx',
+        ),
+        migrations.RemoveField(
+            model_name='bonusbalancesnapshot',
+            name='last_entry_id',
+        ),
+        migrations.AddIndex(
+            model_name='bonusledgerentry',
+            index=models.Index(condition=models.Q(('snapshotted', False)), fields=['user', 'id'], name='bonus_ledger_unfolded'),
+        ),
+    ]
@@ -1,37 +1,51 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 from decimal import Decimal
 import uuid
 from datetime import timedelta
-import random
-import string
+
+from accounts import referral_codes
 
 class User(AbstractUser):
     phone_number = models.CharField(max_length=15, unique=True)
     referral_code = models.CharField(max_length=10, unique=True, null=True, blank=True)
     referred_by = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='referrals')
-    referral_earnings = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     is_banned = models.BooleanField(default=False)
     ban_reason = models.TextField(null=True, blank=True)
     banned_at = models.DateTimeField(null=True, blank=True)
     country = models.CharField(max_length=100, null=True, blank=True)
+    NOTIFICATION_DELIVERY_CHOICES = [
+        ('immediate', 'Immediate'),
+        ('digest', 'Digest'),
+    ]
+    notification_delivery = models.CharField(max_length=10, choices=NOTIFICATION_DELIVERY_CHOICES, default='digest')
 
     USERNAME_FIELD = 'phone_number'
     REQUIRED_FIELDS = ['username', 'email']
 
     def save(self, *args, **kwargs):
-        if not self.referral_code:
+        if self.referral_code:
+            super().save(*args, **kwargs)
+            return
+        # Derived from the id (accounts.referral_codes), so it needs the row
+        # first; one transaction, so no user is ever stored without a code
+        with transaction.atomic():
+            super().save(*args, **kwargs)
             self.referral_code = self.generate_referral_code()
-        super().save(*args, **kwargs)
+            User.objects.filter(pk=self.pk).update(referral_code=self.referral_code)
 
     def generate_referral_code(self):
-        while True:
-            code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-            if not User.objects.filter(referral_code=code).exists():
-                return code
+        return referral_codes.code_for(self.pk)
+
+    @property
+    def referral_earnings(self):
+        """Referral bonus balance, from the bonus ledger (accounts.ledger)"""
+        from accounts import ledger
+
+        return ledger.balance(self.id)
 
     def __str__(self):
         return self.username
@@ -75,6 +89,7 @@ class Investment(models.Model):
         indexes = [
             models.Index(fields=['status', 'is_confirmed', 'mature_at']),
             models.Index(fields=['confirmed_at']),
+            models.Index(fields=['created_at']),
         ]
 
     def __str__(self):
@@ -92,6 +107,12 @@ class Investment(models.Model):
         self.start_countdown_at = timezone.now()
         self.save()
 
+        from accounts.maturity import schedule_maturity
+        schedule_maturity(self.mature_at)
+
+        from accounts.forecast import mark_day_dirty
+        mark_day_dirty(timezone.localdate(self.mature_at))
+
     def check_maturity(self):
         """Check if the investment has reached maturity"""
         if (self.is_confirmed and 
@@ -99,8 +120,10 @@ class Investment(models.Model):
             self.mature_at and 
             timezone.now() >= self.mature_at):
             self.status = 'matured'
-            self.matured_at = timezone.now()  # Set the matured_at field when investment matures
             self.save()
+
+            from accounts.pairing import schedule_pairing
+            schedule_pairing(matured_ids=[self.id])
             return True
         return False
 
@@ -145,7 +168,7 @@ class Investment(models.Model):
         paired_investments = PairedInvestment.objects.filter(
             new_investor=self.user,
             pairing_reference=self.pairing_reference
-        )
+        ).exclude(status='expired')
         
         # Check if all paired investments are confirmed
         all_confirmed = paired_investments.exists() and all(
@@ -182,6 +205,91 @@ class Pairing(models.Model):
             self.payment_due_date = self.paired_at + timedelta(hours=24)
         super().save(*args, **kwargs)
 
+class PairingLease(models.Model):
+    """
+    DB-backed lease that keeps pairing runs which must not overlap apart
+    """
+    name = models.CharField(max_length=50, unique=True)
+    owner = models.CharField(max_length=100, blank=True)
+    acquired_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Pairing lease {self.name} held by {self.owner or 'nobody'} until {self.expires_at}"
+
+class MaturityBucket(models.Model):
+    """
+    One slot of the maturity timer wheel: the investments whose mature_at
+    falls in the minute starting at ``bucket`` mature together when it fires
+    """
+    bucket = models.DateTimeField(unique=True)
+    armed_at = models.DateTimeField(null=True, blank=True)
+    fired_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['armed_at', 'bucket']),
+        ]
+
+    def __str__(self):
+        return f"Maturity bucket {self.bucket} ({'fired' if self.fired_at else 'armed' if self.armed_at else 'waiting'})"
+
+class OutboxMessage(models.Model):
+    """
+    A task call recorded in the same transaction as the change that caused
+    it, and dispatched by the outbox drainer (accounts.outbox) after commit
+    """
+    task = models.CharField(max_length=200)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    dedupe_key = models.CharField(max_length=64)
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sent_at', 'available_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f"Outbox {self.task} ({'sent' if self.sent_at else f'{self.attempts} attempts'})"
+
+class NotificationEvent(models.Model):
+    """
+    A notification waiting in a user's digest (accounts.digests). Identical
+    unsent events share a dedupe_key and are stored once.
+    """
+    KIND_CHOICES = [
+        ('pairing', 'Pairing'),
+        ('referral_bonus', 'Referral Bonus'),
+        ('payment_reminder', 'Payment Reminder'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notification_events')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    payload = models.JSONField(default=dict)
+    dedupe_key = models.CharField(max_length=64)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'dedupe_key'],
+                condition=models.Q(sent_at__isnull=True),
+                name='unique_unsent_notification_event',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['sent_at', 'user', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} for {self.user_id} ({'sent' if self.sent_at else 'buffered'})"
+
 class Referral(models.Model):
     referrer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='referrals_created')
     referral_code = models.CharField(max_length=20, unique=True)
@@ -191,6 +299,28 @@ class Referral(models.Model):
     def __str__(self):
         return f"Referral Code: {self.referral_code} by {self.referrer.username}"
 
+class ReferralClosure(models.Model):
+    """
+    Transitive closure of User.referred_by: one row per (ancestor,
+    descendant) pair, ``depth`` levels apart. Every user has a depth 0 row
+    for themselves. Maintained by accounts.referrals.
+    """
+    ancestor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='downline_links')
+    descendant = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upline_links')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_referral_closure'),
+        ]
+        indexes = [
+            models.Index(fields=['ancestor', 'depth']),
+            models.Index(fields=['descendant', 'depth']),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} -> {self.descendant_id} ({self.depth})"
+
 class ReferralHistory(models.Model):
     referrer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='referral_history')
     referred = models.ForeignKey(User, on_delete=models.CASCADE, related_name='referred_by_history')
@@ -204,37 +334,111 @@ class ReferralHistory(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Withdrawals use up a referrer's pending bonuses in this order
+            models.Index(fields=['referrer', 'status', 'created_at', 'id']),
+        ]
 
     def __str__(self):
         return f"{self.referrer.username} -> {self.referred.username}: ${self.bonus_earned}"
 
+class ReferralStats(models.Model):
+    """
+    Per-user referral counters, so the dashboard and referral list do not
+    aggregate ReferralHistory on every poll. Kept in step with F()
+    increments by accounts.referral_stats; reconcile_referral_stats
+    rebuilds them.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='referral_stats')
+    referred_users = models.PositiveIntegerField(default=0)
+    referrals = models.PositiveIntegerField(default=0)
+    total_earned = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    available_bonus = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"Referral stats for {self.user_id}"
+
+class BonusLedgerEntry(models.Model):
+    """
+    One credit (positive amount) or debit (negative amount) of a user's
+    referral bonus balance. Rows are only ever inserted, then flagged
+    ``snapshotted`` once folded into the user's snapshot; see accounts.ledger.
+    """
+    KIND_CHOICES = [
+        ('opening_balance', 'Opening Balance'),
+        ('referral_bonus', 'Referral Bonus'),
+        ('bonus_confirmed', 'Bonus Confirmed'),
+        ('bonus_used', 'Bonus Used'),
+        ('withdrawal', 'Withdrawal'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='bonus_ledger')
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    reference = models.CharField(max_length=64, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    snapshotted = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'id']),
+            models.Index(fields=['user', 'id'], name='bonus_ledger_unfolded', condition=models.Q(snapshotted=False)),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.amount} for {self.user_id}"
+
+class BonusBalanceSnapshot(models.Model):
+    """A user's bonus balance over the ledger entries flagged snapshotted"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='bonus_snapshot')
+    balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    taken_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Bonus balance of {self.user_id} as of {self.taken_at}"
+
 class PairedInvestment(models.Model):
     matured_investor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='matured_pairings')
     new_investor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='new_pairings')
     amount_paired = models.DecimalField(max_digits=10, decimal_places=2)
     is_confirmed = models.BooleanField(default=False)
     paired_at = models.DateTimeField(auto_now_add=True)
-    status = models.CharField(max_length=20, choices=[('pending', 'Pending'), ('confirmed', 'Confirmed'), ('completed', 'Completed')], default='pending')
+    # 'expired' pairings were not paid in time; their amount went back to both sides
+    status = models.CharField(max_length=20, choices=[('pending', 'Pending'), ('confirmed', 'Confirmed'), ('completed', 'Completed'), ('expired', 'Expired')], default='pending')
     payment_status = models.CharField(max_length=20, choices=[
         ('pending', 'Pending'),
         ('paid', 'Paid'),
         ('failed', 'Failed')
     ], default='pending')
     pairing_reference = models.CharField(max_length=50, null=True, blank=True)
-     
+    # The investments the amount moves between, released back to the book on expiry
+    matured_investment = models.ForeignKey(Investment, on_delete=models.SET_NULL, null=True, blank=True,
+                                           related_name='payouts')
+    new_investment = models.ForeignKey(Investment, on_delete=models.SET_NULL, null=True, blank=True,
+                                       related_name='payments_due')
+    payment_due_at = models.DateTimeField(null=True, blank=True)
+    # When the payment sweeper (accounts.reminders) next acts on this pairing
+    next_reminder_at = models.DateTimeField(null=True, blank=True)
+    reminder_tier = models.PositiveSmallIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_reminder_at', 'id']),
+        ]
+
     def __str__(self):
         return f"Paired Investment: {self.matured_investor.username} -> {self.new_investor.username}"
-    
+
     def confirm(self):
         """Confirm the payment and check if this is the last confirmation needed"""
         self.status = 'confirmed'
         self.confirmed_at = timezone.now()
         self.save()
         
-        # Get all paired investments with the same reference
+        # Get all paired investments with the same reference, except expired ones
         paired_investments = PairedInvestment.objects.filter(
             pairing_reference=self.pairing_reference
-        )
+        ).exclude(status='expired')
         
         # Check if all paired investments are now confirmed
         all_confirmed = all(pi.status == 'confirmed' for pi in paired_investments)
@@ -252,6 +456,9 @@ class PairedInvestment(models.Model):
     def save(self, *args, **kwargs):
         if not self.paired_at:
             self.paired_at = timezone.now()
+        if self.payment_status != 'pending':
+            # Settled pairings leave the reminder sweep
+            self.next_reminder_at = None
         super().save(*args, **kwargs)
 
 class Payment(models.Model):
@@ -0,0 +1,277 @@
+"""
+Concurrent notification dispatch over pluggable channels.
+
+A Notification names a channel ('email', 'sms', ...), a recipient and the
+rendered content. dispatch() sends a list of them from one asyncio event
+loop: at most NOTIFICATION_CONCURRENCY are in flight at once, and each
+provider is held to its NOTIFICATION_RATE_LIMITS messages per second by a
+token bucket. Blocking provider calls (SMTP, HTTP) run in worker threads,
+so a slow round-trip no longer holds up the messages behind it.
+
+Channels are configured in NOTIFICATION_CHANNELS as dotted class paths.
+EmailChannel sends through Django's email backend over pooled
+connections, SmsChannel through the Africa's Talking SMS API for Kenyan
+numbers, and LocalChannel keeps messages in memory for tests.
+
+Every dispatch reports, per channel, how many messages were sent and
+failed, the throughput and the send latency percentiles.
+"""
+import asyncio
+import json
+import logging
+import re
+import time
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from accounts.mailing import ConnectionPool, html_email, text_email
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHANNELS = {
+    'email': 'accounts.notify.EmailChannel',
+    'sms': 'accounts.notify.SmsChannel',
+}
+
+KENYAN_MOBILE = re.compile(r'^(?:\+?254|0)?([17]\d{8})$')
+
+
+def kenyan_msisdn(phone_number):
+    """``phone_number`` in +2547XXXXXXXX form, or None if it is not a Kenyan mobile number"""
+    match = KENYAN_MOBILE.match(re.sub(r'[\s-]', '', phone_number or ''))
+    return f'+254{match.group(1)}' if match else None
+
+
+class Notification:
+    __slots__ = ('channel', 'recipient', 'body', 'subject', 'html')
+
+    def __init__(self, channel, recipient, body='', subject='', html=None):
+        self.channel = channel
+        self.recipient = recipient
+        self.body = body
+        self.subject = subject
+        self.html = html
+
+    def __repr__(self):
+        return f'Notification({self.channel} to {self.recipient})'
+
+
+class Channel:
+    """
+    A delivery channel. ``send`` is a coroutine that raises on failure;
+    ``provider`` names the rate limit the channel draws from.
+    """
+    name = None
+    provider = None
+
+    @property
+    def enabled(self):
+        return True
+
+    async def send(self, notification):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class EmailChannel(Channel):
+    name = 'email'
+    provider = 'smtp'
+
+    def __init__(self):
+        self.pool = ConnectionPool()
+
+    async def send(self, notification):
+        if notification.html is not None:
+            message = html_email(notification.subject, notification.html, notification.recipient)
+        else:
+            message = text_email(notification.subject, notification.body, notification.recipient)
+        await asyncio.to_thread(self.pool.send, message)
+
+    def close(self):
+        self.pool.close()
+
+
+class SmsChannel(Channel):
+    """Africa's Talking bulk SMS API; Kenyan mobile numbers only"""
+    name = 'sms'
+    provider = 'africastalking'
+
+    @property
+    def enabled(self):
+        return bool(getattr(settings, 'SMS_API_KEY', ''))
+
+    async def send(self, notification):
+        msisdn = kenyan_msisdn(notification.recipient)
+        if msisdn is None:
+            raise ValueError(f"{notification.recipient} is not a Kenyan mobile number")
+        await asyncio.to_thread(self._post, msisdn, notification.body)
+
+    def _post(self, msisdn, text):
+        data = {'username': settings.SMS_USERNAME, 'to': msisdn, 'message': text}
+        if getattr(settings, 'SMS_SENDER_ID', ''):
+            data['from'] = settings.SMS_SENDER_ID
+        request = Request(
+            getattr(settings, 'SMS_API_URL', 'https://api.africastalking.com/version1/messaging'),
+            data=urlencode(data).encode(),
+            headers={'apiKey': settings.SMS_API_KEY, 'Accept': 'application/json'},
+        )
+        with urlopen(request, timeout=getattr(settings, 'SMS_TIMEOUT', 10)) as response:
+            recipients = json.load(response)['SMSMessageData']['Recipients']
+        if not recipients or recipients[0].get('status') != 'Success':
+            raise RuntimeError(f"SMS to {msisdn} rejected: {recipients}")
+
+
+class LocalChannel(Channel):
+    """
+    Keeps sent notifications in ``LocalChannel.sent`` (like the locmem email
+    backend). ``latency`` simulates a provider round-trip, in seconds.
+    """
+    sent = []
+
+    def __init__(self, name=None, latency=0.0):
+        self.name = self.provider = name
+        self.latency = latency
+
+    async def send(self, notification):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        LocalChannel.sent.append(notification)
+
+
+def get_channels():
+    """Instantiate the configured channels, keyed by name"""
+    channels = {}
+    for name, path in getattr(settings, 'NOTIFICATION_CHANNELS', DEFAULT_CHANNELS).items():
+        channel = import_string(path)()
+        channel.name = name
+        channel.provider = channel.provider or name
+        channels[name] = channel
+    return channels
+
+
+class RateLimiter:
+    """Token bucket allowing ``rate`` acquisitions per second, in bursts of up to ``rate``"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ChannelStats:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.latencies = []
+        self.started = None
+        self.finished = None
+
+    def record(self, started, finished, ok):
+        self.started = started if self.started is None else min(self.started, started)
+        self.finished = finished if self.finished is None else max(self.finished, finished)
+        self.latencies.append(finished - started)
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        elapsed = (self.finished - self.started) if latencies else 0
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1) if latencies else 0
+
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'latency_p50_ms': percentile(0.5),
+            'latency_p95_ms': percentile(0.95),
+            'latency_max_ms': round(latencies[-1] * 1000, 1) if latencies else 0,
+        }
+
+
+class Dispatcher:
+    def __init__(self, channels=None, concurrency=None, rate_limits=None):
+        self.channels = channels if channels is not None else get_channels()
+        self.concurrency = concurrency or getattr(settings, 'NOTIFICATION_CONCURRENCY', 20)
+        self.rate_limits = rate_limits if rate_limits is not None else getattr(settings, 'NOTIFICATION_RATE_LIMITS', {})
+
+    async def _send(self, notification, semaphore, limiters, stats):
+        channel = self.channels.get(notification.channel)
+        if channel is None:
+            logger.error(f"No notification channel '{notification.channel}' for {notification.recipient}")
+            return False
+        async with semaphore:
+            limiter = limiters.get(channel.provider)
+            if limiter is not None:
+                await limiter.acquire()
+            started = time.perf_counter()
+            try:
+                await channel.send(notification)
+                ok = True
+            except Exception as e:
+                logger.error(f"Failed to send {channel.name} notification to {notification.recipient}: {str(e)}")
+                ok = False
+            stats.setdefault(channel.name, ChannelStats()).record(started, time.perf_counter(), ok)
+            return ok
+
+    async def _run(self, notifications):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        limiters = {
+            channel.provider: RateLimiter(self.rate_limits[channel.provider])
+            for channel in self.channels.values() if self.rate_limits.get(channel.provider)
+        }
+        stats = {}
+        results = await asyncio.gather(*(
+            self._send(notification, semaphore, limiters, stats) for notification in notifications
+        ))
+        return list(results), {name: channel_stats.report() for name, channel_stats in stats.items()}
+
+    def dispatch(self, notifications):
+        """
+        Send ``notifications`` concurrently and return (results, report):
+        a list of booleans telling which were sent, in order, and the
+        per-channel statistics.
+        """
+        if not notifications:
+            return [], {}
+        try:
+            results, report = asyncio.run(self._run(notifications))
+        finally:
+            for channel in self.channels.values():
+                channel.close()
+        for name, stats in report.items():
+            logger.info(
+                f"Notification channel {name}: {stats['sent']} sent, {stats['failed']} failed, "
+                f"{stats['per_second']}/s, p50 {stats['latency_p50_ms']}ms, p95 {stats['latency_p95_ms']}ms"
+            )
+        return results, report
+
+
+def dispatch(notifications):
+    """Send ``notifications`` over the configured channels; see Dispatcher.dispatch"""
+    return Dispatcher().dispatch(notifications)
+
+
+def sms_enabled():
+    channel = get_channels().get('sms')
+    return channel is not None and channel.enabled
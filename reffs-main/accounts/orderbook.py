@@ -0,0 +1,498 @@
+"""
+Resident order book for pairing.
+
+With settings.PAIRING_ENGINE = 'resident', matching moves out of the Celery
+tasks into one long-lived process (manage.py run_order_book). It keeps the
+open book, meaning matured payout remainders and pending bid remainders, in
+compact arrays. Investment events (bid created, investment matured, pairing
+released) arrive as investment ids on a Redis list. Pairings are written
+back to the database in batches through the same PairingPlan/write_plan
+path the Celery engine uses, so matching cost depends on the size of the
+open book, not of the Investment table.
+
+Every change to the book is appended to a write-ahead log before it is
+applied. Periodic snapshots bound the log, and a restart loads the latest
+snapshot and replays the log instead of rereading the book from the
+database.
+"""
+import json
+import logging
+import os
+import time
+from array import array
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+
+from accounts.matching import get_policy
+from accounts.models import Investment
+from accounts.pairing import (
+    MATURED_FIELDS, PENDING_FIELDS, PairingBook, PairingPlan, acquire_lease, lease_owner,
+    log_throughput, release_lease, to_cents, write_plan
+)
+
+logger = logging.getLogger(__name__)
+
+RESIDENT_LEASE = 'pairing-resident'
+EVENT_QUEUE_KEY = 'pairing:book-events'
+SNAPSHOT_FILE = 'book.npz'
+# Bumped when the snapshot layout changes; older snapshots are discarded
+# and the book is reread from the database. 2: mature_at in microseconds.
+SNAPSHOT_VERSION = 2
+WAL_FILE = 'book.wal'
+
+BOOK_FIELDS = tuple(sorted(set(MATURED_FIELDS) | set(PENDING_FIELDS)))
+SIDES = ('matured', 'pending')
+
+
+def _micros(value):
+    return int(value.timestamp() * 1000000) if value else 0
+
+
+class _Side:
+    """One side of the book: parallel int64 arrays plus an id -> slot index"""
+
+    def __init__(self):
+        self.ids = array('q')
+        self.users = array('q')
+        self.cents = array('q')
+        self.created = array('q')
+        self.mature_at = array('q')
+        self.index = {}
+        self.unsorted = False
+
+    def __len__(self):
+        return len(self.index)
+
+    def upsert(self, pk, user, cents, created, mature_at=0):
+        slot = self.index.get(pk)
+        if slot is not None:
+            self.cents[slot] = cents
+            return
+        if self.ids and (created, pk) < (self.created[-1], self.ids[-1]):
+            self.unsorted = True
+        self.index[pk] = len(self.ids)
+        self.ids.append(pk)
+        self.users.append(user)
+        self.cents.append(cents)
+        self.created.append(created)
+        self.mature_at.append(mature_at)
+
+    def remove(self, pk):
+        slot = self.index.pop(pk, None)
+        if slot is not None:
+            self.cents[slot] = 0
+
+    def take(self, pk, cents):
+        slot = self.index[pk]
+        self.cents[slot] -= cents
+        if self.cents[slot] <= 0:
+            self.remove(pk)
+
+    def open_cents(self, pk):
+        slot = self.index.get(pk)
+        return None if slot is None else self.cents[slot]
+
+    def compact(self):
+        """Drop emptied slots and restore (created, id) order"""
+        keep = np.flatnonzero(np.frombuffer(self.cents, dtype=np.int64) > 0) if self.cents else np.zeros(0, np.int64)
+        if self.unsorted and len(keep):
+            created = np.frombuffer(self.created, dtype=np.int64)[keep]
+            ids = np.frombuffer(self.ids, dtype=np.int64)[keep]
+            keep = keep[np.lexsort((ids, created))]
+        self.load({name: np.frombuffer(getattr(self, name), dtype=np.int64)[keep]
+                   for name in ('ids', 'users', 'cents', 'created', 'mature_at')})
+
+    def arrays(self):
+        return {name: np.frombuffer(getattr(self, name), dtype=np.int64) if len(getattr(self, name))
+                else np.zeros(0, np.int64) for name in ('ids', 'users', 'cents', 'created', 'mature_at')}
+
+    def load(self, arrays):
+        for name, values in arrays.items():
+            setattr(self, name, array('q', np.asarray(values, dtype=np.int64).tobytes()))
+        self.index = {pk: slot for slot, pk in enumerate(self.ids) if self.cents[slot] > 0}
+        self.unsorted = False
+
+
+class ResidentBook:
+    """
+    The open order book held in memory. It exposes the same attributes as
+    PairingBook (matured_cents, pending_users, ...), so every matching
+    policy runs on it unchanged. Slots emptied by matching are left in
+    place with zero cents, which policies skip, until compact() runs.
+    """
+
+    def __init__(self):
+        self.matured = _Side()
+        self.pending = _Side()
+        self.seq = 0
+
+    def side(self, name):
+        return self.matured if name == 'matured' else self.pending
+
+    @property
+    def matured_cents(self):
+        return self.matured.cents
+
+    @property
+    def matured_users(self):
+        return self.matured.users
+
+    @property
+    def pending_cents(self):
+        return self.pending.cents
+
+    @property
+    def pending_users(self):
+        return self.pending.users
+
+    @property
+    def pending_waited(self):
+        now = time.time() * 1000000
+        return [(now - created) / 1000000 for created in self.pending.created]
+
+    @property
+    def matured_mature_at(self):
+        return [value or None for value in self.matured.mature_at]
+
+    def apply(self, record):
+        """Apply one write-ahead log record (upsert, remove or committed allocations)"""
+        op = record['op']
+        if op == 'upsert':
+            other = 'pending' if record['side'] == 'matured' else 'matured'
+            self.side(other).remove(record['id'])
+            if record['cents'] > 0:
+                self.side(record['side']).upsert(record['id'], record['user'], record['cents'],
+                                                 record['created'], record.get('mature_at', 0))
+            else:
+                self.side(record['side']).remove(record['id'])
+        elif op == 'remove':
+            self.matured.remove(record['id'])
+            self.pending.remove(record['id'])
+        elif op == 'commit':
+            for matured_id, pending_id, cents in record['allocations']:
+                self.matured.take(matured_id, cents)
+                self.pending.take(pending_id, cents)
+        if 'seq' in record:
+            self.seq = max(self.seq, record['seq'])
+
+    def match(self, policy):
+        """
+        Run a policy over the open book and return its allocations as
+        (matured_id, pending_id, cents) without applying them.
+        """
+        if any(side.unsorted or len(side.ids) > 2 * len(side) + 1000 for side in (self.matured, self.pending)):
+            self.compact()
+        allocations = policy.allocate(self)
+        matured_ids, pending_ids = self.matured.ids, self.pending.ids
+        return [(matured_ids[mi], pending_ids[ni], int(cents)) for mi, ni, cents in allocations]
+
+    def compact(self):
+        self.matured.compact()
+        self.pending.compact()
+
+    def save(self, path):
+        """Write an atomic snapshot of the compacted book"""
+        self.compact()
+        arrays = {'seq': np.array([self.seq], dtype=np.int64),
+                  'version': np.array([SNAPSHOT_VERSION], dtype=np.int64)}
+        for name in SIDES:
+            for field, values in self.side(name).arrays().items():
+                arrays[f'{name}_{field}'] = values
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        """The snapshot at ``path``, or None if it was written in an older layout"""
+        book = cls()
+        with np.load(path, allow_pickle=False) as data:
+            if 'version' not in data or int(data['version'][0]) != SNAPSHOT_VERSION:
+                return None
+            book.seq = int(data['seq'][0])
+            for name in SIDES:
+                book.side(name).load({
+                    field: data[f'{name}_{field}']
+                    for field in ('ids', 'users', 'cents', 'created', 'mature_at')
+                })
+        return book
+
+
+def row_record(investment):
+    """Write-ahead log record giving an investment's current place in the book"""
+    if investment.status == 'matured':
+        return {'op': 'upsert', 'side': 'matured', 'id': investment.id, 'user': investment.user_id,
+                'cents': to_cents(PairingBook.matured_open_amount(investment)),
+                'created': _micros(investment.created_at),
+                'mature_at': _micros(investment.mature_at)}
+    if investment.status == 'pending':
+        return {'op': 'upsert', 'side': 'pending', 'id': investment.id, 'user': investment.user_id,
+                'cents': to_cents(PairingBook.pending_open_amount(investment)),
+                'created': _micros(investment.created_at)}
+    return {'op': 'remove', 'id': investment.id}
+
+
+class WriteAheadLog:
+    """Append-only JSON-lines log of book changes since the last snapshot"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+
+    def append(self, records):
+        for record in records:
+            self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def truncate(self):
+        self.file.close()
+        self.file = open(self.path, 'w')
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(path):
+        if not os.path.exists(path):
+            return []
+        records = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # A torn final line from a crash mid-write
+                    break
+        return records
+
+
+class BookEventQueue:
+    """Redis list carrying the ids of investments whose book entry changed"""
+
+    def __init__(self, url=None, key=EVENT_QUEUE_KEY):
+        import redis
+
+        self.client = redis.Redis.from_url(
+            url or getattr(settings, 'PAIRING_EVENT_BROKER_URL', None) or settings.CELERY_BROKER_URL
+        )
+        self.key = key
+
+    def push(self, investment_ids):
+        if investment_ids:
+            self.client.rpush(self.key, *investment_ids)
+
+    def pop(self, count, timeout=1):
+        """
+        Take up to ``count`` ids, first blocking up to ``timeout`` seconds
+        for one to arrive (no blocking with a zero timeout).
+        """
+        head = []
+        if timeout:
+            first = self.client.blpop(self.key, timeout=timeout)
+            if first is None:
+                return []
+            head, count = [int(first[1])], count - 1
+        pipe = self.client.pipeline()
+        pipe.lrange(self.key, 0, count - 1)
+        pipe.ltrim(self.key, count, -1)
+        rest = pipe.execute()[0] if count > 0 else []
+        return head + [int(value) for value in rest]
+
+
+def publish_book_events(investment_ids):
+    """Hand changed investments to the resident order book"""
+    try:
+        BookEventQueue().push(list(investment_ids))
+    except Exception as e:
+        # run_order_book resyncs from the database periodically
+        logger.error(f"Failed to publish order book events: {str(e)}")
+
+
+class OrderBookService:
+    """
+    The resident matching loop: apply events, match, write the pairs, and
+    snapshot now and then. One instance runs at a time, guarded by
+    RESIDENT_LEASE.
+    """
+
+    def __init__(self, data_dir, policy=None, snapshot_every=10000, queue=None):
+        os.makedirs(data_dir, exist_ok=True)
+        self.snapshot_path = os.path.join(data_dir, SNAPSHOT_FILE)
+        self.wal_path = os.path.join(data_dir, WAL_FILE)
+        self.policy = get_policy(policy or getattr(settings, 'PAIRING_POLICY', None))
+        self.snapshot_every = snapshot_every
+        self.queue = queue
+        self.owner = lease_owner()
+        self.book = None
+        self.wal = None
+        self.since_snapshot = 0
+
+    def start(self):
+        """Rebuild the book from snapshot + log, or from the database on a cold start"""
+        started = time.perf_counter()
+        if os.path.exists(self.snapshot_path):
+            self.book = ResidentBook.load(self.snapshot_path)
+        if self.book is not None:
+            in_doubt = self._replay(WriteAheadLog.read(self.wal_path))
+            self.wal = WriteAheadLog(self.wal_path)
+            if in_doubt:
+                self.refresh(in_doubt)
+            source = 'snapshot'
+        else:
+            self.wal = WriteAheadLog(self.wal_path)
+            self.resync()
+            source = 'database'
+        logger.info(
+            f"Order book loaded from {source} in {(time.perf_counter() - started) * 1000:.0f}ms: "
+            f"{len(self.book.matured)} matured, {len(self.book.pending)} pending"
+        )
+        return self.book
+
+    def _replay(self, records):
+        """
+        Re-apply the log written after the snapshot. Allocations count only
+        once their commit record is there; an uncommitted batch at the end
+        of the log is returned so its rows can be reread from the database.
+        """
+        in_doubt = None
+        for record in records:
+            if record.get('seq', 0) <= self.book.seq:
+                continue
+            if record['op'] == 'match':
+                in_doubt = record
+                continue
+            if record['op'] == 'abort':
+                in_doubt = None
+            elif record['op'] == 'commit':
+                in_doubt = None
+            self.book.apply(record)
+        if in_doubt is None:
+            return []
+        return sorted({pk for allocation in in_doubt['allocations'] for pk in allocation[:2]})
+
+    def log(self, records):
+        for record in records:
+            self.book.seq += 1
+            record['seq'] = self.book.seq
+        self.wal.append(records)
+        for record in records:
+            self.book.apply(record)
+        self.since_snapshot += len(records)
+
+    def refresh(self, investment_ids):
+        """Reread investments from the database and log their current book entries"""
+        rows = Investment.objects.filter(id__in=investment_ids).only(*BOOK_FIELDS)
+        found = {investment.id: investment for investment in rows}
+        self.log([
+            row_record(found[pk]) if pk in found else {'op': 'remove', 'id': pk}
+            for pk in investment_ids
+        ])
+
+    def resync(self):
+        """Replace the book with the database's open book and snapshot it"""
+        book = ResidentBook()
+        book.seq = self.book.seq if self.book else 0
+        for investment in Investment.objects.filter(status__in=SIDES).only(*BOOK_FIELDS).order_by('created_at', 'id'):
+            book.apply(row_record(investment))
+        self.book = book
+        self.snapshot()
+
+    def snapshot(self):
+        self.book.save(self.snapshot_path)
+        self.wal.truncate()
+        self.since_snapshot = 0
+
+    def pair(self):
+        """Match the open book and write the result; returns the written plan or None"""
+        started = time.perf_counter()
+        allocations = self.book.match(self.policy)
+        match_seconds = time.perf_counter() - started
+        if not allocations:
+            return None
+
+        self.log([{'op': 'match', 'allocations': allocations}])
+        match_seq = self.book.seq
+        plan = self.write(allocations, match_seconds)
+        if plan is None:
+            ids = sorted({pk for allocation in allocations for pk in allocation[:2]})
+            self.log([{'op': 'abort', 'match': match_seq}])
+            self.refresh(ids)
+            return None
+        self.log([{'op': 'commit', 'match': match_seq, 'allocations': allocations}])
+        log_throughput([plan])
+        return plan
+
+    def write(self, allocations, match_seconds=0.0):
+        """
+        Write allocations through PairingPlan under row locks. If any row no
+        longer matches the resident book (paired or edited elsewhere),
+        nothing is written and None is returned.
+        """
+        matured_ids = list(dict.fromkeys(matured_id for matured_id, _, _ in allocations))
+        pending_ids = list(dict.fromkeys(pending_id for _, pending_id, _ in allocations))
+        with transaction.atomic():
+            rows = {
+                investment.id: investment
+                for investment in Investment.objects.select_for_update().filter(
+                    id__in=matured_ids + pending_ids
+                ).only(*BOOK_FIELDS)
+            }
+            for pk, side in [(pk, 'matured') for pk in matured_ids] + [(pk, 'pending') for pk in pending_ids]:
+                record = row_record(rows[pk]) if pk in rows else None
+                if (record is None or record.get('side') != side
+                        or record['cents'] != self.book.side(side).open_cents(pk)):
+                    logger.warning(f"Investment {pk} changed outside the order book; rematching")
+                    return None
+            book = PairingBook([rows[pk] for pk in matured_ids], [rows[pk] for pk in pending_ids])
+            matured_slot = {pk: slot for slot, pk in enumerate(matured_ids)}
+            pending_slot = {pk: slot for slot, pk in enumerate(pending_ids)}
+            plan = PairingPlan(book, [
+                (matured_slot[matured_id], pending_slot[pending_id], cents)
+                for matured_id, pending_id, cents in allocations
+            ], self.policy.name, match_seconds)
+            write_plan(plan)
+        return plan
+
+    def handle(self, investment_ids):
+        """Process one batch of events: update the book, pair, maybe snapshot"""
+        if investment_ids:
+            self.refresh(list(dict.fromkeys(investment_ids)))
+        plan = self.pair()
+        if self.since_snapshot >= self.snapshot_every:
+            self.snapshot()
+        return plan
+
+    def run(self, batch_size=500, resync_seconds=900, once=False):
+        if self.queue is None:
+            self.queue = BookEventQueue()
+        if not acquire_lease(RESIDENT_LEASE, self.owner):
+            raise RuntimeError('Another order book service holds the lease')
+        started = False
+        try:
+            self.start()
+            started = True
+            self.pair()
+            last_resync = time.monotonic()
+            while True:
+                if not acquire_lease(RESIDENT_LEASE, self.owner):
+                    raise RuntimeError('Lost the order book lease to another service')
+                self.handle(self.queue.pop(batch_size, timeout=0 if once else 1))
+                if once:
+                    break
+                if resync_seconds and time.monotonic() - last_resync >= resync_seconds:
+                    self.resync()
+                    self.pair()
+                    last_resync = time.monotonic()
+        finally:
+            # A failed start leaves no book, or one whose log must not be truncated
+            if started:
+                self.snapshot()
+            if self.wal is not None:
+                self.wal.close()
+            release_lease(RESIDENT_LEASE, self.owner)
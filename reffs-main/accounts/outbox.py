@@ -0,0 +1,150 @@
+"""
+Transactional outbox for notification tasks.
+
+Code that changes business state records the notifications it implies
+with enqueue() inside the same transaction, as OutboxMessage rows. Nothing
+talks to the broker on the request or pairing path, and a rolled-back
+transaction takes its messages with it.
+
+drain() runs from the drain_outbox beat task or the drain_outbox management
+command. It claims a batch of due rows (SKIP LOCKED where supported),
+collapses rows with the same dedupe key into one call, and pushes them to
+Celery or, with OUTBOX_DELIVERY = 'direct', runs the task in-process.
+Tasks driven by the outbox raise on failure rather than logging and
+returning, so failed calls are retried with exponential backoff up to
+OUTBOX_MAX_ATTEMPTS. Delivery is at-least-once.
+"""
+import hashlib
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from accounts.models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _task_name(task):
+    return getattr(task, 'name', task)
+
+
+def dedupe_key(task, args=(), kwargs=None):
+    """Identical calls to the same task share a key"""
+    payload = json.dumps([_task_name(task), list(args), kwargs or {}], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def message(task, *args, key=None, **kwargs):
+    """An unsaved outbox row for ``task(*args, **kwargs)``; see enqueue_many()"""
+    return OutboxMessage(
+        task=_task_name(task),
+        args=list(args),
+        kwargs=kwargs,
+        dedupe_key=key or dedupe_key(task, args, kwargs),
+    )
+
+
+def enqueue(task, *args, key=None, **kwargs):
+    """
+    Record a call to ``task`` (a task or its dotted name) in the current
+    transaction. ``key`` overrides the dedupe key derived from the call.
+    """
+    return message(task, *args, key=key, **kwargs).save()
+
+
+def enqueue_many(messages):
+    """Record several message() rows with one INSERT"""
+    if messages:
+        OutboxMessage.objects.bulk_create(messages)
+
+
+def backoff(attempts):
+    base = _setting('OUTBOX_RETRY_BASE_SECONDS', 10)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), _setting('OUTBOX_RETRY_MAX_SECONDS', 3600)))
+
+
+def dispatch(row, direct=False):
+    task = import_string(row.task)
+    if direct:
+        task.apply(args=row.args, kwargs=row.kwargs, throw=True)
+    else:
+        task.apply_async(args=row.args, kwargs=row.kwargs)
+
+
+def claim(batch_size):
+    """Lock the next ``batch_size`` due rows. Must run inside a transaction."""
+    queryset = OutboxMessage.objects.filter(
+        sent_at__isnull=True,
+        available_at__lte=timezone.now(),
+        attempts__lt=_setting('OUTBOX_MAX_ATTEMPTS', 8),
+    ).order_by('id')
+    if connection.features.has_select_for_update_skip_locked:
+        queryset = queryset.select_for_update(skip_locked=True)
+    return list(queryset[:batch_size])
+
+
+def drain_batch(batch_size=None, direct=None):
+    """
+    Dispatch one batch. Returns (claimed rows, calls sent, calls failed).
+    Every row sharing a dedupe key is settled by one call.
+    """
+    batch_size = batch_size or _setting('OUTBOX_BATCH_SIZE', 100)
+    if direct is None:
+        direct = _setting('OUTBOX_DELIVERY', 'celery') == 'direct'
+    with transaction.atomic():
+        rows = claim(batch_size)
+        groups = {}
+        for row in rows:
+            groups.setdefault(row.dedupe_key, []).append(row)
+
+        sent_ids, failed = [], []
+        for group in groups.values():
+            try:
+                # A savepoint per call: a task that fails in direct mode
+                # rolls back its own writes, not the claim or the batch
+                with transaction.atomic():
+                    dispatch(group[0], direct=direct)
+            except Exception as e:
+                logger.error(f"Failed to dispatch outbox message {group[0].id} ({group[0].task}): {str(e)}")
+                failed.append((group, str(e)))
+            else:
+                sent_ids.extend(row.id for row in group)
+
+        now = timezone.now()
+        if sent_ids:
+            OutboxMessage.objects.filter(id__in=sent_ids).update(sent_at=now)
+        for group, error in failed:
+            attempts = group[0].attempts + 1
+            OutboxMessage.objects.filter(id__in=[row.id for row in group]).update(
+                attempts=attempts, last_error=error, available_at=now + backoff(attempts)
+            )
+    return len(rows), len(groups) - len(failed), len(failed)
+
+
+def drain(batch_size=None, direct=None, max_batches=None):
+    """Drain batches until the outbox has no due rows; returns (sent, failed) calls"""
+    batch_size = batch_size or _setting('OUTBOX_BATCH_SIZE', 100)
+    sent = failed = batches = 0
+    while max_batches is None or batches < max_batches:
+        claimed, batch_sent, batch_failed = drain_batch(batch_size, direct)
+        sent += batch_sent
+        failed += batch_failed
+        batches += 1
+        if claimed < batch_size:
+            break
+    return sent, failed
+
+
+def purge_sent(older_than=None):
+    """Delete rows sent longer than OUTBOX_RETENTION_DAYS ago"""
+    cutoff = timezone.now() - (older_than or timedelta(days=_setting('OUTBOX_RETENTION_DAYS', 7)))
+    return OutboxMessage.objects.filter(sent_at__lt=cutoff).delete()[0]
@@ -0,0 +1,670 @@
+import logging
+import os
+import socket
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from accounts import digests as notification_digests
+from accounts.matching import get_policy
+from accounts.reminders import payment_deadlines
+from accounts.models import Investment, PairedInvestment, PairingLease
+
+logger = logging.getLogger(__name__)
+
+# Lease taken by full sweeps so overlapping beat ticks skip instead of
+# racing each other.
+SWEEP_LEASE = 'pairing-sweep'
+# Lease shared by every pairing run on databases without SKIP LOCKED
+# (SQLite), degrading pairing to a single claimer.
+SINGLE_CLAIMER_LEASE = 'pairing'
+
+# Only the columns the matcher and the write-back need are loaded.
+MATURED_FIELDS = ('id', 'user', 'amount', 'return_amount', 'remaining_amount',
+                  'status', 'paired_to', 'created_at', 'mature_at')
+PENDING_FIELDS = ('id', 'user', 'amount', 'remn_amount', 'status',
+                  'paired_to', 'pairing_reference', 'created_at')
+
+
+def to_cents(value):
+    """Convert a Decimal amount to integer cents"""
+    return int((value or Decimal('0.00')).quantize(Decimal('0.01')) * 100)
+
+
+def from_cents(cents):
+    """Convert integer cents back to a two-place Decimal"""
+    return (Decimal(int(cents)) / 100).quantize(Decimal('0.01'))
+
+
+class PairingBook:
+    """
+    Snapshot of the order book: matured payouts and pending bids, in
+    created_at order, with their open amounts as integer cents.
+    """
+
+    def __init__(self, matured, pending):
+        self.matured = list(matured)
+        self.pending = list(pending)
+        self.matured_users = [inv.user_id for inv in self.matured]
+        self.pending_users = [inv.user_id for inv in self.pending]
+        self.matured_mature_at = [inv.mature_at for inv in self.matured]
+        self.matured_cents = [to_cents(self.matured_open_amount(inv)) for inv in self.matured]
+        self.pending_cents = [to_cents(self.pending_open_amount(inv)) for inv in self.pending]
+        now = timezone.now()
+        self.pending_waited = [
+            (now - inv.created_at).total_seconds() if inv.created_at else 0 for inv in self.pending
+        ]
+
+    @staticmethod
+    def matured_open_amount(investment):
+        if investment.remaining_amount is None:
+            return investment.return_amount or investment.amount
+        return investment.remaining_amount
+
+    @staticmethod
+    def pending_open_amount(investment):
+        if investment.remn_amount is None:
+            return investment.amount
+        return investment.remn_amount
+
+
+def load_book(matured_queryset=None, pending_queryset=None):
+    """Load the matured and pending sides of the book in one query each"""
+    if matured_queryset is None:
+        matured_queryset = Investment.objects.filter(status='matured')
+    if pending_queryset is None:
+        pending_queryset = Investment.objects.filter(status='pending')
+
+    matured = matured_queryset.only(*MATURED_FIELDS).order_by('created_at', 'id')
+    pending = pending_queryset.only(*PENDING_FIELDS).order_by('created_at', 'id')
+    return PairingBook(matured, pending)
+
+
+def _lock(queryset, lock):
+    if lock:
+        return queryset.select_for_update(skip_locked=True)
+    return queryset
+
+
+def _fill_counter_side(anchor, anchor_is_matured, lock=False, chunk_size=200):
+    """
+    Read the side of the book opposite ``anchor`` in FIFO order, chunk by
+    chunk, stopping once enough counterparty amount has been seen to cover
+    the anchor. Returns the resulting PairingBook.
+
+    Chunks are read without locks. With ``lock`` only the prefix of a chunk
+    that covers what is still missing is then claimed, by id with SKIP
+    LOCKED, so no row past the last one needed is locked.
+    """
+    if anchor_is_matured:
+        anchor_cents = sum(to_cents(PairingBook.matured_open_amount(inv)) for inv in anchor)
+        counter_queryset = Investment.objects.filter(status='pending').only(*PENDING_FIELDS)
+        open_amount = PairingBook.pending_open_amount
+    else:
+        anchor_cents = sum(to_cents(PairingBook.pending_open_amount(inv)) for inv in anchor)
+        counter_queryset = Investment.objects.filter(status='matured').only(*MATURED_FIELDS)
+        open_amount = PairingBook.matured_open_amount
+
+    anchor_users = {inv.user_id for inv in anchor}
+    counter = []
+    eligible_cents = 0
+    after = None
+    while eligible_cents < anchor_cents:
+        queryset = counter_queryset
+        if after is not None:
+            created_at, pk = after
+            queryset = queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+        chunk = list(queryset.order_by('created_at', 'id')[:chunk_size])
+        needed = []
+        missing = anchor_cents - eligible_cents
+        for row in chunk:
+            needed.append(row)
+            if row.user_id not in anchor_users:
+                missing -= to_cents(open_amount(row))
+            if missing <= 0:
+                break
+        if not needed:
+            break
+        after = (needed[-1].created_at, needed[-1].id)
+        if lock:
+            ids = [row.id for row in needed]
+            needed = list(_lock(counter_queryset.filter(id__in=ids), True).order_by('created_at', 'id'))
+        for row in needed:
+            counter.append(row)
+            if row.user_id not in anchor_users:
+                eligible_cents += to_cents(open_amount(row))
+        if len(chunk) < chunk_size and after == (chunk[-1].created_at, chunk[-1].id):
+            break
+
+    if anchor_is_matured:
+        return PairingBook(anchor, counter)
+    return PairingBook(counter, anchor)
+
+
+def load_slice(matured_ids=None, pending_ids=None, lock=False, chunk_size=200):
+    """
+    Load only the part of the book a pairing trigger can affect.
+
+    The triggered side is loaded by id. The opposite side is read in FIFO
+    order until it covers the triggered side. With ``lock`` every row read
+    is claimed with SELECT ... FOR UPDATE SKIP LOCKED, so rows another
+    worker is pairing are left out.
+    """
+    if matured_ids:
+        queryset = Investment.objects.filter(status='matured', id__in=matured_ids).only(*MATURED_FIELDS)
+    else:
+        queryset = Investment.objects.filter(status='pending', id__in=pending_ids or []).only(*PENDING_FIELDS)
+    anchor = list(_lock(queryset, lock).order_by('created_at', 'id'))
+    return _fill_counter_side(anchor, bool(matured_ids), lock=lock, chunk_size=chunk_size)
+
+
+def claim_batch(after=None, batch_size=100, chunk_size=200):
+    """
+    Claim the next batch of matured investments after the ``after``
+    (created_at, id) keyset position, plus the pending bids needed to cover
+    them, all with SKIP LOCKED. Must run inside a transaction.
+    """
+    queryset = Investment.objects.filter(status='matured').only(*MATURED_FIELDS)
+    if after is not None:
+        created_at, pk = after
+        queryset = queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+    anchor = list(_lock(queryset, True).order_by('created_at', 'id')[:batch_size])
+    return _fill_counter_side(anchor, True, lock=True, chunk_size=chunk_size)
+
+
+class PairingPlan:
+    """
+    The result of matching a book: the PairedInvestment rows to create, the
+    Investment rows whose amounts or status changed, and the untouched rows
+    whose open amount is only being initialised.
+    """
+
+    def __init__(self, book, allocations, policy_name='fifo', match_seconds=0.0):
+        self.book = book
+        self.allocations = allocations
+        self.policy_name = policy_name
+        self.match_seconds = match_seconds
+        self.pairs = []
+        self.matured_updates = []
+        self.pending_updates = []
+        self.matured_inits = []
+        self.pending_inits = []
+        self._build()
+
+    def _build(self):
+        book = self.book
+        now = timezone.now()
+        payment_due_at, next_reminder_at = payment_deadlines(now)
+        matured_left = list(book.matured_cents)
+        pending_left = list(book.pending_cents)
+        last_matured_partner = {}
+        last_pending_partner = {}
+
+        for mi, ni, cents in self.allocations:
+            matured = book.matured[mi]
+            new = book.pending[ni]
+            self.pairs.append(PairedInvestment(
+                matured_investor_id=matured.user_id,
+                new_investor_id=new.user_id,
+                amount_paired=from_cents(cents),
+                status='paired',
+                payment_status='pending',
+                paired_at=now,
+                pairing_reference=new.pairing_reference,
+                matured_investment_id=matured.id,
+                new_investment_id=new.id,
+                payment_due_at=payment_due_at,
+                next_reminder_at=next_reminder_at,
+            ))
+            matured_left[mi] -= cents
+            pending_left[ni] -= cents
+            last_matured_partner[mi] = new.user_id
+            last_pending_partner[ni] = matured.user_id
+
+        for mi, matured in enumerate(book.matured):
+            if mi not in last_matured_partner:
+                if matured.remaining_amount is None:
+                    matured.remaining_amount = from_cents(matured_left[mi])
+                    self.matured_inits.append(matured)
+                continue
+            matured.remaining_amount = from_cents(matured_left[mi])
+            if matured_left[mi] == 0:
+                matured.status = 'paired'
+                matured.paired_to_id = last_matured_partner[mi]
+            self.matured_updates.append(matured)
+
+        for ni, new in enumerate(book.pending):
+            if ni not in last_pending_partner:
+                if new.remn_amount is None:
+                    new.remn_amount = from_cents(pending_left[ni])
+                    self.pending_inits.append(new)
+                continue
+            new.remn_amount = from_cents(pending_left[ni])
+            if pending_left[ni] == 0:
+                new.status = 'completed'
+                new.paired_to_id = last_pending_partner[ni]
+            self.pending_updates.append(new)
+
+    @property
+    def total_paired(self):
+        return from_cents(sum(cents for _, _, cents in self.allocations))
+
+    @property
+    def investment_updates(self):
+        return (len(self.matured_updates) + len(self.pending_updates)
+                + len(self.matured_inits) + len(self.pending_inits))
+
+    @property
+    def throughput(self):
+        """Book entries matched per second by the policy"""
+        entries = len(self.book.matured) + len(self.book.pending)
+        if not self.match_seconds:
+            return 0.0
+        return entries / self.match_seconds
+
+
+def _chunks(items, size=500):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def grouped_update(rows, fields):
+    """
+    Write changed rows with one UPDATE per distinct combination of new
+    values. A pairing run yields few distinct combinations (every bid
+    completed by the same investor gets the same remn_amount, status and
+    paired_to), and an UPDATE ... WHERE id IN (...) is far cheaper than the
+    per-row CASE/WHEN expressions bulk_update builds.
+    """
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(getattr(row, field) for field in fields), []).append(row.id)
+    for values, ids in groups.items():
+        for chunk in _chunks(ids):
+            Investment.objects.filter(id__in=chunk).update(**dict(zip(fields, values)))
+
+
+def write_plan(plan):
+    """Persist a pairing plan in a single transaction"""
+    with transaction.atomic():
+        PairedInvestment.objects.bulk_create(plan.pairs, batch_size=500)
+        grouped_update(plan.matured_updates, ['remaining_amount', 'status', 'paired_to_id'])
+        grouped_update(plan.pending_updates, ['remn_amount', 'status', 'paired_to_id'])
+        for chunk in _chunks([inv.id for inv in plan.matured_inits]):
+            Investment.objects.filter(id__in=chunk, remaining_amount__isnull=True).update(
+                remaining_amount=Coalesce('return_amount', 'amount')
+            )
+        for chunk in _chunks([inv.id for inv in plan.pending_inits]):
+            Investment.objects.filter(id__in=chunk, remn_amount__isnull=True).update(remn_amount=F('amount'))
+        record_pairing_events(collect_digests(plan.pairs), plan.pairs[0].paired_at if plan.pairs else None)
+
+
+def resident_book_enabled():
+    """Whether matching is done by the resident order book (accounts.orderbook)"""
+    return getattr(settings, 'PAIRING_ENGINE', 'celery') == 'resident'
+
+
+def schedule_pairing(matured_ids=None, pending_ids=None):
+    """
+    Queue an incremental pairing run for the given investments once the
+    current transaction commits, or hand them to the resident order book
+    when it is enabled.
+    """
+    matured_ids = list(matured_ids or [])
+    pending_ids = list(pending_ids or [])
+    if not matured_ids and not pending_ids:
+        return
+
+    if resident_book_enabled():
+        from accounts.orderbook import publish_book_events
+
+        transaction.on_commit(lambda: publish_book_events(matured_ids + pending_ids))
+        return
+
+    def enqueue():
+        from accounts.tasks import pair_investments
+
+        try:
+            pair_investments.delay(matured_ids=matured_ids, pending_ids=pending_ids)
+        except Exception as e:
+            # The scheduled run_pairing_job sweep picks these up later.
+            logger.error(f"Failed to queue incremental pairing: {str(e)}")
+
+    transaction.on_commit(enqueue)
+
+
+def collect_digests(pairs):
+    """
+    Group a run's pairs into one notification per affected user. Matured
+    investors get the amounts they will receive, new investors the amounts
+    they must pay, summed per counterparty.
+    """
+    digests = {}
+    for pair in pairs:
+        for user_id, counterparty_id, role in (
+            (pair.matured_investor_id, pair.new_investor_id, 'receive'),
+            (pair.new_investor_id, pair.matured_investor_id, 'pay'),
+        ):
+            entries = digests.setdefault(user_id, {})
+            key = (counterparty_id, role)
+            entries[key] = entries.get(key, Decimal('0.00')) + pair.amount_paired
+    return {
+        user_id: [
+            {'counterparty_id': counterparty_id, 'role': role, 'amount': str(amount)}
+            for (counterparty_id, role), amount in entries.items()
+        ]
+        for user_id, entries in digests.items()
+    }
+
+
+def record_pairing_events(digests, paired_at):
+    """Buffer each user's per-counterparty totals of a run in their notification digest"""
+    notification_digests.record([
+        notification_digests.event(user_id, 'pairing', entry, identity=[entry, paired_at])
+        for user_id, entries in digests.items()
+        for entry in entries
+    ])
+
+
+class PairingLeaseBusy(Exception):
+    """Raised when another process holds the pairing lease"""
+
+
+def supports_skip_locked():
+    return connection.features.has_select_for_update_skip_locked
+
+
+def lease_owner():
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def acquire_lease(name, owner, ttl=None):
+    """
+    Take the named lease if it is free, expired or already ours. The
+    compare-and-set is a single UPDATE so only one caller can win.
+    """
+    if ttl is None:
+        ttl = timedelta(seconds=getattr(settings, 'PAIRING_LEASE_SECONDS', 300))
+    now = timezone.now()
+    PairingLease.objects.get_or_create(name=name, defaults={'expires_at': now})
+    claimed = PairingLease.objects.filter(name=name).filter(
+        Q(expires_at__lte=now) | Q(owner=owner)
+    ).update(owner=owner, acquired_at=now, expires_at=now + ttl)
+    return claimed == 1
+
+
+def renew_lease(name, owner, ttl=None):
+    """Push out the expiry of a lease ``owner`` still holds. Returns False if it was lost."""
+    if ttl is None:
+        ttl = timedelta(seconds=getattr(settings, 'PAIRING_LEASE_SECONDS', 300))
+    return PairingLease.objects.filter(name=name, owner=owner).update(expires_at=timezone.now() + ttl) == 1
+
+
+def release_lease(name, owner):
+    PairingLease.objects.filter(name=name, owner=owner).update(owner='', expires_at=timezone.now())
+
+
+@contextmanager
+def pairing_lease(name):
+    """
+    Hold a pairing lease for the duration of the block, raising
+    PairingLeaseBusy if someone else holds it. Without SKIP LOCKED support
+    every caller uses the single-claimer lease; with it, ``name=None``
+    means row locks alone are enough and no lease is taken.
+
+    The block gets a ``renew()`` callable to call before each write: it
+    extends the lease by another PAIRING_LEASE_SECONDS, or raises
+    PairingLeaseBusy if the lease expired and another worker took it, so
+    a long run never writes without holding it.
+    """
+    if not supports_skip_locked():
+        name = SINGLE_CLAIMER_LEASE
+    if name is None:
+        yield lambda: None
+        return
+
+    owner = lease_owner()
+    if not acquire_lease(name, owner):
+        raise PairingLeaseBusy(f"Pairing lease '{name}' is held by another worker")
+
+    def renew():
+        if not renew_lease(name, owner):
+            raise PairingLeaseBusy(f"Pairing lease '{name}' expired and was taken over")
+
+    try:
+        yield renew
+    finally:
+        release_lease(name, owner)
+
+
+def pair_book(book, policy=None, renew=None):
+    """
+    Match a loaded book with the given policy and write the resulting plan,
+    renewing the caller's lease with ``renew`` right before the write
+    """
+    policy = get_policy(policy)
+    started = time.perf_counter()
+    allocations = policy.allocate(book)
+    plan = PairingPlan(book, allocations, policy.name, time.perf_counter() - started)
+    if renew is not None:
+        renew()
+    write_plan(plan)
+    return plan
+
+
+def log_throughput(plans):
+    for plan in plans:
+        logger.info(
+            f"Policy {plan.policy_name} matched {len(plan.book.matured)} matured and "
+            f"{len(plan.book.pending)} pending into {len(plan.pairs)} pairs in "
+            f"{plan.match_seconds * 1000:.1f}ms ({plan.throughput:.0f} entries/s)"
+        )
+
+
+def run_incremental_pairing(matured_ids=None, pending_ids=None, policy=None):
+    """
+    Pair only the investments touched by an event: newly matured payouts
+    and/or new or released bids. Each side is paired in its own transaction
+    and claims its rows with SKIP LOCKED where the database supports it.
+    """
+    plans = []
+    lock = supports_skip_locked()
+    with pairing_lease(None) as renew:
+        if matured_ids:
+            with transaction.atomic():
+                plans.append(pair_book(load_slice(matured_ids=matured_ids, lock=lock), policy, renew))
+        if pending_ids:
+            with transaction.atomic():
+                plans.append(pair_book(load_slice(pending_ids=pending_ids, lock=lock), policy, renew))
+    log_throughput(plans)
+    return plans
+
+
+def run_claimed_pairing(batch_size=100, policy=None, renew=None):
+    """
+    Sweep the matured side in keyset-ordered batches, each claimed with
+    SKIP LOCKED and committed on its own, so several workers can pair
+    disjoint slices of the book at the same time. ``renew`` is called
+    before each batch is written (see pairing_lease).
+    """
+    plans = []
+    after = None
+    while True:
+        with transaction.atomic():
+            book = claim_batch(after=after, batch_size=batch_size)
+            if not book.matured:
+                break
+            plans.append(pair_book(book, policy, renew))
+        last = book.matured[-1]
+        after = (last.created_at, last.id)
+        if not book.pending:
+            break
+    return plans
+
+
+def run_pairing(matured_queryset=None, pending_queryset=None, batch_size=100, policy=None):
+    """
+    Full pairing sweep under the sweep lease, matched with the named policy
+    (see accounts.matching). Returns the list of written plans, or an empty
+    list when another sweep is already running.
+    """
+    policy = get_policy(policy or getattr(settings, 'PAIRING_POLICY', None))
+    try:
+        with pairing_lease(SWEEP_LEASE) as renew:
+            if supports_skip_locked() and matured_queryset is None and pending_queryset is None:
+                plans = run_claimed_pairing(batch_size=batch_size, policy=policy, renew=renew)
+            else:
+                with transaction.atomic():
+                    plans = [pair_book(load_book(matured_queryset, pending_queryset), policy, renew)]
+    except PairingLeaseBusy as e:
+        logger.info(f"Skipping pairing sweep: {str(e)}")
+        return []
+
+    logger.info(
+        f"Pairing created {sum(len(plan.pairs) for plan in plans)} pairs "
+        f"in {len(plans)} batch(es)"
+    )
+    log_throughput(plans)
+    return plans
+
+
+@contextmanager
+def _snapshot(read_only):
+    """
+    A transaction reading one consistent snapshot of the book, rolled back
+    at the end. It has to be the outermost transaction: Postgres only takes
+    SET TRANSACTION before the transaction's first query.
+    """
+    if connection.in_atomic_block:
+        raise transaction.TransactionManagementError(
+            "Pairing dry runs open their own snapshot transaction; call them outside atomic()"
+        )
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            mode = ' READ ONLY' if read_only else ''
+            with connection.cursor() as cursor:
+                cursor.execute(f'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ{mode}')
+        yield
+        transaction.set_rollback(True)
+
+
+def simulate_pairing(policy=None, measure_writes=False, max_pairs=None):
+    """
+    Dry-run the full matcher against a consistent snapshot of the book and
+    report what it would do without writing anything.
+
+    With ``measure_writes`` the bulk writes are executed inside the
+    snapshot transaction and rolled back, so the write timing is real;
+    otherwise only building the rows is timed. Those writes lock the rows
+    they update, as a real sweep does, until the rollback right after
+    them, so confirmations and the order book touching those rows wait
+    for write_ms. The run holds the sweep lease and raises PairingLeaseBusy
+    while a real sweep is running rather than contend with it.
+    """
+    policy = get_policy(policy or getattr(settings, 'PAIRING_POLICY', None))
+    with pairing_lease(SWEEP_LEASE) if measure_writes else nullcontext():
+        with _snapshot(read_only=not measure_writes):
+            started = time.perf_counter()
+            book = load_book()
+            loaded = time.perf_counter()
+            allocations = policy.allocate(book)
+            matched = time.perf_counter()
+            plan = PairingPlan(book, allocations, policy.name, matched - loaded)
+            if measure_writes:
+                write_plan(plan)
+            written = time.perf_counter()
+
+    return build_report(plan, {
+        'load_ms': round((loaded - started) * 1000, 2),
+        'match_ms': round((matched - loaded) * 1000, 2),
+        'write_ms': round((written - matched) * 1000, 2),
+        'write_executed': measure_writes,
+    }, max_pairs=max_pairs)
+
+
+def compare_policies(policies):
+    """
+    Dry-run several policies against one snapshot of the book. Each report
+    gains ``fragment_reduction``: the share of PairedInvestment rows (and
+    so transfers, confirmations and notifications) saved relative to the
+    first policy.
+    """
+    reports = []
+    with _snapshot(read_only=True):
+        for name in policies:
+            policy = get_policy(name)
+            book = load_book()
+            started = time.perf_counter()
+            allocations = policy.allocate(book)
+            match_seconds = time.perf_counter() - started
+            plan = PairingPlan(book, allocations, policy.name, match_seconds)
+            reports.append(build_report(plan, {'match_ms': round(match_seconds * 1000, 2)}, max_pairs=0))
+
+    baseline = reports[0]['pair_count'] if reports else 0
+    for report in reports:
+        report['fragment_reduction'] = round(1 - report['pair_count'] / baseline, 4) if baseline else 0.0
+    return reports
+
+
+def build_report(plan, timing, max_pairs=None):
+    """Summarise a pairing plan as a JSON-serialisable dict"""
+    book = plan.book
+    matured_fragments = {}
+    pending_fragments = {}
+    matured_left = list(book.matured_cents)
+    pending_left = list(book.pending_cents)
+    pairs = []
+    for mi, ni, cents in plan.allocations:
+        matured_fragments[mi] = matured_fragments.get(mi, 0) + 1
+        pending_fragments[ni] = pending_fragments.get(ni, 0) + 1
+        matured_left[mi] -= cents
+        pending_left[ni] -= cents
+        if max_pairs is None or len(pairs) < max_pairs:
+            pairs.append({
+                'matured_investment_id': book.matured[mi].id,
+                'matured_investor_id': book.matured_users[mi],
+                'new_investment_id': book.pending[ni].id,
+                'new_investor_id': book.pending_users[ni],
+                'amount': str(from_cents(cents)),
+            })
+
+    def fragment_stats(fragments):
+        counts = list(fragments.values())
+        return {
+            'investments': len(counts),
+            'max': max(counts, default=0),
+            'avg': round(sum(counts) / len(counts), 2) if counts else 0,
+        }
+
+    return {
+        'policy': plan.policy_name,
+        'matured_count': len(book.matured),
+        'pending_count': len(book.pending),
+        'pair_count': len(plan.allocations),
+        'total_paired': str(plan.total_paired),
+        'unmatched': {
+            'matured_count': sum(1 for cents in matured_left if cents > 0),
+            'matured_amount': str(from_cents(sum(matured_left))),
+            'pending_count': sum(1 for cents in pending_left if cents > 0),
+            'pending_amount': str(from_cents(sum(pending_left))),
+        },
+        'fragments': {
+            'per_matured': fragment_stats(matured_fragments),
+            'per_pending': fragment_stats(pending_fragments),
+        },
+        'rows': {
+            'paired_investments': len(plan.pairs),
+            'investment_updates': plan.investment_updates,
+        },
+        'timing': timing,
+        'throughput': round(plan.throughput, 1),
+        'pairs': pairs,
+    }
@@ -0,0 +1,93 @@
+"""
+Referral codes derived from user ids.
+
+A user's code is their id pushed through a keyed permutation of the
+9-character code space (uppercase letters and digits, 36**9 codes): a
+balanced Feistel network over 48 bits with HMAC-SHA256 rounds, cycle-walked
+back into range. Distinct ids always give distinct codes, so there is
+nothing to look up and nothing to retry, and consecutive ids give codes
+that look unrelated.
+
+Codes issued before this were 8 random characters; they stay valid, and
+as every derived code has 9 characters the two can never collide.
+
+REFERRAL_CODE_KEY must be set explicitly: it is not derived from
+SECRET_KEY, so rotating SECRET_KEY cannot change the codes, and the app
+refuses to start without it (check_key(), from AccountsConfig.ready()).
+It must not change once codes have been issued, or new codes could repeat
+old ones.
+"""
+import hashlib
+import hmac
+import string
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+ALPHABET = string.digits + string.ascii_uppercase
+LENGTH = 9
+SPACE = len(ALPHABET) ** LENGTH
+HALF_BITS = 24
+HALF_MASK = (1 << HALF_BITS) - 1
+ROUNDS = 6
+
+
+def check_key():
+    """Raise ImproperlyConfigured unless REFERRAL_CODE_KEY is set"""
+    if not getattr(settings, 'REFERRAL_CODE_KEY', ''):
+        raise ImproperlyConfigured("REFERRAL_CODE_KEY must be set to derive referral codes")
+
+
+def _key():
+    check_key()
+    return settings.REFERRAL_CODE_KEY.encode()
+
+
+def _round(key, i, value):
+    digest = hmac.new(key, f'{i}:{value}'.encode(), hashlib.sha256).digest()
+    return int.from_bytes(digest[:4], 'big') & HALF_MASK
+
+
+def _feistel(n, key):
+    left, right = n >> HALF_BITS, n & HALF_MASK
+    for i in range(ROUNDS):
+        left, right = right, left ^ _round(key, i, right)
+    return (left << HALF_BITS) | right
+
+
+def permute(n):
+    """Keyed bijection of [0, SPACE)"""
+    if not 0 <= n < SPACE:
+        raise ValueError(f"{n} is outside the referral code space")
+    key = _key()
+    n = _feistel(n, key)
+    while n >= SPACE:
+        n = _feistel(n, key)
+    return n
+
+
+def encode(n):
+    chars = []
+    for _ in range(LENGTH):
+        n, digit = divmod(n, len(ALPHABET))
+        chars.append(ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+
+def code_for(user_id):
+    """The referral code of the user with id ``user_id``"""
+    return encode(permute(user_id))
+
+
+def assign(users):
+    """
+    Give saved users without a code theirs, in one bulk UPDATE; for users
+    created with bulk_create, which skips User.save()
+    """
+    from accounts.models import User
+
+    missing = [user for user in users if not user.referral_code]
+    for user in missing:
+        user.referral_code = code_for(user.pk)
+    User.objects.bulk_update(missing, ['referral_code'], batch_size=500)
+    return len(missing)
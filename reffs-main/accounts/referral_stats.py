@@ -0,0 +1,140 @@
+"""
+Denormalized per-user referral counters.
+
+ReferralStats holds, for each user, how many users they referred, how many
+ReferralHistory rows they have, the bonus those rows earned and the part of
+it that is available (active and payment confirmed). The read endpoints
+serve these instead of aggregating ReferralHistory on every request.
+
+Every code path that creates a ReferralHistory row or changes its status,
+confirmation or bonus calls in here in the same transaction. The change is
+applied as an F() increment of the difference it makes, so concurrent
+updates for the same referrer never overwrite each other. reconcile()
+recomputes every counter from the source rows and fixes any that drifted.
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+
+from accounts.models import ReferralHistory, ReferralStats, User
+
+COUNTERS = ('referred_users', 'referrals', 'total_earned', 'available_bonus')
+
+
+def get(user):
+    """The user's counters, created empty if they have none yet"""
+    return ReferralStats.objects.get_or_create(user=user)[0]
+
+
+def adjust(user_id, **deltas):
+    """Add ``deltas`` ({counter: amount}) to the user's counters"""
+    updates = {field: F(field) + delta for field, delta in deltas.items() if delta}
+    if not updates:
+        return
+    if not ReferralStats.objects.filter(user_id=user_id).update(**updates):
+        ReferralStats.objects.get_or_create(user_id=user_id)
+        ReferralStats.objects.filter(user_id=user_id).update(**updates)
+
+
+def snapshot(history):
+    """What a ReferralHistory row counts towards; pass to history_changed() after changing it"""
+    return history.status, history.payment_confirmed, history.bonus_earned
+
+
+def contribution(status, payment_confirmed, bonus_earned):
+    available = bonus_earned if status == 'active' and payment_confirmed else Decimal('0.00')
+    return {'referrals': 1, 'total_earned': bonus_earned, 'available_bonus': available}
+
+
+def user_joined(user):
+    ReferralStats.objects.get_or_create(user=user)
+    if user.referred_by_id:
+        adjust(user.referred_by_id, referred_users=1)
+
+
+def history_created(history):
+    adjust(history.referrer_id, **contribution(*snapshot(history)))
+
+
+def history_changed(history, before):
+    old, new = contribution(*before), contribution(*snapshot(history))
+    adjust(history.referrer_id, **{field: new[field] - old[field] for field in new})
+
+
+def update_histories(queryset, **changes):
+    """
+    ``queryset.update(**changes)`` for ReferralHistory rows, adjusting the
+    referrers' counters. Returns the rows as they were before the update.
+    """
+    rows = list(queryset.select_for_update().values('id', 'referrer_id', 'status', 'payment_confirmed', 'bonus_earned'))
+    if not rows:
+        return rows
+    ReferralHistory.objects.filter(id__in=[row['id'] for row in rows]).update(**changes)
+    deltas = {}
+    for row in rows:
+        before = (row['status'], row['payment_confirmed'], row['bonus_earned'])
+        after = (
+            changes.get('status', row['status']),
+            changes.get('payment_confirmed', row['payment_confirmed']),
+            changes.get('bonus_earned', row['bonus_earned']),
+        )
+        old, new = contribution(*before), contribution(*after)
+        user_deltas = deltas.setdefault(row['referrer_id'], {})
+        for field in new:
+            user_deltas[field] = user_deltas.get(field, 0) + new[field] - old[field]
+    for user_id, user_deltas in sorted(deltas.items()):
+        adjust(user_id, **user_deltas)
+    return rows
+
+
+def expected_counters():
+    """{user id: {counter: value}} recomputed from ReferralHistory and User"""
+    counters = {}
+    for row in (
+        ReferralHistory.objects.values('referrer_id').order_by()
+        .annotate(
+            referrals=Count('id'),
+            total_earned=Sum('bonus_earned'),
+            available_bonus=Sum('bonus_earned', filter=Q(status='active', payment_confirmed=True)),
+        )
+    ):
+        counters[row['referrer_id']] = {
+            'referrals': row['referrals'],
+            'total_earned': row['total_earned'] or Decimal('0.00'),
+            'available_bonus': row['available_bonus'] or Decimal('0.00'),
+        }
+    for user_id, referred in (
+        User.objects.filter(referred_by__isnull=False).values('referred_by_id').order_by()
+        .annotate(n=Count('id')).values_list('referred_by_id', 'n')
+    ):
+        counters.setdefault(user_id, {})['referred_users'] = referred
+    return counters
+
+
+def reconcile(dry_run=False, batch_size=500):
+    """
+    Recompute every user's counters and fix those that drifted. Returns
+    the ids of the users whose counters were wrong.
+    """
+    with transaction.atomic():
+        # Hold the counters still while they are compared
+        current = {stats.user_id: stats for stats in ReferralStats.objects.select_for_update()}
+        expected = expected_counters()
+        missing, drifted = [], []
+        for user_id in User.objects.values_list('id', flat=True).order_by('id'):
+            values = {field: expected.get(user_id, {}).get(field, 0) for field in COUNTERS}
+            stats = current.get(user_id)
+            if stats is None:
+                missing.append(ReferralStats(user_id=user_id, **values))
+            elif any(getattr(stats, field) != values[field] for field in COUNTERS):
+                for field in COUNTERS:
+                    setattr(stats, field, values[field])
+                drifted.append(stats)
+        if not dry_run:
+            ReferralStats.objects.bulk_create(missing, batch_size=batch_size)
+            ReferralStats.objects.bulk_update(drifted, COUNTERS, batch_size=batch_size)
+    # Users without counters only count as drift if they should have some
+    return [stats.user_id for stats in drifted] + [
+        stats.user_id for stats in missing if any(getattr(stats, field) for field in COUNTERS)
+    ]
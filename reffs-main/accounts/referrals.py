@@ -0,0 +1,98 @@
+"""
+Referral tree queries over the ReferralClosure table.
+
+The closure table stores every (ancestor, descendant, depth) pair of the
+User.referred_by tree, so downline questions are single indexed queries
+on ancestor instead of recursive walks:
+
+    downline_count(user)              everyone below the user
+    downline_by_depth(user)           users and amount invested per level
+
+add_to_tree() inserts a new user's rows when they register (their own
+depth 0 row plus one row per upline ancestor). rebuild_closure() recreates
+the whole table level by level with one INSERT ... SELECT per depth and
+backs the backfill_referral_closure command.
+"""
+from django.db import connection, transaction
+from django.db.models import Count, DecimalField, Sum
+
+from accounts.models import Investment, ReferralClosure, User
+
+PAID_IN = ['confirmed', 'matured', 'paired', 'partially_paid', 'completed']
+
+
+def add_to_tree(user):
+    """Record a newly registered user's place in the referral tree"""
+    rows = [ReferralClosure(ancestor_id=user.id, descendant_id=user.id, depth=0)]
+    if user.referred_by_id:
+        rows.extend(
+            ReferralClosure(ancestor_id=ancestor_id, descendant_id=user.id, depth=depth + 1)
+            for ancestor_id, depth in ReferralClosure.objects.filter(
+                descendant_id=user.referred_by_id
+            ).values_list('ancestor_id', 'depth')
+        )
+    ReferralClosure.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+def downline(user, max_depth=None):
+    """Closure rows below ``user`` (depth >= 1), optionally limited to ``max_depth`` levels"""
+    queryset = ReferralClosure.objects.filter(ancestor=user, depth__gt=0)
+    if max_depth is not None:
+        queryset = queryset.filter(depth__lte=max_depth)
+    return queryset
+
+
+def downline_count(user, max_depth=None):
+    return downline(user, max_depth).count()
+
+
+def downline_by_depth(user, max_depth=None):
+    """
+    [{'depth', 'users', 'invested'}] per level below ``user``. ``invested``
+    sums the downline's investments that have been paid in.
+    """
+    money = DecimalField(max_digits=14, decimal_places=2)
+    links = {'user__upline_links__ancestor': user, 'user__upline_links__depth__gt': 0}
+    if max_depth is not None:
+        links['user__upline_links__depth__lte'] = max_depth
+    totals = dict(
+        Investment.objects.filter(status__in=PAID_IN, **links)
+        .values_list('user__upline_links__depth').order_by()
+        .annotate(total=Sum('amount', output_field=money))
+    )
+    levels = downline(user, max_depth).values('depth').order_by('depth').annotate(users=Count('descendant'))
+    return [
+        {'depth': level['depth'], 'users': level['users'], 'invested': totals.get(level['depth'], 0)}
+        for level in levels
+    ]
+
+
+def rebuild_closure(max_depth=100):
+    """
+    Recreate the closure table from User.referred_by. Returns the number
+    of rows per depth. Stops at ``max_depth`` so a cycle in referred_by
+    cannot loop forever.
+    """
+    closure = ReferralClosure._meta.db_table
+    users = User._meta.db_table
+    levels = []
+    with transaction.atomic(), connection.cursor() as cursor:
+        ReferralClosure.objects.all().delete()
+        cursor.execute(
+            f"INSERT INTO {closure} (ancestor_id, descendant_id, depth) SELECT id, id, 0 FROM {users}"
+        )
+        levels.append(cursor.rowcount)
+        depth = 0
+        while depth < max_depth:
+            cursor.execute(
+                f"INSERT INTO {closure} (ancestor_id, descendant_id, depth) "
+                f"SELECT c.ancestor_id, u.id, c.depth + 1 FROM {closure} c "
+                f"JOIN {users} u ON u.referred_by_id = c.descendant_id "
+                f"WHERE c.depth = %s AND u.id <> c.ancestor_id",
+                [depth],
+            )
+            if not cursor.rowcount:
+                break
+            levels.append(cursor.rowcount)
+            depth += 1
+    return levels
@@ -0,0 +1,283 @@
+"""
+Payment reminders and expiry for paired investments.
+
+Every pending PairedInvestment carries a payment_due_at deadline
+(PAYMENT_WINDOW_HOURS after pairing) and a next_reminder_at: the moment
+the sweeper next has to act on it. The escalation tiers are
+PAYMENT_REMINDER_HOURS before the deadline (a reminder at T-6h, a final
+reminder at T-1h), then expiry at T.
+
+sweep_payments() walks rows with next_reminder_at <= now in keyset order
+over the (next_reminder_at, id) index. Each batch is one transaction. It
+works out each row's tier from the current time, so a late sweep skips
+straight to the tier that applies. It records reminder events in the
+users' notification digests (sent immediately, not held for the window),
+and moves next_reminder_at on to the next tier with one UPDATE per tier.
+With nothing due, a sweep is a single index probe.
+
+Expiry marks the pairing 'expired' (payment 'failed'), which no
+confirmation can undo, and releases the unpaid amounts in the same
+transaction: each matured
+investment gets its expired amount_paired back on remaining_amount (and
+returns to 'matured' if it was fully paired), with one CASE-keyed UPDATE
+per 500 investments. A bidder's remn_amount is not added to, as payment
+confirmation rewrites it too: it is recomputed as amount minus the
+bidder's pairings that have not expired, and the bidder returns to
+'pending' if that leaves anything to pay. The released investments are
+handed to schedule_pairing in the same batch so they are re-matched on
+the next cycle.
+
+Pairings made before their matured investment was recorded still get
+reminders and expire, but cannot be released until someone resolves
+which investment they paid out; release_legacy() (the
+release_legacy_pairing command) records it and releases them then.
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, DecimalField, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from accounts import digests
+from accounts.models import Investment, PairedInvestment
+
+logger = logging.getLogger(__name__)
+
+
+def payment_window():
+    return timedelta(hours=getattr(settings, 'PAYMENT_WINDOW_HOURS', 24))
+
+
+def reminder_offsets():
+    """Reminder tiers as time before the deadline, earliest first"""
+    hours = sorted(getattr(settings, 'PAYMENT_REMINDER_HOURS', [6, 1]), reverse=True)
+    return [timedelta(hours=h) for h in hours]
+
+
+def expiry_tier():
+    return len(reminder_offsets()) + 1
+
+
+def payment_deadlines(paired_at):
+    """(payment_due_at, next_reminder_at) for a pairing made at ``paired_at``"""
+    due = paired_at + payment_window()
+    offsets = reminder_offsets()
+    return due, due - offsets[0] if offsets else due
+
+
+def tier_at(due, now, offsets=None):
+    """The tier that applies at ``now``: 1..len(offsets) for reminders, then expiry"""
+    offsets = reminder_offsets() if offsets is None else offsets
+    if now >= due:
+        return len(offsets) + 1
+    tier = 1
+    for i, offset in enumerate(offsets):
+        if now >= due - offset:
+            tier = i + 1
+    return tier
+
+
+def due_rows(now, after=None, batch_size=500):
+    """
+    The next batch of pending pairings the sweeper must act on, in
+    (next_reminder_at, id) order after the ``after`` key
+    """
+    queryset = PairedInvestment.objects.filter(next_reminder_at__lte=now)
+    if connection.features.has_select_for_update_skip_locked:
+        queryset = queryset.select_for_update(skip_locked=True, of=('self',))
+    if after is not None:
+        queryset = queryset.filter(
+            Q(next_reminder_at__gt=after[0]) | Q(next_reminder_at=after[0], id__gt=after[1])
+        )
+    return list(queryset.order_by('next_reminder_at', 'id').values(
+        'id', 'next_reminder_at', 'payment_due_at', 'reminder_tier', 'payment_status', 'amount_paired',
+        'matured_investor_id', 'matured_investor__username', 'new_investor_id', 'new_investor__username',
+        'matured_investment_id', 'new_investment_id',
+    )[:batch_size])
+
+
+def reminder_events(row, tier, expired):
+    payload = {
+        'paired_investment_id': row['id'],
+        'amount': str(row['amount_paired']),
+        'due_at': row['payment_due_at'].isoformat(),
+        'tier': tier,
+        'expired': expired,
+    }
+    events = [digests.event(
+        row['new_investor_id'], 'payment_reminder',
+        dict(payload, counterparty=row['matured_investor__username'], role='pay'),
+        identity=[row['id'], tier, 'pay'],
+    )]
+    if expired:
+        events.append(digests.event(
+            row['matured_investor_id'], 'payment_reminder',
+            dict(payload, counterparty=row['new_investor__username'], role='receive'),
+            identity=[row['id'], tier, 'receive'],
+        ))
+    return events
+
+
+def process_batch(rows, now):
+    """
+    Act on one batch of due rows. Returns {tier: rows}. Must run inside a
+    transaction.
+    """
+    offsets = reminder_offsets()
+    expiry = len(offsets) + 1
+    by_tier = {}
+    stale = {}
+    settled = []
+    events = []
+    for row in rows:
+        if row['payment_status'] != 'pending' or row['payment_due_at'] is None:
+            settled.append(row['id'])
+            continue
+        tier = tier_at(row['payment_due_at'], now, offsets)
+        if tier <= row['reminder_tier']:
+            # Already sent; only the next action time is off
+            stale.setdefault(row['reminder_tier'], []).append(row['id'])
+            continue
+        by_tier.setdefault(tier, []).append(row['id'])
+        events.extend(reminder_events(row, tier, tier == expiry))
+
+    if settled:
+        PairedInvestment.objects.filter(id__in=settled).update(next_reminder_at=None)
+    for tier, ids in list(by_tier.items()) + list(stale.items()):
+        if tier >= expiry:
+            PairedInvestment.objects.filter(id__in=ids, payment_status='pending').update(
+                reminder_tier=tier, next_reminder_at=None, payment_status='failed', status='expired'
+            )
+        else:
+            next_at = F('payment_due_at') - offsets[tier] if tier < len(offsets) else F('payment_due_at')
+            PairedInvestment.objects.filter(id__in=ids).update(reminder_tier=tier, next_reminder_at=next_at)
+    if by_tier.get(expiry):
+        expired_ids = set(by_tier[expiry])
+        release_expired([row for row in rows if row['id'] in expired_ids])
+    digests.record(events, urgent=True)
+    return by_tier
+
+
+def _add_back(amounts, field, paired_status, open_status, chunk_size=500):
+    """Add ``amounts`` ({investment id: Decimal}) to ``field`` and reopen fully paired rows"""
+    money = DecimalField(max_digits=10, decimal_places=2)
+    ids = sorted(amounts)
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        Investment.objects.filter(id__in=chunk).update(**{
+            field: Coalesce(F(field), Value(0), output_field=money) + Case(
+                *[When(id=pk, then=Value(amounts[pk])) for pk in chunk], output_field=money
+            ),
+            'status': Case(When(status=paired_status, then=Value(open_status)), default=F('status')),
+        })
+
+
+def _reopen_bids(ids, chunk_size=500):
+    """
+    Set remn_amount of the bids ``ids`` to their amount less the pairings
+    that have not expired, and reopen fully paired bids left with an amount
+    """
+    money = DecimalField(max_digits=10, decimal_places=2)
+    paired = PairedInvestment.objects.filter(
+        pairing_reference=OuterRef('pairing_reference'), new_investor=OuterRef('user')
+    ).exclude(status='expired').order_by().values('new_investor').annotate(
+        total=Sum('amount_paired')
+    ).values('total')
+    ids = sorted(ids)
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        Investment.objects.filter(id__in=chunk).update(
+            remn_amount=F('amount') - Coalesce(Subquery(paired, output_field=money), Value(0), output_field=money)
+        )
+        Investment.objects.filter(id__in=chunk, status='completed', remn_amount__gt=0).update(status='pending')
+
+
+def release_expired(rows):
+    """
+    Give the unpaid amounts of expired pairings back to both investments
+    and queue them for pairing. Must run in the transaction that expired
+    them. Pairings missing either investment are not released at all, as
+    giving the amount back to one side only would create money on that
+    side. Returns (matured ids, pending ids).
+    """
+    from accounts.pairing import schedule_pairing
+
+    matured, pending = {}, set()
+    for row in rows:
+        if not row['matured_investment_id'] or not row['new_investment_id']:
+            logger.error(
+                f"Expired pairing {row['id']} is missing an investment; its amount was not released "
+                f"(see the release_legacy_pairing command)"
+            )
+            continue
+        matured[row['matured_investment_id']] = matured.get(row['matured_investment_id'], 0) + row['amount_paired']
+        pending.add(row['new_investment_id'])
+    _add_back(matured, 'remaining_amount', 'paired', 'matured')
+    _reopen_bids(pending)
+    schedule_pairing(matured_ids=sorted(matured), pending_ids=sorted(pending))
+    return sorted(matured), sorted(pending)
+
+
+def release_legacy(pairing_id, matured_investment_id, new_investment_id=None):
+    """
+    Record the investments of an expired pairing the sweep could not
+    release (one made before they were tracked) and release it as the
+    sweep would have. ``new_investment_id`` is only needed when the
+    bidder's investment is not known either. Returns (matured ids,
+    pending ids).
+    """
+    with transaction.atomic():
+        pairing = PairedInvestment.objects.select_for_update().get(id=pairing_id)
+        if pairing.status != 'expired':
+            raise ValueError(f"Pairing {pairing_id} has not expired")
+        if pairing.matured_investment_id and pairing.new_investment_id:
+            raise ValueError(f"Pairing {pairing_id} has already been released")
+        new_investment_id = pairing.new_investment_id or new_investment_id
+        if new_investment_id is None:
+            raise ValueError(f"Pairing {pairing_id} needs its new investment as well")
+        owners = dict(Investment.objects.filter(
+            id__in=[matured_investment_id, new_investment_id]
+        ).values_list('id', 'user_id'))
+        if owners.get(matured_investment_id) != pairing.matured_investor_id:
+            raise ValueError(f"Investment {matured_investment_id} is not the matured investor's")
+        if owners.get(new_investment_id) != pairing.new_investor_id:
+            raise ValueError(f"Investment {new_investment_id} is not the new investor's")
+
+        pairing.matured_investment_id = matured_investment_id
+        pairing.new_investment_id = new_investment_id
+        pairing.save(update_fields=['matured_investment', 'new_investment'])
+        return release_expired([{
+            'id': pairing.id,
+            'amount_paired': pairing.amount_paired,
+            'matured_investment_id': matured_investment_id,
+            'new_investment_id': new_investment_id,
+        }])
+
+
+def sweep_payments(now=None, batch_size=None):
+    """
+    Send every reminder and expire every pairing that is due. Returns
+    {'reminded': n, 'expired': n}.
+    """
+    now = now or timezone.now()
+    batch_size = batch_size or getattr(settings, 'PAYMENT_SWEEP_BATCH_SIZE', 500)
+    expiry = expiry_tier()
+    totals = {'reminded': 0, 'expired': 0}
+    after = None
+    while True:
+        with transaction.atomic():
+            rows = due_rows(now, after, batch_size)
+            if not rows:
+                break
+            by_tier = process_batch(rows, now)
+        for tier, ids in by_tier.items():
+            totals['expired' if tier == expiry else 'reminded'] += len(ids)
+        after = (rows[-1]['next_reminder_at'], rows[-1]['id'])
+        if len(rows) < batch_size:
+            break
+    if totals['reminded'] or totals['expired']:
+        logger.info(f"Payment sweep: {totals['reminded']} reminded, {totals['expired']} expired")
+    return totals
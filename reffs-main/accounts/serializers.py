@@ -2,6 +2,9 @@ from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from django.db import transaction
 from .models import ReferralHistory, Investment, User, PairedInvestment, WithdrawHistory
+from .pairing import schedule_pairing
+from .referrals import add_to_tree
+from . import ledger, referral_stats
 from django.utils import timezone
 from decimal import Decimal
 from datetime import timedelta
@@ -24,6 +27,7 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
             'country': {'required': True}
         }
 
+    @transaction.atomic
     def create(self, validated_data):
         referral_code = validated_data.pop('referral_code', None)
         password = validated_data.pop('password')
@@ -38,6 +42,8 @@ class UserRegistrationSerializer(serializers.ModelSerializer):
                 pass
         
         user.save()
+        add_to_tree(user)
+        referral_stats.user_joined(user)
         return user
 
 class UserLoginSerializer(serializers.Serializer):
@@ -56,7 +62,8 @@ class UserLoginSerializer(serializers.Serializer):
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
-        fields = ('id', 'username', 'email', 'phone_number', 'referral_code', 'referral_earnings', 'is_staff', 'is_superuser')
+        fields = ('id', 'username', 'email', 'phone_number', 'referral_code', 'referral_earnings', 'is_staff', 'is_superuser',
+                  'notification_delivery')
         read_only_fields = ('referral_code', 'referral_earnings', 'is_staff', 'is_superuser')
 
 class UserMinimalSerializer(serializers.ModelSerializer):
@@ -117,8 +124,14 @@ class InvestmentSerializer(serializers.ModelSerializer):
         # Calculate interest amount
         interest_amount = amount * daily_interest_rate * maturity_period
         
-        # Get available referral bonus
-        available_bonus = self.get_available_referral_bonus(Investment(user=user))
+        # Get available referral bonus, locking the rows it comes from so a
+        # concurrent investment cannot use the same bonus
+        active_bonuses = list(ReferralHistory.objects.select_for_update().filter(
+            referrer=user,
+            status='active',
+            payment_confirmed=True
+        ).values_list('id', 'bonus_earned'))
+        available_bonus = sum((bonus for _, bonus in active_bonuses), Decimal('0.00'))
         
         # Calculate total return including referral bonus
         total_return = amount + interest_amount + available_bonus
@@ -142,33 +155,32 @@ class InvestmentSerializer(serializers.ModelSerializer):
             bonus_amount = amount * Decimal('0.03')
             
             # Create new referral history entry for this investment
-            ReferralHistory.objects.create(
+            history = ReferralHistory.objects.create(
                 referrer=user.referred_by,
                 referred=user,
                 amount_invested=amount,
                 bonus_earned=bonus_amount,
                 status='pending'
             )
+            referral_stats.history_created(history)
             
-            # Update referrer's total earnings
-            user.referred_by.referral_earnings += bonus_amount
-            user.referred_by.save()
+            # Credit the referrer's bonus balance
+            ledger.credit(user.referred_by_id, bonus_amount, 'referral_bonus', f'investment:{investment.id}')
         
         # If there's a referral bonus to use, update the referral history
         if available_bonus > 0:
-            # Update all active referral histories to mark bonus as used
-            ReferralHistory.objects.filter(
-                referrer=user,
-                status='active',
-                payment_confirmed=True
-            ).update(
+            # Mark the referral histories whose bonus was used
+            referral_stats.update_histories(
+                ReferralHistory.objects.filter(id__in=[history_id for history_id, _ in active_bonuses]),
                 status='used',
                 used_at=timezone.now()
             )
             
-            # Update user's referral earnings
-            user.referral_earnings -= available_bonus
-            user.save()
+            # Debit the bonus used from the user's balance
+            ledger.debit(user.id, available_bonus, 'bonus_used', f'investment:{investment.id}')
+
+        # Pair the new bid against the matured book once it is committed
+        schedule_pairing(pending_ids=[investment.id])
         
         return investment
 
@@ -223,6 +235,9 @@ class PairedInvestmentSerializer(serializers.ModelSerializer):
         Update the payment status and related fields
         """
         if 'payment_status' in validated_data and validated_data['payment_status'] == 'paid':
+            if instance.payment_status != 'pending':
+                # Expired pairings have been released and paired again
+                raise serializers.ValidationError({'payment_status': f'Payment is already {instance.payment_status}'})
             instance.status = 'confirmed'
             instance.payment_status = 'paid'
             instance.save()
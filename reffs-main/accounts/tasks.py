@@ -1,45 +1,68 @@
 from celery import shared_task
-from django.utils import timezone
-from django.db import transaction, models
-from datetime import timedelta
+from django.db import transaction
 from decimal import Decimal
 from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.conf import settings
-from django.apps import apps
 import pdfkit # type: ignore
 import os
 import logging
-from django.db.models import Sum, Count
-import random
+from django.db.models import Sum
 
-from accounts.models import Investment, PairedInvestment, Pairing, ReferralHistory, User
+from accounts import digests, ledger, notify, outbox
+from accounts.maturity import arm_due_buckets, fire_bucket, mature_due_investments
+from accounts.models import Investment, Pairing, ReferralHistory, User
+from accounts.pairing import (
+    PairingLeaseBusy, resident_book_enabled, run_incremental_pairing, run_pairing, simulate_pairing
+)
+from accounts.reminders import sweep_payments
 
 logger = logging.getLogger(__name__)
 
 @shared_task
 def check_matured_investments():
     """
-    Check for investments that have reached their maturity date and update their status.
+    Move confirmed investments that have reached their maturity date to
+    matured, in chunked bulk UPDATEs, and queue pairing for each chunk.
     This task should be scheduled to run periodically (e.g., daily or hourly).
     """
-    with transaction.atomic():
-        # Get all confirmed investments that have reached their maturity date
-        matured_investments = Investment.objects.filter(
-            is_confirmed=True,
-            status='confirmed',
-            mature_at__lte=timezone.now()
-        ).select_for_update()
-        
-        # Update each investment's status to matured
-        for investment in matured_investments:
-            investment.check_maturity()
-            
-        return f"Processed {len(matured_investments)} matured investments"
+    try:
+        matured_ids = mature_due_investments()
+        return f"Processed {len(matured_ids)} matured investments"
+    except Exception as e:
+        logger.error(f"Failed to check matured investments: {str(e)}")
+        raise
+
+@shared_task(bind=True, max_retries=3)
+def mature_bucket(self, bucket_id):
+    """Timer wheel tick: mature the investments of one minute bucket"""
+    try:
+        matured_ids = fire_bucket(bucket_id)
+    except Exception as e:
+        logger.error(f"Failed to mature bucket {bucket_id}: {str(e)}")
+        raise self.retry(exc=e, countdown=30)
+    if matured_ids is None:
+        return f"Bucket {bucket_id} is not due yet; queued again for the end of its minute"
+    return f"Processed {len(matured_ids)} matured investments"
+
+@shared_task
+def arm_maturity_buckets():
+    """Queue the ETA tasks of maturity buckets that are now within the arming horizon"""
+    try:
+        return f"Armed {arm_due_buckets()} maturity buckets"
+    except Exception as e:
+        logger.error(f"Failed to arm maturity buckets: {str(e)}")
 
 @shared_task
 def send_maturity_notification(investment_id=None):
-    """Send email notification when investment matures"""
+    """
+    Send maturity emails (and SMS to Kenyan numbers when SMS is set up),
+    either for one investment or for every matured investment not yet
+    notified. Recipients are loaded with their investments, each chunk is
+    sent concurrently by accounts.notify and the sent flags are set with
+    one UPDATE per chunk. Investments whose email failed stay unflagged
+    for the next run.
+    """
     try:
         if investment_id:
             # Handle single investment notification
@@ -50,38 +73,58 @@ def send_maturity_notification(investment_id=None):
                 status='matured',
                 maturity_notification_sent=False
             )
-        
-        for investment in investments:
-            user = investment.user
-            
-            # Prepare email content
-            subject = f'Investment Matured - {investment.id}'
-            context = {
-                'user': user,
-                'investment': investment,
-                'return_amount': investment.return_amount,
-                'maturity_date': investment.maturity_date,
-            }
-            
-            message = render_to_string('accounts/email/maturity_notification.html', context)
-            
-            # Send email
-            send_mail(
-                subject=subject,
-                message='',  # Empty message as we're using HTML
-                html_message=message,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[user.email],
-                fail_silently=False,
-            )
-            
-            # Mark notification as sent
-            investment.maturity_notification_sent = True
-            investment.save()
-            
-            logger.info(f"Sent maturity notification for investment {investment.id}")
+        investments = investments.exclude(user__email='').select_related('user').order_by('id')
+        chunk_size = getattr(settings, 'EMAIL_BATCH_SIZE', 100)
+        sms = notify.sms_enabled()
+
+        sent_total = failed_total = 0
+        last_id = 0
+        while True:
+            batch = list(investments.filter(id__gt=last_id)[:chunk_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+            notifications, owners = [], []
+            for investment in batch:
+                for notification in maturity_notifications(investment, sms):
+                    notifications.append(notification)
+                    owners.append((investment.id, notification.channel))
+            results, _ = notify.dispatch(notifications)
+            sent_ids = [investment_id for (investment_id, channel), sent in zip(owners, results)
+                        if sent and channel == 'email']
+            Investment.objects.filter(id__in=sent_ids).update(maturity_notification_sent=True)
+            sent_total += len(sent_ids)
+            failed_total += len(batch) - len(sent_ids)
+
+        logger.info(f"Sent {sent_total} maturity notifications ({failed_total} failed)")
+        return f"Sent {sent_total} maturity notifications ({failed_total} failed)"
     except Exception as e:
         logger.error(f"Failed to send maturity notification: {str(e)}")
+        raise
+
+def maturity_notifications(investment, sms=False):
+    """The maturity email, then the SMS if wanted, for an investment loaded with its user"""
+    return_amount = investment.return_amount or investment.amount
+    context = {
+        'user': investment.user,
+        'investment': investment,
+        'interest_earned': return_amount - investment.amount - investment.referral_bonus_used,
+        'referral_bonus': investment.referral_bonus_used,
+        'total_return': return_amount,
+        'statement_url': f"{settings.SITE_URL}/api/investments/{investment.id}/statement/",
+        'dashboard_url': f"{settings.SITE_URL}/dashboard",
+    }
+    notifications = [notify.Notification(
+        'email', investment.user.email,
+        subject=f'Investment Matured - {investment.id}',
+        html=render_to_string('accounts/email/investment_matured.html', context),
+    )]
+    if sms and notify.kenyan_msisdn(investment.user.phone_number):
+        notifications.append(notify.Notification(
+            'sms', investment.user.phone_number,
+            render_to_string('accounts/sms/investment_matured.txt', context).strip(),
+        ))
+    return notifications
 
 @shared_task
 def process_referral_bonus(investment_id):
@@ -94,13 +137,17 @@ def process_referral_bonus(investment_id):
             # Calculate referral bonus (3% of investment amount)
             bonus_amount = investment.amount * Decimal('0.03')
             
-            # Update referrer's earnings
-            referrer = user.referred_by
-            referrer.referral_earnings += bonus_amount
-            referrer.save()
-            
-            # Send notification
-            send_referral_bonus_notification.delay(referrer.id, investment.id, float(bonus_amount))
+            with transaction.atomic():
+                # Credit the referrer's bonus balance
+                referrer = user.referred_by
+                ledger.credit(referrer.id, bonus_amount, 'referral_bonus', f'investment:{investment.id}')
+
+                # Goes into the referrer's notification digest
+                digests.record([digests.event(referrer.id, 'referral_bonus', {
+                    'investment_id': investment.id,
+                    'referred': user.username,
+                    'amount': str(bonus_amount.quantize(Decimal('0.01'))),
+                }, identity=investment.id)])
             
             logger.info(f"Processed referral bonus for investment {investment_id}")
     except Exception as e:
@@ -108,7 +155,11 @@ def process_referral_bonus(investment_id):
 
 @shared_task
 def send_referral_bonus_notification(referrer_id, investment_id, bonus_amount):
-    """Send email notification for referral bonus"""
+    """
+    Send email notification for referral bonus. New bonuses go into the
+    referrer's notification digest (accounts.digests); this handles calls
+    already queued in the outbox.
+    """
     try:
         referrer = User.objects.get(id=referrer_id)
         investment = Investment.objects.get(id=investment_id)
@@ -136,6 +187,7 @@ def send_referral_bonus_notification(referrer_id, investment_id, bonus_amount):
         logger.info(f"Sent referral bonus notification for investment {investment_id}")
     except Exception as e:
         logger.error(f"Failed to send referral bonus notification for investment {investment_id}: {str(e)}")
+        raise
 
 @shared_task
 def generate_investment_statement(investment_id):
@@ -199,114 +251,52 @@ def calculate_daily_statistics():
         logger.error(f"Failed to calculate daily statistics: {str(e)}")
 
 @shared_task
-def run_pairing_job(**kwargs):
+def run_pairing_job(policy=None, dry_run=False, **kwargs):
     """
-    Task to match matured investments with new investments
+    Task to match matured investments with new investments.
+
+    The whole book is loaded once, matched in memory with the selected
+    matching policy (settings.PAIRING_POLICY by default) and written back
+    in a single transaction (see accounts.pairing). With ``dry_run`` the
+    matcher runs against a snapshot and a report is returned instead.
     """
     if kwargs:
         logger.warning(f"Ignoring unexpected parameters: {kwargs}")
     try:
-        # Get matured investments that haven't been paired yet
-        matured_investments = Investment.objects.filter(
-            status='matured',
-         
-        ).order_by('created_at')
-
-        # Get new investments that are pending
-        new_investments = Investment.objects.filter(
-            status='pending'
-        ).order_by('created_at')
-
-        # Process each matured investment
-        for matured in matured_investments:
-            # Initialize remaining_amount from return_amount if not set
-            if matured.remaining_amount is None:
-                remaining = matured.return_amount or matured.amount
-                # Round down to 2 decimal places
-                matured.remaining_amount = Decimal(str(round(float(remaining), 2)))
-                matured.save()
-            
-            remaining_amount = matured.remaining_amount
-            matured_paired = False
-
-            # Try to pair with new investments until return amount is exhausted
-            for new in new_investments:
-                # Skip if the new investment is from the same user as the matured investment
-                if new.user == matured.user:
-                    continue
-
-                if new.status == 'completed':
-                    continue
-
-                # Initialize remn_amount from amount if not set
-                if new.remn_amount is None:
-                    new.remn_amount = new.amount
-                    new.save()
-                new_remaining = new.remn_amount
-                
-                if remaining_amount >= new_remaining:
-                    # Full pairing of new investment
-                    new.status = 'completed'
-                    new.paired_to = matured.user
-                    
-                    # Create paired investment with the same pairing reference
-                    paired_investment = PairedInvestment.objects.create(
-                        matured_investor=matured.user,
-                        new_investor=new.user,
-                        amount_paired=new_remaining,
-                        status='paired',
-                        payment_status='pending',
-                        paired_at=timezone.now(),
-                        pairing_reference=new.pairing_reference
-                    )
-                    paired_investment.save()
-                    
-                    new.remn_amount = Decimal('0.00')
-                    new.save()
-                    
-                    remaining_amount -= new_remaining
-                    matured.remaining_amount = remaining_amount
-                    matured.save()
-                    send_pairing_notification.delay(matured.user.id, new.user.id)
-                   
-                    if remaining_amount == 0:
-                        matured.status = 'paired'
-                        matured.paired_to = new.user
-                        matured.save()
-                        matured_paired = True
-                        break
-                        
-                else:
-                    # Partial pairing based on remaining return amount
-                    matured.status = 'paired'
-                    matured.paired_to = new.user
-                    
-                    # Create paired investment with the same pairing reference
-                    paired_investment = PairedInvestment.objects.create(
-                        matured_investor=matured.user,
-                        new_investor=new.user,
-                        amount_paired=remaining_amount,
-                        status='paired',
-                        payment_status='pending',
-                        paired_at=timezone.now(),
-                        pairing_reference=new.pairing_reference
-                    )
-                    paired_investment.save()
-                    
-                    # Update the current investment amount to what was paired
-                    new.remn_amount = new_remaining - remaining_amount
-                    new.save()
-                    
-                    matured.remaining_amount = Decimal('0.00')
-                    matured.save()
-                    matured_paired = True
-                    break
-
+        if dry_run:
+            report = simulate_pairing(policy=policy, max_pairs=1000)
+            logger.info(f"Pairing dry run would create {report['pair_count']} pairings")
+            return report
+        if resident_book_enabled():
+            return "Pairing is handled by the resident order book"
+        plans = run_pairing(policy=policy)
         logger.info("Pairing job completed successfully")
+        throughput = sum(plan.throughput for plan in plans) / len(plans) if plans else 0
+        return (f"Created {sum(len(plan.pairs) for plan in plans)} pairings "
+                f"({throughput:.0f} entries/s)")
     except Exception as e:
         logger.error(f"Failed to run pairing job: {str(e)}")
         raise
 
+@shared_task(bind=True, max_retries=5)
+def pair_investments(self, matured_ids=None, pending_ids=None, policy=None):
+    """
+    Event-driven pairing for the investments that just changed: created
+    bids, newly matured investments or released pairings.
+    """
+    if resident_book_enabled():
+        return "Pairing is handled by the resident order book"
+    try:
+        plans = run_incremental_pairing(matured_ids=matured_ids, pending_ids=pending_ids,
+                                        policy=policy or getattr(settings, 'PAIRING_POLICY', None))
+        return f"Created {sum(len(plan.pairs) for plan in plans)} pairings"
+    except PairingLeaseBusy as e:
+        # Single-claimer databases: wait for the current run to finish
+        raise self.retry(exc=e, countdown=10)
+    except Exception as e:
+        logger.error(f"Failed to pair investments {matured_ids} / {pending_ids}: {str(e)}")
+        raise
+
 @shared_task
 def send_pairing_notification(matured_user_id, new_user_id):
     """Send email notifications to both users when investments are paired"""
@@ -354,78 +344,32 @@ def send_pairing_notification(matured_user_id, new_user_id):
 
 @shared_task
 def send_payment_reminders():
-    """Send payment reminders to users who need to make payments"""
+    """
+    Remind payers of pairings approaching their payment deadline and expire
+    the overdue ones (see accounts.reminders). Cheap when nothing is due.
+    """
     try:
-        # Get all pending pairings where payment is due
-        pending_pairings = Pairing.objects.filter(
-            status='pending',
-            payment_due_date__lte=timezone.now()
-        )
-        
-        for pairing in pending_pairings:
-            # Get the users involved
-            matured_user = pairing.matured_investment.user
-            new_user = pairing.new_investment_id.user
-            
-            # Send reminder to new user
-            subject = 'Payment Reminder - Investment Pairing'
-            message = render_to_string('accounts/email/payment_reminder.txt', {
-                'user': new_user,
-                'matured_user': matured_user,
-                'amount': pairing.amount_paired,
-                'due_date': pairing.payment_due_date,
-            })
-            
-            send_mail(
-                subject,
-                message,
-                settings.DEFAULT_FROM_EMAIL,
-                [new_user.email],
-                fail_silently=False,
-            )
-            
-            logger.info(f"Payment reminder sent to {new_user.email}")
-            
+        totals = sweep_payments()
+        return f"Sent {totals['reminded']} payment reminders, expired {totals['expired']} pairings"
     except Exception as e:
         logger.error(f"Error sending payment reminders: {str(e)}")
         raise
 
 @shared_task
-def check_admin_pairing():
-    """Check for admin pairing requests and process them"""
+def snapshot_bonus_balances():
+    """Fold new bonus ledger entries into the balance snapshots (see accounts.ledger)"""
     try:
-        # Get all pending pairings that need admin review
-        pending_pairings = Pairing.objects.filter(
-            status='pending',
-            is_confirmed=False
-        ).select_related(
-            'matured_investment',
-            'new_investment_id',
-            'matured_investment__user',
-            'new_investment_id__user'
-        )
-        
-        for pairing in pending_pairings:
-            # Check if payment is overdue
-            if pairing.payment_due_date and pairing.payment_due_date <= timezone.now():
-                # Update pairing status to failed
-                pairing.status = 'failed'
-                pairing.save()
-                
-                # Send notification to both users
-                send_pairing_failed_notification.delay(
-                    pairing.matured_investment.user.id,
-                    pairing.new_investment_id.user.id,
-                    pairing.id
-                )
-                
-                logger.info(f"Pairing {pairing.id} marked as failed due to overdue payment")
-            
-        logger.info("Admin pairing check completed")
+        written = ledger.take_snapshots()
+        return f"Snapshotted {written} bonus balances"
     except Exception as e:
-        logger.error(f"Error in check_admin_pairing: {str(e)}")
+        logger.error(f"Error snapshotting bonus balances: {str(e)}")
         raise
 
+@shared_task
+def check_admin_pairing():
+    """Expire pairings whose payment is overdue; the same sweep as send_payment_reminders"""
+    return send_payment_reminders()
+
 @shared_task
 def send_pairing_failed_notification(matured_user_id, new_user_id, pairing_id):
     """Send notification when a pairing fails"""
@@ -433,42 +377,62 @@ def send_pairing_failed_notification(matured_user_id, new_user_id, pairing_id):
         matured_user = User.objects.get(id=matured_user_id)
         new_user = User.objects.get(id=new_user_id)
         pairing = Pairing.objects.get(id=pairing_id)
-        
-        # Send notification to matured user
-        subject = 'Pairing Failed - Payment Overdue'
-        message = render_to_string('accounts/email/pairing_failed.txt', {
-            'user': matured_user,
-            'new_user': new_user,
-            'amount': pairing.amount_paired,
-            'due_date': pairing.payment_due_date,
-        })
-        
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [matured_user.email],
-            fail_silently=False,
-        )
-        
-        # Send notification to new user
-        subject = 'Pairing Failed - Payment Overdue'
-        message = render_to_string('accounts/email/pairing_failed.txt', {
-            'user': new_user,
-            'matured_user': matured_user,
-            'amount': pairing.amount_paired,
-            'due_date': pairing.payment_due_date,
-        })
-        
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [new_user.email],
-            fail_silently=False,
-        )
-        
+        sms = notify.sms_enabled()
+
+        # Notify both users at once
+        notifications = []
+        for user, other_user, other_key in ((matured_user, new_user, 'new_user'),
+                                            (new_user, matured_user, 'matured_user')):
+            context = {
+                'user': user,
+                other_key: other_user,
+                'other_user': other_user,
+                'amount': pairing.amount_paired,
+                'due_date': pairing.payment_due_date,
+            }
+            notifications.append(notify.Notification(
+                'email', user.email, render_to_string('accounts/email/pairing_failed.txt', context),
+                subject='Pairing Failed - Payment Overdue',
+            ))
+            if sms and notify.kenyan_msisdn(user.phone_number):
+                notifications.append(notify.Notification(
+                    'sms', user.phone_number, render_to_string('accounts/sms/pairing_failed.txt', context).strip()
+                ))
+        notify.dispatch(notifications)
+
         logger.info(f"Pairing failed notifications sent for pairing {pairing_id}")
     except Exception as e:
         logger.error(f"Error sending pairing failed notifications: {str(e)}")
-        raise 
\ No newline at end of file
+        raise 
+
+@shared_task
+def drain_outbox():
+    """Dispatch the notification calls recorded in the transactional outbox"""
+    try:
+        sent, failed = outbox.drain()
+        purged = outbox.purge_sent()
+        return f"Dispatched {sent} outbox messages ({failed} failed, {purged} purged)"
+    except Exception as e:
+        logger.error(f"Failed to drain outbox: {str(e)}")
+        raise
+
+@shared_task
+def send_user_digest(user_id):
+    """Send a user's buffered notifications now (immediate delivery or urgent events)"""
+    try:
+        sent, failed = digests.send_digests([user_id])
+        return f"Sent {sent} notification digests ({failed} failed)"
+    except Exception as e:
+        logger.error(f"Failed to send notification digest to user {user_id}: {str(e)}")
+        raise
+
+@shared_task
+def send_notification_digests():
+    """Send the digests of every user whose digest window has passed"""
+    try:
+        sent, failed = digests.flush_due()
+        purged = digests.purge_sent()
+        return f"Sent {sent} notification digests ({failed} failed, {purged} purged)"
+    except Exception as e:
+        logger.error(f"Failed to send notification digests: {str(e)}")
+        raise
@@ -0,0 +1,80 @@
+from django.core import mail
+from django.utils import timezone
+from datetime import timedelta
+from unittest import mock
+from rest_framework.test import APIClient
+from accounts import digests
+from accounts.models import NotificationEvent, OutboxMessage
+from accounts.tasks import run_pairing_job
+from accounts.tests.test_pairing_engine import PairingTestCase
+
+
+class NotificationDigestTest(PairingTestCase):
+    def bonus(self, user, investment_id, amount='30.00'):
+        return digests.event(user.id, 'referral_bonus', {
+            'investment_id': investment_id, 'referred': 'pairuser3', 'amount': amount,
+        }, identity=investment_id)
+
+    def age_events(self, seconds=3600):
+        NotificationEvent.objects.update(created_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_identical_events_are_buffered_once(self):
+        digests.record([self.bonus(self.users[0], 1), self.bonus(self.users[0], 1)])
+        digests.record([self.bonus(self.users[0], 1), self.bonus(self.users[0], 2)])
+
+        self.assertEqual(NotificationEvent.objects.count(), 2)
+        # Digest users are not queued for immediate delivery
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_window_combines_events_into_one_email(self):
+        self.create_investment(self.users[0], '900.00', 'matured', '900.00')
+        for _ in range(3):
+            self.create_investment(self.users[1], '300.00', 'pending')
+        run_pairing_job()
+        digests.record([self.bonus(self.users[0], 1), self.bonus(self.users[0], 2, '15.00')])
+
+        # Still inside the window
+        self.assertEqual(digests.flush_due(), (0, 0))
+        self.age_events()
+        self.assertEqual(digests.flush_due(), (2, 0))
+
+        self.assertEqual(len(mail.outbox), 2)
+        body = next(m for m in mail.outbox if m.to == [self.users[0].email]).alternatives[0][0]
+        self.assertIn('pairuser1', body)
+        self.assertIn('900.00', body)
+        self.assertIn('45.00', body)
+        self.assertFalse(NotificationEvent.objects.filter(sent_at__isnull=True).exists())
+        # A new identical event after sending starts a new digest
+        digests.record([self.bonus(self.users[0], 1)])
+        self.assertEqual(NotificationEvent.objects.filter(sent_at__isnull=True).count(), 1)
+
+    def test_immediate_preference_queues_digest(self):
+        self.users[0].notification_delivery = 'immediate'
+        self.users[0].save()
+
+        digests.record([self.bonus(self.users[0], 1), self.bonus(self.users[1], 1)])
+
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.task, message.args), ('accounts.tasks.send_user_digest', [self.users[0].id]))
+        self.assertEqual(digests.send_digests([self.users[0].id]), (1, 0))
+        self.assertEqual(mail.outbox[0].to, [self.users[0].email])
+
+    def test_failed_digest_returns_to_buffer(self):
+        digests.record([self.bonus(self.users[0], 1)])
+        self.age_events()
+
+        with mock.patch('accounts.notify.Dispatcher.dispatch', return_value=([False], {})):
+            self.assertEqual(digests.flush_due(), (0, 1))
+
+        self.assertTrue(NotificationEvent.objects.filter(sent_at__isnull=True).exists())
+        self.assertEqual(digests.flush_due(), (1, 0))
+
+    def test_preference_is_editable_on_profile(self):
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+
+        response = client.patch('/api/profile/', {'notification_delivery': 'immediate'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.users[0].refresh_from_db()
+        self.assertEqual(self.users[0].notification_delivery, 'immediate')
@@ -0,0 +1,87 @@
+from django.core.cache import cache
+from django.utils import timezone
+from datetime import timedelta
+import numpy as np
+from rest_framework.test import APIClient
+from accounts.forecast import liquidity_forecast, project
+from accounts.models import Investment
+from accounts.tests.test_pairing_engine import PairingTestCase
+
+
+class ProjectionTest(PairingTestCase):
+    def test_first_shortfall_day(self):
+        owed, funded, shortfall = project(np.array([0, 100, 0, 300]), 50, 100, 30)
+        self.assertEqual(list(owed), [50, 150, 150, 450])
+        self.assertEqual(list(funded), [130, 160, 190, 220])
+        self.assertEqual(shortfall, 3)
+
+    def test_no_shortfall_within_horizon(self):
+        self.assertIsNone(project(np.array([10, 10]), 0, 100, 0)[2])
+
+
+class LiquidityForecastTest(PairingTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        now = timezone.now()
+        self.confirmed(self.users[0], '1000.00', '1100.00', now + timedelta(days=2))
+        self.confirmed(self.users[1], '2000.00', '2200.00', now + timedelta(days=2))
+        self.confirmed(self.users[2], '500.00', '600.00', now + timedelta(days=4))
+        self.create_investment(self.users[3], '300.00', 'matured', '300.00')
+        bid = self.create_investment(self.users[3], '700.00', 'pending')
+        Investment.objects.filter(id=bid.id).update(created_at=now - timedelta(days=3))
+
+    def confirmed(self, user, amount, return_amount, mature_at):
+        investment = self.create_investment(user, amount, 'confirmed', return_amount)
+        Investment.objects.filter(id=investment.id).update(mature_at=mature_at, is_confirmed=True)
+        return investment
+
+    def test_payouts_are_bucketed_by_maturity_day(self):
+        forecast = liquidity_forecast(days=5)
+
+        self.assertEqual([day['payouts'] for day in forecast['days']], [0, 0, 3300.0, 0, 600.0])
+        self.assertEqual(forecast['matured_backlog'], 300.0)
+        self.assertEqual(forecast['open_bids'], 700.0)
+        self.assertEqual(forecast['daily_intake'], 50.0)
+        # Owed 3600 by day 2 against 700 + 3 * 50 funded
+        self.assertEqual(forecast['days_until_shortfall'], 2)
+        self.assertEqual(forecast['refresh']['mode'], 'full')
+
+    def test_refresh_only_reloads_dirty_days(self):
+        liquidity_forecast()
+        with self.assertNumQueries(1):
+            forecast = liquidity_forecast()
+        self.assertEqual(forecast['refresh']['days'], 0)
+
+        new = self.create_investment(self.users[3], '1000.00', 'pending', '1500.00')
+        new.start_countdown()
+        forecast = liquidity_forecast(days=10)
+
+        self.assertEqual(forecast['refresh']['mode'], 'incremental')
+        self.assertEqual(forecast['refresh']['days'], 1)
+        day = (timezone.localdate(new.mature_at) - timezone.localdate()).days
+        self.assertEqual(forecast['days'][day]['payouts'], 1500.0)
+
+    def test_maturity_moves_payout_into_backlog(self):
+        self.confirmed(self.users[0], '100.00', '150.00', timezone.now())
+        self.assertEqual(liquidity_forecast()['days'][0]['payouts'], 150.0)
+
+        from accounts.maturity import mature_due_investments
+        mature_due_investments(schedule=False)
+        forecast = liquidity_forecast()
+
+        self.assertEqual(forecast['days'][0]['payouts'], 0)
+        self.assertEqual(forecast['matured_backlog'], 450.0)
+
+    def test_endpoint_is_admin_only(self):
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+        self.assertEqual(client.get('/api/liquidity-forecast/').status_code, 403)
+
+        self.users[0].is_staff = True
+        self.users[0].save()
+        response = client.get('/api/liquidity-forecast/?days=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['days']), 3)
+        self.assertEqual(response.data['days_until_shortfall'], 2)
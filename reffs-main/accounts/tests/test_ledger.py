@@ -0,0 +1,76 @@
+from decimal import Decimal
+from rest_framework.test import APIClient
+from accounts import ledger
+from accounts.models import BonusBalanceSnapshot, BonusLedgerEntry, WithdrawHistory
+from accounts.tests.test_pairing_engine import PairingTestCase
+
+
+class BonusLedgerTest(PairingTestCase):
+    def test_balance_is_credits_less_debits(self):
+        user = self.users[0]
+        ledger.credit(user.id, Decimal('30.00'), 'referral_bonus', 'investment:1')
+        ledger.credit(user.id, Decimal('15.00'), 'referral_bonus', 'investment:2')
+        ledger.debit(user.id, Decimal('10.00'), 'withdrawal', 'withdrawal:1')
+
+        self.assertEqual(ledger.balance(user.id), Decimal('35.00'))
+        self.assertEqual(user.referral_earnings, Decimal('35.00'))
+        self.assertEqual(ledger.balance(self.users[1].id), Decimal('0.00'))
+
+    def test_snapshot_folds_entries_and_keeps_balance(self):
+        ledger.credit(self.users[0].id, Decimal('30.00'), 'referral_bonus')
+        ledger.credit(self.users[1].id, Decimal('20.00'), 'referral_bonus')
+
+        self.assertEqual(ledger.take_snapshots(), 2)
+        ledger.debit(self.users[0].id, Decimal('5.00'), 'withdrawal')
+
+        snapshot = BonusBalanceSnapshot.objects.get(user=self.users[0])
+        self.assertEqual(snapshot.balance, Decimal('30.00'))
+        with self.assertNumQueries(1):
+            self.assertEqual(ledger.balance(self.users[0].id), Decimal('25.00'))
+
+        # Only the new entry is folded, into the existing snapshot
+        self.assertEqual(ledger.take_snapshots(), 1)
+        snapshot.refresh_from_db()
+        self.assertEqual(snapshot.balance, Decimal('25.00'))
+        self.assertFalse(BonusLedgerEntry.objects.filter(snapshotted=False).exists())
+        self.assertEqual(ledger.take_snapshots(), 0)
+        self.assertEqual(ledger.balance(self.users[1].id), Decimal('20.00'))
+
+    def test_entry_committed_late_is_still_folded(self):
+        user_id = self.users[0].id
+        # An id handed out to a transaction that commits after later entries
+        held = ledger.credit(user_id, Decimal('1.00'), 'referral_bonus')
+        held.delete()
+        ledger.credit(user_id, Decimal('30.00'), 'referral_bonus')
+        ledger.take_snapshots()
+
+        BonusLedgerEntry.objects.create(id=held.id, user_id=user_id, amount=Decimal('12.00'), kind='referral_bonus')
+
+        self.assertEqual(ledger.balance(user_id), Decimal('42.00'))
+        self.assertEqual(ledger.take_snapshots(), 1)
+        self.assertEqual(BonusBalanceSnapshot.objects.get(user_id=user_id).balance, Decimal('42.00'))
+        self.assertEqual(ledger.balance(user_id), Decimal('42.00'))
+
+    def test_snapshots_are_taken_in_batches(self):
+        for i in range(5):
+            ledger.credit(self.users[i % 2].id, Decimal('10.00'), 'referral_bonus')
+
+        self.assertEqual(ledger.take_snapshots(batch_size=2), 5)
+        self.assertEqual(ledger.balance(self.users[0].id), Decimal('30.00'))
+        self.assertEqual(ledger.balance(self.users[1].id), Decimal('20.00'))
+
+    def test_withdrawal_is_a_debit(self):
+        user = self.users[0]
+        ledger.credit(user.id, Decimal('30.00'), 'referral_bonus')
+        client = APIClient()
+        client.force_authenticate(user)
+
+        response = client.post('/api/withdraw-bonus/', {'amount': '20.00'}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        response = client.post('/api/withdraw-bonus/', {'amount': '20.00'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        withdrawal = WithdrawHistory.objects.get()
+        entry = BonusLedgerEntry.objects.get(kind='withdrawal')
+        self.assertEqual((entry.amount, entry.reference), (Decimal('-20.00'), f'withdrawal:{withdrawal.id}'))
+        self.assertEqual(ledger.balance(user.id), Decimal('10.00'))
@@ -0,0 +1,276 @@
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.mail.backends import locmem
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+import json
+import os
+import smtplib
+import tempfile
+from django.test import override_settings
+from accounts.maturity import arm_due_buckets, bucket_start, fire_bucket, mature_due_investments, schedule_maturity
+from accounts.models import Investment, MaturityBucket, OutboxMessage
+from accounts.tasks import check_matured_investments, send_maturity_notification
+from accounts.tests.test_pairing_engine import PairingTestCase
+
+
+class MaturityTestCase(PairingTestCase):
+    def create_confirmed(self, user, mature_in):
+        investment = self.create_investment(user, '1000.00', 'confirmed')
+        Investment.objects.filter(id=investment.id).update(
+            is_confirmed=True, mature_at=timezone.now() + mature_in
+        )
+        return investment
+
+
+class BulkMaturityTest(MaturityTestCase):
+    def test_only_due_confirmed_investments_mature(self):
+        due = [self.create_confirmed(self.users[i], timedelta(minutes=-5)) for i in range(3)]
+        later = self.create_confirmed(self.users[3], timedelta(days=1))
+        unconfirmed = self.create_investment(self.users[3], '500.00', 'pending')
+
+        with mock.patch('accounts.maturity.schedule_pairing'):
+            matured_ids = mature_due_investments()
+
+        self.assertEqual(matured_ids, [investment.id for investment in due])
+        self.assertEqual(
+            set(Investment.objects.filter(status='matured').values_list('id', flat=True)),
+            set(matured_ids)
+        )
+        later.refresh_from_db()
+        unconfirmed.refresh_from_db()
+        self.assertEqual(later.status, 'confirmed')
+        self.assertEqual(unconfirmed.status, 'pending')
+
+    def test_backlog_is_processed_in_chunks(self):
+        due = [self.create_confirmed(self.users[i % 4], timedelta(hours=-1)) for i in range(5)]
+
+        with mock.patch('accounts.maturity.schedule_pairing') as schedule:
+            matured_ids = mature_due_investments(chunk_size=2)
+
+        self.assertEqual(len(matured_ids), 5)
+        self.assertEqual(
+            [call.kwargs['matured_ids'] for call in schedule.call_args_list],
+            [[due[0].id, due[1].id], [due[2].id, due[3].id], [due[4].id]]
+        )
+
+    def test_chunk_is_one_select_and_one_update(self):
+        for i in range(3):
+            self.create_confirmed(self.users[i], timedelta(hours=-1))
+
+        # SAVEPOINT, SELECT ids, UPDATE, outbox INSERT, RELEASE
+        with mock.patch('accounts.maturity.schedule_pairing'), self.assertNumQueries(5):
+            mature_due_investments()
+
+    def test_task_reports_count(self):
+        self.create_confirmed(self.users[0], timedelta(minutes=-1))
+
+        with mock.patch('accounts.maturity.schedule_pairing') as schedule:
+            result = check_matured_investments()
+
+        self.assertEqual(result, 'Processed 1 matured investments')
+        schedule.assert_called_once()
+        self.assertTrue(OutboxMessage.objects.filter(task='accounts.tasks.send_maturity_notification').exists())
+
+    def test_check_maturity_on_single_investment(self):
+        investment = self.create_confirmed(self.users[0], timedelta(minutes=-1))
+        investment.refresh_from_db()
+
+        with mock.patch('accounts.pairing.schedule_pairing'):
+            self.assertTrue(investment.check_maturity())
+
+        investment.refresh_from_db()
+        self.assertEqual(investment.status, 'matured')
+
+
+class TimerWheelTest(MaturityTestCase):
+    def test_one_task_per_bucket(self):
+        minute = bucket_start(timezone.now() + timedelta(minutes=10))
+
+        with mock.patch('accounts.tasks.mature_bucket.apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                for seconds in (5, 30, 59):
+                    schedule_maturity(minute + timedelta(seconds=seconds))
+
+        self.assertEqual(MaturityBucket.objects.count(), 1)
+        apply_async.assert_called_once()
+        self.assertEqual(apply_async.call_args.kwargs['eta'], minute + timedelta(minutes=1))
+
+    def test_distant_buckets_are_armed_when_they_come_into_range(self):
+        with mock.patch('accounts.tasks.mature_bucket.apply_async') as apply_async:
+            schedule_maturity(timezone.now() + timedelta(days=2))
+            self.assertEqual(arm_due_buckets(), 0)
+            with override_settings(MATURITY_ARM_HORIZON=3 * 86400), \
+                    self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(arm_due_buckets(), 1)
+                self.assertEqual(arm_due_buckets(), 0)
+
+        apply_async.assert_called_once()
+
+    def test_start_countdown_registers_bucket(self):
+        investment = self.create_investment(self.users[0], '1000.00', 'pending')
+
+        investment.start_countdown()
+
+        self.assertTrue(MaturityBucket.objects.filter(bucket=bucket_start(investment.mature_at)).exists())
+
+    def test_firing_matures_only_that_bucket(self):
+        in_bucket = [self.create_confirmed(self.users[i], timedelta(minutes=-3)) for i in range(2)]
+        other = self.create_confirmed(self.users[2], timedelta(minutes=-10))
+        in_bucket[1].refresh_from_db()
+        Investment.objects.filter(id=in_bucket[0].id).update(mature_at=in_bucket[1].mature_at)
+        bucket = MaturityBucket.objects.create(bucket=bucket_start(in_bucket[1].mature_at))
+
+        with mock.patch('accounts.maturity.schedule_pairing'):
+            matured_ids = fire_bucket(bucket.id)
+
+        self.assertEqual(sorted(matured_ids), sorted(investment.id for investment in in_bucket))
+        other.refresh_from_db()
+        self.assertEqual(other.status, 'confirmed')
+        bucket.refresh_from_db()
+        self.assertIsNotNone(bucket.fired_at)
+        self.assertEqual(fire_bucket(bucket.id), [])
+
+    def test_early_delivery_is_deferred(self):
+        bucket = MaturityBucket.objects.create(bucket=bucket_start(timezone.now() + timedelta(minutes=5)))
+
+        with mock.patch('accounts.tasks.mature_bucket.apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertIsNone(fire_bucket(bucket.id))
+
+        # A fresh tick for the end of the minute, however early the delivery
+        apply_async.assert_called_once_with(args=[bucket.id], eta=bucket.bucket + timedelta(minutes=1))
+
+    def test_fired_bucket_is_rearmed_for_a_late_countdown(self):
+        investment = self.create_confirmed(self.users[0], timedelta(minutes=-3))
+        investment.refresh_from_db()
+        minute = bucket_start(investment.mature_at)
+        bucket = MaturityBucket.objects.create(
+            bucket=minute, armed_at=minute - timedelta(minutes=30), fired_at=minute + timedelta(minutes=1)
+        )
+
+        with mock.patch('accounts.tasks.mature_bucket.apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                schedule_maturity(investment.mature_at)
+
+        apply_async.assert_called_once_with(args=[bucket.id], eta=minute + timedelta(minutes=1))
+        with mock.patch('accounts.maturity.schedule_pairing'):
+            self.assertEqual(fire_bucket(bucket.id), [investment.id])
+
+    def test_rearm_during_a_tick_keeps_the_bucket_unfired(self):
+        investment = self.create_confirmed(self.users[0], timedelta(minutes=-3))
+        investment.refresh_from_db()
+        bucket = MaturityBucket.objects.create(bucket=bucket_start(investment.mature_at), armed_at=timezone.now())
+
+        def late_countdown(*args, **kwargs):
+            with mock.patch('accounts.tasks.mature_bucket.apply_async'):
+                schedule_maturity(investment.mature_at)
+            return [investment.id]
+
+        with mock.patch('accounts.maturity.mature_due_investments', side_effect=late_countdown):
+            fire_bucket(bucket.id)
+
+        bucket.refresh_from_db()
+        self.assertIsNone(bucket.fired_at)
+
+
+class CheckMaturedCommandTest(MaturityTestCase):
+    def setUp(self):
+        super().setUp()
+        fd, self.state_file = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(self.state_file)
+        self.addCleanup(lambda: os.path.exists(self.state_file) and os.remove(self.state_file))
+
+    def run_command(self, *args):
+        out = StringIO()
+        with mock.patch('accounts.management.commands.check_matured_investments.schedule_pairing'):
+            call_command('check_matured_investments', '--state-file', self.state_file, *args, stdout=out)
+        return out.getvalue()
+
+    def test_matures_in_batches_with_progress(self):
+        for i in range(5):
+            self.create_confirmed(self.users[i % 4], timedelta(hours=-1))
+        self.create_confirmed(self.users[0], timedelta(hours=1))
+
+        output = self.run_command('--batch-size', '2')
+
+        self.assertEqual(Investment.objects.filter(status='matured').count(), 5)
+        self.assertIn('5/5 matured', output)
+        self.assertEqual(output.count('checkpoint id'), 3)
+        self.assertFalse(os.path.exists(self.state_file))
+
+    def test_since_watermark(self):
+        old = self.create_confirmed(self.users[0], timedelta(days=-3))
+        recent = self.create_confirmed(self.users[1], timedelta(hours=-1))
+
+        self.run_command('--since', (timezone.now() - timedelta(days=1)).isoformat())
+
+        old.refresh_from_db()
+        recent.refresh_from_db()
+        self.assertEqual(old.status, 'confirmed')
+        self.assertEqual(recent.status, 'matured')
+
+    def test_resume_continues_after_checkpoint(self):
+        due = [self.create_confirmed(self.users[i], timedelta(hours=-1)) for i in range(3)]
+        with open(self.state_file, 'w') as f:
+            json.dump({'until': timezone.now().isoformat(), 'since': None,
+                       'after_id': due[0].id, 'matured': 1}, f)
+
+        output = self.run_command('--resume')
+
+        self.assertEqual(
+            set(Investment.objects.filter(status='matured').values_list('id', flat=True)),
+            {due[1].id, due[2].id}
+        )
+        self.assertIn('Matured 3 investments', output)
+
+    def test_resume_without_checkpoint(self):
+        with self.assertRaises(CommandError):
+            self.run_command('--resume')
+
+
+class MaturityNotificationTest(MaturityTestCase):
+    def setUp(self):
+        super().setUp()
+        self.investments = [
+            self.create_investment(self.users[i], '1000.00', 'matured', '1100.00') for i in range(4)
+        ]
+
+    def test_connections_are_pooled_per_chunk(self):
+        with override_settings(EMAIL_BATCH_SIZE=2, NOTIFICATION_CONCURRENCY=1), \
+                mock.patch('accounts.mailing.get_connection', wraps=get_connection) as connect:
+            result = send_maturity_notification()
+
+        self.assertEqual(result, 'Sent 4 maturity notifications (0 failed)')
+        self.assertEqual(connect.call_count, 2)
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertIn('Investment Matured', mail.outbox[0].subject)
+        self.assertFalse(Investment.objects.filter(maturity_notification_sent=False).exists())
+
+    def test_failed_message_does_not_abort_batch(self):
+        bad_address = self.users[1].email
+        real_send = locmem.EmailBackend.send_messages
+
+        def send_messages(backend, messages):
+            if messages[0].to == [bad_address]:
+                raise smtplib.SMTPRecipientsRefused({bad_address: (550, b'No such user')})
+            return real_send(backend, messages)
+
+        with mock.patch.object(locmem.EmailBackend, 'send_messages', send_messages):
+            result = send_maturity_notification()
+
+        self.assertEqual(result, 'Sent 3 maturity notifications (1 failed)')
+        self.assertEqual(
+            list(Investment.objects.filter(maturity_notification_sent=False).values_list('id', flat=True)),
+            [self.investments[1].id]
+        )
+
+    def test_users_are_loaded_with_their_investments(self):
+        # One SELECT for the chunk, one for the empty next page, one UPDATE
+        with self.assertNumQueries(3):
+            send_maturity_notification()
@@ -0,0 +1,101 @@
+import asyncio
+import time
+from django.core import mail
+from django.test import TestCase, override_settings
+from accounts import notify
+from accounts.notify import Dispatcher, LocalChannel, Notification, kenyan_msisdn
+from accounts.tasks import send_maturity_notification
+from accounts.tests.test_pairing_engine import PairingTestCase
+
+LOCAL_CHANNELS = {
+    'email': 'accounts.notify.EmailChannel',
+    'sms': 'accounts.notify.LocalChannel',
+}
+
+
+class TrackingChannel(LocalChannel):
+    """Records the most sends in flight at once; fails for 'bad' recipients"""
+
+    def __init__(self, name='local', latency=0.02):
+        super().__init__(name, latency)
+        self.in_flight = self.max_in_flight = 0
+
+    async def send(self, notification):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            if notification.recipient == 'bad':
+                raise ConnectionError('provider down')
+        finally:
+            self.in_flight -= 1
+
+
+class DispatcherTest(TestCase):
+    def notifications(self, count, channel='local'):
+        return [Notification(channel, f'user{i}', 'hello') for i in range(count)]
+
+    def test_sends_concurrently_under_the_semaphore(self):
+        channel = TrackingChannel(latency=0.05)
+        started = time.perf_counter()
+        results, report = Dispatcher({'local': channel}, concurrency=10).dispatch(self.notifications(40))
+
+        self.assertEqual(results, [True] * 40)
+        self.assertEqual(channel.max_in_flight, 10)
+        # Four rounds of 50ms, not forty
+        self.assertLess(time.perf_counter() - started, 1.0)
+        self.assertEqual(report['local']['sent'], 40)
+        self.assertGreaterEqual(report['local']['latency_p50_ms'], 50)
+
+    def test_provider_rate_limit(self):
+        channel = TrackingChannel(latency=0)
+        started = time.perf_counter()
+        Dispatcher({'local': channel}, concurrency=50, rate_limits={'local': 20}).dispatch(self.notifications(30))
+
+        # A burst of 20, then 10 more at 20/s
+        self.assertGreaterEqual(time.perf_counter() - started, 0.45)
+
+    def test_failures_are_isolated_and_reported(self):
+        notifications = self.notifications(3)
+        notifications[1].recipient = 'bad'
+        notifications.append(Notification('fax', 'user9', 'hello'))
+
+        results, report = Dispatcher({'local': TrackingChannel()}).dispatch(notifications)
+
+        self.assertEqual(results, [True, False, True, False])
+        self.assertEqual((report['local']['sent'], report['local']['failed']), (2, 1))
+
+
+class KenyanNumberTest(TestCase):
+    def test_normalises_local_and_international_forms(self):
+        for number in ('0712345678', '712345678', '254712345678', '+254 712-345-678', '0112345678'):
+            self.assertIn(kenyan_msisdn(number), ('+254712345678', '+254112345678'))
+        self.assertIsNone(kenyan_msisdn('+14155550100'))
+        self.assertIsNone(kenyan_msisdn(''))
+
+
+@override_settings(NOTIFICATION_CHANNELS=LOCAL_CHANNELS)
+class NotificationTaskTest(PairingTestCase):
+    def setUp(self):
+        super().setUp()
+        LocalChannel.sent = []
+        self.addCleanup(setattr, LocalChannel, 'sent', [])
+
+    def test_maturity_notification_sends_email_and_sms(self):
+        investment = self.create_investment(self.users[0], '1000.00', 'matured', '1100.00')
+
+        self.assertEqual(send_maturity_notification(), 'Sent 1 maturity notifications (0 failed)')
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual([sms.recipient for sms in LocalChannel.sent], [self.users[0].phone_number])
+        self.assertIn(f'#{investment.id}', LocalChannel.sent[0].body)
+
+    @override_settings(NOTIFICATION_CHANNELS={'email': 'accounts.notify.EmailChannel'})
+    def test_sms_is_skipped_when_not_configured(self):
+        self.create_investment(self.users[0], '1000.00', 'matured', '1100.00')
+
+        send_maturity_notification()
+
+        self.assertFalse(notify.sms_enabled())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(LocalChannel.sent, [])
@@ -0,0 +1,176 @@
+from decimal import Decimal
+from unittest import mock
+import shutil
+import tempfile
+import numpy as np
+from django.db.models import F
+from django.test import override_settings
+from accounts.matching import get_policy
+from accounts.models import Investment, PairedInvestment
+from accounts.orderbook import RESIDENT_LEASE, OrderBookService, ResidentBook, WriteAheadLog, row_record
+from accounts.pairing import acquire_lease, load_book, schedule_pairing
+from accounts.tasks import pair_investments, run_pairing_job
+from accounts.tests.test_pairing_engine import PairingTestCase
+
+
+class OrderBookTestCase(PairingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+
+    def start_service(self):
+        service = OrderBookService(self.data_dir, policy='fifo')
+        service.start()
+        self.addCleanup(service.wal.close)
+        return service
+
+
+class ResidentBookTest(OrderBookTestCase):
+    def test_policies_match_the_database_book(self):
+        for i in range(3):
+            self.create_investment(self.users[i], '300.00', 'matured', '330.00')
+        for i in range(8):
+            self.create_investment(self.users[(i + 1) % 4], '150.00', 'pending')
+        db_book = load_book()
+        resident = ResidentBook()
+        for investment in list(db_book.matured) + list(db_book.pending):
+            resident.apply(row_record(investment))
+
+        for name in ('fifo', 'oldest_matured', 'largest_first', 'best_fit'):
+            expected = [
+                (db_book.matured[mi].id, db_book.pending[ni].id, cents)
+                for mi, ni, cents in get_policy(name).allocate(db_book)
+            ]
+            self.assertEqual(resident.match(get_policy(name)), expected, name)
+
+    def test_snapshot_round_trip(self):
+        book = ResidentBook()
+        book.apply({'op': 'upsert', 'side': 'pending', 'id': 2, 'user': 7, 'cents': 500, 'created': 20})
+        book.apply({'op': 'upsert', 'side': 'pending', 'id': 1, 'user': 8, 'cents': 300, 'created': 10})
+        book.apply({'op': 'upsert', 'side': 'matured', 'id': 3, 'user': 9, 'cents': 0, 'created': 5})
+        book.seq = 42
+        book.save(f'{self.data_dir}/book.npz')
+
+        loaded = ResidentBook.load(f'{self.data_dir}/book.npz')
+        self.assertEqual(loaded.seq, 42)
+        self.assertEqual(list(loaded.pending.ids), [1, 2])
+        self.assertEqual(list(loaded.pending_cents), [300, 500])
+        self.assertEqual(len(loaded.matured), 0)
+
+    def test_row_record_times_share_one_unit(self):
+        matured = self.create_investment(self.users[0], '500.00', 'matured', '500.00')
+        Investment.objects.filter(id=matured.id).update(mature_at=F('created_at'))
+        matured.refresh_from_db()
+
+        record = row_record(matured)
+        self.assertEqual(record['mature_at'], record['created'])
+
+
+class OrderBookServiceTest(OrderBookTestCase):
+    def test_cold_start_pairs_the_open_book(self):
+        matured = self.create_investment(self.users[0], '500.00', 'matured', '550.00')
+        bid = self.create_investment(self.users[1], '550.00', 'pending')
+
+        service = self.start_service()
+        plan = service.pair()
+
+        self.assertEqual(len(plan.pairs), 1)
+        matured.refresh_from_db()
+        bid.refresh_from_db()
+        self.assertEqual(matured.status, 'paired')
+        self.assertEqual(bid.status, 'completed')
+        self.assertEqual(len(service.book.matured), 0)
+        self.assertEqual(len(service.book.pending), 0)
+
+    def test_events_pair_new_bids(self):
+        matured = self.create_investment(self.users[0], '500.00', 'matured', '600.00')
+        service = self.start_service()
+        self.assertIsNone(service.pair())
+
+        bid = self.create_investment(self.users[1], '200.00', 'pending')
+        service.handle([bid.id])
+
+        matured.refresh_from_db()
+        self.assertEqual(matured.remaining_amount, Decimal('400.00'))
+        self.assertEqual(service.book.matured.open_cents(matured.id), 40000)
+        self.assertTrue(PairedInvestment.objects.filter(amount_paired=Decimal('200.00')).exists())
+
+    def test_restart_replays_log_without_reading_the_database(self):
+        matured = self.create_investment(self.users[0], '500.00', 'matured', '600.00')
+        service = self.start_service()
+        bid = self.create_investment(self.users[1], '200.00', 'pending')
+        service.handle([bid.id])
+        service.wal.close()
+
+        with self.assertNumQueries(0):
+            restarted = self.start_service()
+        self.assertEqual(restarted.book.matured.open_cents(matured.id), 40000)
+        self.assertIsNone(restarted.book.pending.open_cents(bid.id))
+
+    def test_snapshot_in_an_older_layout_is_reread_from_the_database(self):
+        matured = self.create_investment(self.users[0], '500.00', 'matured', '600.00')
+        np.savez(f'{self.data_dir}/book.npz', seq=np.array([7]))
+
+        service = self.start_service()
+
+        self.assertEqual(service.book.matured.open_cents(matured.id), 60000)
+        self.assertIsNotNone(ResidentBook.load(service.snapshot_path))
+
+    def test_failed_start_is_not_masked_on_the_way_out(self):
+        service = OrderBookService(self.data_dir, policy='fifo', queue=mock.Mock())
+        with mock.patch.object(service, 'start', side_effect=ValueError('bad snapshot')):
+            with self.assertRaisesMessage(ValueError, 'bad snapshot'):
+                service.run(once=True)
+
+        self.assertTrue(acquire_lease(RESIDENT_LEASE, 'other-service'))
+
+    def test_uncommitted_match_is_reread_on_restart(self):
+        matured = self.create_investment(self.users[0], '500.00', 'matured', '600.00')
+        bid = self.create_investment(self.users[1], '200.00', 'pending')
+        service = self.start_service()
+        # Crash after logging the match but before the database write
+        service.log([{'op': 'match', 'allocations': [[matured.id, bid.id, 20000]]}])
+        service.wal.close()
+
+        restarted = self.start_service()
+        self.assertEqual(restarted.book.matured.open_cents(matured.id), 60000)
+        self.assertEqual(restarted.book.pending.open_cents(bid.id), 20000)
+        records = WriteAheadLog.read(restarted.wal_path)
+        self.assertEqual(records[-1]['op'], 'upsert')
+
+    def test_rows_changed_elsewhere_are_not_written(self):
+        matured = self.create_investment(self.users[0], '500.00', 'matured', '600.00')
+        bid = self.create_investment(self.users[1], '200.00', 'pending')
+        service = self.start_service()
+        Investment.objects.filter(id=bid.id).update(remn_amount=Decimal('50.00'))
+
+        self.assertIsNone(service.pair())
+        self.assertFalse(PairedInvestment.objects.exists())
+        self.assertEqual(service.book.pending.open_cents(bid.id), 5000)
+
+        plan = service.pair()
+        self.assertEqual(plan.total_paired, Decimal('50.00'))
+        matured.refresh_from_db()
+        self.assertEqual(matured.remaining_amount, Decimal('550.00'))
+
+
+@override_settings(PAIRING_ENGINE='resident')
+class ResidentEngineRoutingTest(PairingTestCase):
+    def test_events_go_to_the_order_book(self):
+        with mock.patch('accounts.orderbook.publish_book_events') as publish, \
+                mock.patch('accounts.tasks.pair_investments.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                schedule_pairing(matured_ids=[1], pending_ids=[2])
+
+        publish.assert_called_once_with([1, 2])
+        delay.assert_not_called()
+
+    def test_celery_pairing_stands_down(self):
+        self.create_investment(self.users[0], '500.00', 'matured', '500.00')
+        self.create_investment(self.users[1], '500.00', 'pending')
+
+        run_pairing_job()
+        pair_investments(pending_ids=[1])
+
+        self.assertFalse(PairedInvestment.objects.exists())
@@ -0,0 +1,101 @@
+from django.core import mail
+from django.db import IntegrityError, transaction
+from django.test import override_settings
+from django.utils import timezone
+from decimal import Decimal
+from unittest import mock
+from accounts import outbox, tasks
+from accounts.models import OutboxMessage
+from accounts.tasks import process_referral_bonus
+from accounts.tests.test_pairing_engine import PairingTestCase
+
+
+class OutboxTest(PairingTestCase):
+    def test_rolled_back_change_leaves_no_message(self):
+        try:
+            with transaction.atomic():
+                outbox.enqueue('accounts.tasks.send_maturity_notification')
+                raise RuntimeError('rollback')
+        except RuntimeError:
+            pass
+
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_immediate_referral_bonus_is_recorded_not_queued(self):
+        self.users[0].notification_delivery = 'immediate'
+        self.users[0].save()
+        self.users[1].referred_by = self.users[0]
+        self.users[1].save()
+        investment = self.create_investment(self.users[1], '1000.00', 'pending')
+
+        with mock.patch('accounts.tasks.send_user_digest.delay') as delay:
+            process_referral_bonus(investment.id)
+
+        delay.assert_not_called()
+        self.users[0].refresh_from_db()
+        self.assertEqual(self.users[0].referral_earnings, Decimal('30.00'))
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.task, 'accounts.tasks.send_user_digest')
+        self.assertEqual(message.args, [self.users[0].id])
+
+    def test_identical_calls_are_dispatched_once(self):
+        outbox.enqueue('accounts.tasks.send_maturity_notification')
+        outbox.enqueue('accounts.tasks.send_maturity_notification')
+        outbox.enqueue('accounts.tasks.send_user_digest', self.users[0].id)
+
+        with mock.patch('celery.app.task.Task.apply_async') as apply_async:
+            self.assertEqual(outbox.drain(), (2, 0))
+
+        self.assertEqual(apply_async.call_count, 2)
+        self.assertFalse(OutboxMessage.objects.filter(sent_at__isnull=True).exists())
+
+    def test_failed_dispatch_backs_off(self):
+        outbox.enqueue('accounts.tasks.send_maturity_notification')
+
+        with mock.patch('celery.app.task.Task.apply_async', side_effect=ConnectionError('broker down')):
+            self.assertEqual(outbox.drain(), (0, 1))
+
+        message = OutboxMessage.objects.get()
+        self.assertIsNone(message.sent_at)
+        self.assertEqual(message.attempts, 1)
+        self.assertIn('broker down', message.last_error)
+        self.assertGreater(message.available_at, timezone.now())
+        # Not due again until the backoff has passed
+        self.assertEqual(outbox.drain(), (0, 0))
+
+    @override_settings(OUTBOX_DELIVERY='direct')
+    def test_direct_delivery_runs_the_task(self):
+        self.create_investment(self.users[0], '400.00', 'matured', '400.00')
+        outbox.enqueue('accounts.tasks.send_maturity_notification')
+
+        self.assertEqual(outbox.drain(), (1, 0))
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.users[0].email])
+        self.assertIsNotNone(OutboxMessage.objects.get().sent_at)
+
+    @override_settings(OUTBOX_DELIVERY='direct')
+    def test_failed_direct_task_rolls_back_only_its_own_writes(self):
+        investment = self.create_investment(self.users[0], '500.00', 'matured', '500.00')
+        outbox.enqueue('accounts.tasks.send_referral_bonus_notification', self.users[0].id, investment.id, '15.00')
+        outbox.enqueue('accounts.tasks.send_maturity_notification')
+
+        render = tasks.render_to_string
+
+        def fail_after_write(template, context):
+            if template != 'accounts/email/referral_bonus_notification.html':
+                return render(template, context)
+            OutboxMessage.objects.create(task='partial', dedupe_key='partial')
+            raise IntegrityError('constraint failed')
+
+        with mock.patch('accounts.tasks.render_to_string', side_effect=fail_after_write):
+            self.assertEqual(outbox.drain(), (1, 1))
+
+        self.assertFalse(OutboxMessage.objects.filter(task='partial').exists())
+        failed = OutboxMessage.objects.get(task='accounts.tasks.send_referral_bonus_notification')
+        self.assertEqual((failed.sent_at, failed.attempts), (None, 1))
+        self.assertIn('constraint failed', failed.last_error)
+        self.assertGreater(failed.available_at, timezone.now())
+        investment.refresh_from_db()
+        self.assertTrue(investment.maturity_notification_sent)
+        self.assertIsNotNone(OutboxMessage.objects.get(task='accounts.tasks.send_maturity_notification').sent_at)
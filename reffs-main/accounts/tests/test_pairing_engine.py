@@ -0,0 +1,441 @@
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from io import StringIO
+import json
+import os
+import random
+import tempfile
+from django.core.management import CommandError, call_command
+from accounts.matching import MinFragmentsPolicy, fifo_allocate, fifo_allocate_vectorized, get_policy
+from accounts.models import User, Investment, NotificationEvent, PairedInvestment, PairingLease
+from accounts.pairing import (
+    PairingBook, PairingLeaseBusy, SINGLE_CLAIMER_LEASE, SWEEP_LEASE, acquire_lease, load_slice,
+    pairing_lease, release_lease, run_incremental_pairing, run_pairing, simulate_pairing,
+    supports_skip_locked
+)
+from accounts.tasks import run_pairing_job
+
+
+class FifoAllocateTest(TestCase):
+    def test_splits_across_bids_in_order(self):
+        allocations = fifo_allocate([500], [1], [200, 200, 200], [2, 3, 4])
+        self.assertEqual(allocations, [(0, 0, 200), (0, 1, 200), (0, 2, 100)])
+
+    def test_skips_same_user_bids(self):
+        allocations = fifo_allocate([300, 300], [1, 2], [100, 300], [1, 1])
+        self.assertEqual(allocations, [(1, 0, 100), (1, 1, 200)])
+
+    def test_partial_bid_stays_open_for_next_matured(self):
+        allocations = fifo_allocate([100, 100], [1, 2], [150], [3])
+        self.assertEqual(allocations, [(0, 0, 100), (1, 0, 50)])
+
+
+class VectorizedFifoTest(TestCase):
+    def assertMatchesReference(self, *args, **kwargs):
+        self.assertEqual(
+            fifo_allocate_vectorized(*args, **kwargs),
+            fifo_allocate(*args, **kwargs)
+        )
+
+    def test_conflict_free_merge(self):
+        self.assertMatchesReference([500, 300], [1, 2], [200, 200, 500], [3, 4, 5])
+
+    def test_same_user_conflicts(self):
+        self.assertMatchesReference([300, 300, 100], [1, 2, 1], [100, 300, 50, 400], [1, 1, 2, 3])
+
+    def test_empty_sides(self):
+        self.assertMatchesReference([], [], [100], [1])
+        self.assertMatchesReference([100], [1], [], [])
+
+    def test_random_books_match_reference(self):
+        rng = random.Random(42)
+        for _ in range(300):
+            users = rng.randint(1, 5)
+            matured = [rng.randint(0, 3000000) for _ in range(rng.randint(0, 40))]
+            pending = [rng.randint(0, 3000000) for _ in range(rng.randint(0, 40))]
+            matured_users = [rng.randint(1, users) for _ in matured]
+            pending_users = [rng.randint(1, users) for _ in pending]
+            order = list(range(len(matured)))
+            rng.shuffle(order)
+            self.assertMatchesReference(matured, matured_users, pending, pending_users)
+            self.assertMatchesReference(matured, matured_users, pending, pending_users,
+                                        matured_order=order)
+
+    def test_merge_resumes_across_windows(self):
+        rng = random.Random(7)
+        for window in (1, 2, 5):
+            with mock.patch('accounts.matching.MERGE_WINDOW', window):
+                for _ in range(100):
+                    matured = [rng.randint(0, 5000) for _ in range(rng.randint(20, 120))]
+                    pending = [rng.randint(0, 5000) for _ in range(rng.randint(20, 120))]
+                    matured_users = [rng.randint(1, 3) for _ in matured]
+                    pending_users = [rng.randint(1, 3) for _ in pending]
+                    self.assertMatchesReference(matured, matured_users, pending, pending_users)
+
+
+class FakeInvestment:
+    def __init__(self, user_id, amount, mature_at=None, created_at=None):
+        self.user_id = user_id
+        self.amount = Decimal(amount)
+        self.return_amount = Decimal(amount)
+        self.remaining_amount = None
+        self.remn_amount = None
+        self.mature_at = mature_at
+        self.created_at = created_at
+
+
+def make_book(matured, pending):
+    return PairingBook(
+        [FakeInvestment(user_id, amount, mature_at) for user_id, amount, mature_at in matured],
+        [FakeInvestment(*bid[:2], created_at=bid[2] if len(bid) > 2 else None) for bid in pending],
+    )
+
+
+class MatchingPolicyTest(TestCase):
+    def test_best_fit_prefers_exact_fit_over_older_bids(self):
+        book = make_book([(1, '500.00', None)], [(2, '200.00'), (3, '300.00'), (4, '500.00')])
+        self.assertEqual(get_policy('best_fit').allocate(book), [(0, 2, 50000)])
+
+    def test_best_fit_skips_same_user(self):
+        book = make_book([(1, '500.00', None)], [(1, '500.00'), (3, '600.00')])
+        self.assertEqual(get_policy('best_fit').allocate(book), [(0, 1, 50000)])
+
+    def test_largest_first_uses_largest_bids(self):
+        book = make_book([(1, '700.00', None)], [(2, '100.00'), (3, '400.00'), (4, '350.00')])
+        self.assertEqual(get_policy('largest_first').allocate(book), [(0, 1, 40000), (0, 2, 30000)])
+
+    def test_oldest_matured_first_orders_by_maturity(self):
+        now = timezone.now()
+        book = make_book(
+            [(1, '100.00', now), (2, '100.00', now - timedelta(days=1))],
+            [(3, '100.00')]
+        )
+        self.assertEqual(get_policy('oldest_matured').allocate(book), [(1, 0, 10000)])
+
+    def test_policies_conserve_amounts(self):
+        book = make_book(
+            [(1, '350.00', None), (2, '120.00', None), (3, '900.00', None)],
+            [(1, '200.00'), (2, '300.00'), (4, '150.00'), (5, '700.00')]
+        )
+        for name in ('fifo', 'oldest_matured', 'largest_first', 'best_fit', 'min_fragments'):
+            allocations = get_policy(name).allocate(book)
+            total = sum(cents for _, _, cents in allocations)
+            self.assertEqual(total, 135000, name)
+            for mi, ni, _ in allocations:
+                self.assertNotEqual(book.matured_users[mi], book.pending_users[ni], name)
+
+    def test_min_fragments_tops_up_largest_bid_with_exact_fit(self):
+        book = make_book(
+            [(1, '1000.00', None)],
+            [(2, '100.00'), (3, '250.00'), (4, '450.00'), (5, '300.00'), (6, '550.00')]
+        )
+        self.assertEqual(get_policy('min_fragments').allocate(book), [(0, 4, 55000), (0, 2, 45000)])
+
+    def test_min_fragments_splits_one_bid_over_many(self):
+        book = make_book([(1, '500.00', None)], [(2, '100.00'), (3, '200.00'), (4, '900.00')])
+        self.assertEqual(get_policy('min_fragments').allocate(book), [(0, 2, 50000)])
+
+    def test_min_fragments_serves_overdue_bids_first(self):
+        old = timezone.now() - timedelta(days=3)
+        book = make_book([(1, '500.00', None)], [(2, '100.00', old), (3, '500.00')])
+        allocations = MinFragmentsPolicy(max_wait=86400).allocate(book)
+        self.assertEqual(allocations, [(0, 0, 10000), (0, 1, 40000)])
+
+    def test_min_fragments_cuts_fragments_on_random_books(self):
+        rng = random.Random(7)
+        matured = [(i, f'{rng.randint(50, 300) * 100}.00', None) for i in range(40)]
+        pending = [(100 + i, f'{rng.choice([100, 200, 500, 1000, 2500])}.00') for i in range(600)]
+        book = make_book(matured, pending)
+        fifo = get_policy('fifo').allocate(book)
+        fewer = get_policy('min_fragments').allocate(book)
+        self.assertEqual(sum(c for _, _, c in fifo), sum(c for _, _, c in fewer))
+        self.assertLess(len(fewer), len(fifo))
+        # Nothing is overdue, so this is plain best fit
+        self.assertEqual(fewer, get_policy('best_fit').allocate(book))
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            get_policy('random')
+
+
+class PairingFixtures:
+    def setUp(self):
+        self.users = [
+            User.objects.create_user(
+                username=f'pairuser{i}',
+                email=f'pair{i}@example.com',
+                phone_number=f'07000000{i:02d}',
+                password='testpass123'
+            )
+            for i in range(4)
+        ]
+
+    def create_investment(self, user, amount, status, return_amount=None):
+        return Investment.objects.create(
+            user=user,
+            amount=Decimal(amount),
+            maturity_period=5,
+            maturity_date=timezone.now() + timedelta(days=5),
+            return_amount=Decimal(return_amount) if return_amount else None,
+            status=status
+        )
+
+
+class PairingTestCase(PairingFixtures, TestCase):
+    pass
+
+
+class PairingEngineTest(PairingTestCase):
+    def test_one_matured_to_multiple_new(self):
+        matured = self.create_investment(self.users[0], '1000.00', 'matured', '1100.00')
+        new1 = self.create_investment(self.users[1], '600.00', 'pending')
+        new2 = self.create_investment(self.users[2], '700.00', 'pending')
+
+        run_pairing_job()
+
+        matured.refresh_from_db()
+        new1.refresh_from_db()
+        new2.refresh_from_db()
+        self.assertEqual(matured.status, 'paired')
+        self.assertEqual(matured.remaining_amount, Decimal('0.00'))
+        self.assertEqual(new1.status, 'completed')
+        self.assertEqual(new1.remn_amount, Decimal('0.00'))
+        self.assertEqual(new1.paired_to, self.users[0])
+        self.assertEqual(new2.status, 'pending')
+        self.assertEqual(new2.remn_amount, Decimal('200.00'))
+
+        amounts = sorted(PairedInvestment.objects.values_list('amount_paired', flat=True))
+        self.assertEqual(amounts, [Decimal('500.00'), Decimal('600.00')])
+        self.assertTrue(PairedInvestment.objects.filter(
+            new_investor=self.users[2], pairing_reference=new2.pairing_reference
+        ).exists())
+
+    def test_same_user_is_never_paired(self):
+        matured = self.create_investment(self.users[0], '500.00', 'matured', '550.00')
+        own_bid = self.create_investment(self.users[0], '550.00', 'pending')
+
+        run_pairing_job()
+
+        matured.refresh_from_db()
+        own_bid.refresh_from_db()
+        self.assertEqual(matured.status, 'matured')
+        self.assertEqual(matured.remaining_amount, Decimal('550.00'))
+        self.assertEqual(own_bid.status, 'pending')
+        self.assertFalse(PairedInvestment.objects.exists())
+
+    def test_query_count_is_independent_of_book_size(self):
+        for i in range(3):
+            self.create_investment(self.users[i], '300.00', 'matured', '330.00')
+        for i in range(10):
+            self.create_investment(self.users[3], '100.00', 'pending')
+
+        with self.assertNumQueries(21):
+            run_pairing_job()
+
+        self.assertEqual(Investment.objects.filter(status='completed').count(), 9)
+        self.assertEqual(Investment.objects.filter(status='paired').count(), 3)
+
+
+class IncrementalPairingTest(PairingTestCase):
+    def test_new_bid_pairs_with_oldest_matured(self):
+        older = self.create_investment(self.users[0], '500.00', 'matured', '500.00')
+        newer = self.create_investment(self.users[1], '500.00', 'matured', '500.00')
+        bid = self.create_investment(self.users[2], '300.00', 'pending')
+
+        run_incremental_pairing(pending_ids=[bid.id])
+
+        older.refresh_from_db()
+        newer.refresh_from_db()
+        bid.refresh_from_db()
+        self.assertEqual(bid.status, 'completed')
+        self.assertEqual(older.remaining_amount, Decimal('200.00'))
+        self.assertIsNone(newer.remaining_amount)
+
+    def test_matured_slice_leaves_other_matured_untouched(self):
+        older = self.create_investment(self.users[0], '500.00', 'matured', '500.00')
+        newer = self.create_investment(self.users[1], '500.00', 'matured', '500.00')
+        self.create_investment(self.users[2], '300.00', 'pending')
+
+        run_incremental_pairing(matured_ids=[newer.id])
+
+        older.refresh_from_db()
+        newer.refresh_from_db()
+        self.assertIsNone(older.remaining_amount)
+        self.assertEqual(newer.remaining_amount, Decimal('200.00'))
+
+    def test_counter_side_stops_at_the_bids_it_needs(self):
+        matured = self.create_investment(self.users[0], '500.00', 'matured', '500.00')
+        first = self.create_investment(self.users[1], '200.00', 'pending')
+        own = self.create_investment(self.users[0], '200.00', 'pending')
+        second = self.create_investment(self.users[2], '100.00', 'pending')
+        third = self.create_investment(self.users[3], '300.00', 'pending')
+        self.create_investment(self.users[1], '300.00', 'pending')
+
+        book = load_slice(matured_ids=[matured.id], chunk_size=2)
+
+        self.assertEqual([inv.id for inv in book.pending], [first.id, own.id, second.id, third.id])
+
+    def test_maturity_transition_schedules_pairing(self):
+        investment = self.create_investment(self.users[0], '500.00', 'confirmed', '550.00')
+        investment.is_confirmed = True
+        investment.mature_at = timezone.now() - timedelta(minutes=1)
+        investment.save()
+
+        with mock.patch('accounts.tasks.pair_investments.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertTrue(investment.check_maturity())
+
+        delay.assert_called_once_with(matured_ids=[investment.id], pending_ids=[])
+
+
+class PairingLeaseTest(PairingTestCase):
+    def test_lease_is_exclusive_until_released(self):
+        self.assertTrue(acquire_lease('test-lease', 'worker-a'))
+        self.assertFalse(acquire_lease('test-lease', 'worker-b'))
+        self.assertTrue(acquire_lease('test-lease', 'worker-a'))
+
+        release_lease('test-lease', 'worker-a')
+        self.assertTrue(acquire_lease('test-lease', 'worker-b'))
+
+    def test_expired_lease_can_be_taken_over(self):
+        self.assertTrue(acquire_lease('test-lease', 'worker-a', ttl=timedelta(seconds=-1)))
+        self.assertTrue(acquire_lease('test-lease', 'worker-b'))
+
+    def test_renewal_fails_once_the_lease_is_taken_over(self):
+        name = SWEEP_LEASE if supports_skip_locked() else SINGLE_CLAIMER_LEASE
+        with self.assertRaises(PairingLeaseBusy):
+            with pairing_lease(SWEEP_LEASE) as renew:
+                renew()
+                self.assertFalse(acquire_lease(name, 'other-worker'))
+                PairingLease.objects.filter(name=name).update(expires_at=timezone.now())
+                self.assertTrue(acquire_lease(name, 'other-worker'))
+                renew()
+
+        self.assertEqual(PairingLease.objects.get(name=name).owner, 'other-worker')
+
+    def test_sweep_skips_while_lease_is_held(self):
+        self.create_investment(self.users[0], '500.00', 'matured', '500.00')
+        self.create_investment(self.users[1], '500.00', 'pending')
+        acquire_lease(SINGLE_CLAIMER_LEASE, 'other-worker')
+
+        self.assertEqual(run_pairing(), [])
+        self.assertFalse(PairedInvestment.objects.exists())
+
+
+class PolicySelectionTest(PairingTestCase):
+    def test_run_pairing_job_uses_selected_policy(self):
+        matured = self.create_investment(self.users[0], '500.00', 'matured', '500.00')
+        small = self.create_investment(self.users[1], '200.00', 'pending')
+        exact = self.create_investment(self.users[2], '500.00', 'pending')
+
+        run_pairing_job(policy='best_fit')
+
+        matured.refresh_from_db()
+        small.refresh_from_db()
+        exact.refresh_from_db()
+        self.assertEqual(matured.status, 'paired')
+        self.assertEqual(small.status, 'pending')
+        self.assertEqual(exact.status, 'completed')
+        self.assertEqual(exact.paired_to, self.users[0])
+
+
+class DryRunTest(PairingFixtures, TransactionTestCase):
+    # Dry runs must open the outermost transaction, which TestCase already holds
+    def setUp(self):
+        super().setUp()
+        self.matured = self.create_investment(self.users[0], '1000.00', 'matured', '1000.00')
+        self.create_investment(self.users[1], '400.00', 'pending')
+        self.create_investment(self.users[2], '400.00', 'pending')
+
+    def test_simulation_writes_nothing(self):
+        report = simulate_pairing(measure_writes=True)
+
+        self.assertEqual(report['pair_count'], 2)
+        self.assertEqual(report['total_paired'], '800.00')
+        self.assertEqual(report['unmatched']['matured_amount'], '200.00')
+        self.assertEqual(report['unmatched']['pending_count'], 0)
+        self.assertEqual(report['fragments']['per_matured']['max'], 2)
+        self.assertFalse(PairedInvestment.objects.exists())
+        self.matured.refresh_from_db()
+        self.assertIsNone(self.matured.remaining_amount)
+
+    def test_simulation_refuses_an_outer_transaction(self):
+        with transaction.atomic():
+            with self.assertRaises(transaction.TransactionManagementError):
+                simulate_pairing()
+
+    def test_measured_writes_wait_for_no_sweep(self):
+        with pairing_lease(SWEEP_LEASE):
+            with self.assertRaises(PairingLeaseBusy):
+                simulate_pairing(measure_writes=True)
+            with self.assertRaises(CommandError):
+                call_command('run_pairing_job', '--dry-run', '--measure-writes', stdout=StringIO())
+        self.assertEqual(simulate_pairing()['pair_count'], 2)
+
+    def test_compare_reports_fragment_reduction(self):
+        self.create_investment(self.users[3], '600.00', 'pending')
+        out = StringIO()
+        call_command('run_pairing_job', '--compare', 'fifo', 'min_fragments', '--json', stdout=out)
+
+        fifo, fewer = json.loads(out.getvalue())
+        self.assertEqual(fifo['pair_count'], 3)
+        self.assertEqual(fewer['pair_count'], 2)
+        self.assertEqual(fewer['fragment_reduction'], 0.3333)
+        self.assertFalse(PairedInvestment.objects.exists())
+
+    def test_dry_run_command_outputs_json_report(self):
+        out = StringIO()
+        call_command('run_pairing_job', '--dry-run', '--json', stdout=out)
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(len(report['pairs']), 2)
+        self.assertEqual(set(report['timing']), {'load_ms', 'match_ms', 'write_ms', 'write_executed'})
+        self.assertFalse(PairedInvestment.objects.exists())
+
+
+class PairingDigestTest(PairingTestCase):
+    def test_one_digest_per_user_per_run(self):
+        self.create_investment(self.users[0], '900.00', 'matured', '900.00')
+        for _ in range(3):
+            self.create_investment(self.users[1], '300.00', 'pending')
+
+        run_pairing_job()
+
+        self.assertEqual(PairedInvestment.objects.count(), 3)
+        events = NotificationEvent.objects.filter(kind='pairing')
+        self.assertEqual(events.count(), 2)
+        digests = {event.user_id: [event.payload] for event in events}
+        self.assertEqual(digests[self.users[0].id], [
+            {'counterparty_id': self.users[1].id, 'role': 'receive', 'amount': '900.00'}
+        ])
+        self.assertEqual(digests[self.users[1].id], [
+            {'counterparty_id': self.users[0].id, 'role': 'pay', 'amount': '900.00'}
+        ])
+
+
+class BenchmarkCommandTest(TestCase):
+    def run_benchmark(self, *args):
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        call_command('benchmark_pairing', '--sizes', '300', '--output', path, *args, stdout=StringIO())
+        with open(path) as f:
+            return json.load(f)
+
+    def test_db_run_is_rolled_back(self):
+        report = self.run_benchmark('--policies', 'fifo', 'best_fit')
+
+        self.assertEqual([r['policy'] for r in report['results']], ['fifo', 'best_fit'])
+        self.assertTrue(all(r['pairs'] > 0 and r['queries'] > 0 for r in report['results']))
+        self.assertFalse(Investment.objects.exists())
+        self.assertFalse(User.objects.exists())
+
+    def test_books_are_reproducible(self):
+        first = self.run_benchmark('--mode', 'memory', '--distributions', 'bimodal')
+        second = self.run_benchmark('--mode', 'memory', '--distributions', 'bimodal')
+        self.assertEqual(first['results'][0]['pairs'], second['results'][0]['pairs'])
+        self.assertEqual(first['results'][0]['rows_written'], 0)
@@ -0,0 +1,73 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from unittest import mock
+from accounts import referral_codes
+from accounts.models import User
+
+
+class ReferralCodeTest(TestCase):
+    def test_codes_are_distinct_and_fixed_length(self):
+        codes = [referral_codes.code_for(user_id) for user_id in range(1, 5001)]
+
+        self.assertEqual(len(set(codes)), len(codes))
+        self.assertTrue(all(len(code) == 9 and code.isalnum() and code.upper() == code for code in codes))
+        self.assertEqual(referral_codes.code_for(42), referral_codes.code_for(42))
+
+    def test_permutation_is_keyed(self):
+        with override_settings(REFERRAL_CODE_KEY='one'):
+            first = referral_codes.code_for(7)
+        with override_settings(REFERRAL_CODE_KEY='two'):
+            second = referral_codes.code_for(7)
+
+        self.assertNotEqual(first, second)
+
+    def test_permutation_stays_in_code_space(self):
+        for n in (0, 1, referral_codes.SPACE - 1):
+            self.assertLess(referral_codes.permute(n), referral_codes.SPACE)
+        with self.assertRaises(ValueError):
+            referral_codes.permute(referral_codes.SPACE)
+
+    def test_new_user_gets_code_without_lookups(self):
+        with CaptureQueriesContext(connection) as queries:
+            user = User.objects.create_user(
+                username='coder', email='coder@example.com', phone_number='0712000001', password='testpass123'
+            )
+
+        self.assertEqual(user.referral_code, referral_codes.code_for(user.pk))
+        self.assertFalse([q for q in queries if q['sql'].startswith('SELECT')])
+        user.refresh_from_db()
+        self.assertEqual(user.referral_code, referral_codes.code_for(user.pk))
+
+    def test_bulk_created_users_are_assigned_codes(self):
+        User.objects.bulk_create([
+            User(username=f'bulk{i}', email=f'bulk{i}@example.com', phone_number=f'07120001{i:02d}')
+            for i in range(5)
+        ])
+        users = list(User.objects.filter(username__startswith='bulk'))
+        self.assertTrue(all(user.referral_code is None for user in users))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(referral_codes.assign(users), 5)
+
+        self.assertEqual(
+            sorted(User.objects.filter(username__startswith='bulk').values_list('referral_code', flat=True)),
+            sorted(referral_codes.code_for(user.pk) for user in users)
+        )
+
+    def test_failed_code_assignment_leaves_no_user(self):
+        with mock.patch('accounts.referral_codes.code_for', side_effect=RuntimeError('no code')):
+            with self.assertRaises(RuntimeError):
+                User.objects.create_user(
+                    username='nocode', email='nocode@example.com', phone_number='0712000002', password='testpass123'
+                )
+
+        self.assertFalse(User.objects.filter(username='nocode').exists())
+
+    def test_key_is_required(self):
+        with override_settings(REFERRAL_CODE_KEY=''):
+            with self.assertRaises(ImproperlyConfigured):
+                referral_codes.check_key()
+            with self.assertRaises(ImproperlyConfigured):
+                referral_codes.code_for(7)
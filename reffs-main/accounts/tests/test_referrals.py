@@ -0,0 +1,178 @@
+from io import StringIO
+from decimal import Decimal
+from django.core.management import call_command
+from rest_framework.test import APIClient
+from accounts import referral_stats, referrals
+from accounts.models import Investment, ReferralClosure, ReferralHistory, ReferralStats, User
+from accounts.tests.test_pairing_engine import PairingTestCase
+
+
+class ReferralClosureTest(PairingTestCase):
+    def register(self, username, phone_number, referral_code=None):
+        data = {
+            'username': username,
+            'email': f'{username}@example.com',
+            'phone_number': phone_number,
+            'password': 'testpass123',
+            'country': 'Kenya',
+        }
+        if referral_code:
+            data['referral_code'] = referral_code
+        response = APIClient().post('/api/register/', data, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return User.objects.get(username=username)
+
+    def build_chain(self):
+        """root <- child <- grandchild, plus a second child of root"""
+        referrals.rebuild_closure()
+        root = self.users[0]
+        child = self.register('child', '0711000001', root.referral_code)
+        grandchild = self.register('grandchild', '0711000002', child.referral_code)
+        sibling = self.register('sibling', '0711000003', root.referral_code)
+        return root, child, grandchild, sibling
+
+    def links(self):
+        return set(ReferralClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+
+    def test_registration_adds_upline_links(self):
+        root, child, grandchild, _ = self.build_chain()
+
+        self.assertEqual(
+            set(ReferralClosure.objects.filter(descendant=grandchild).values_list('ancestor_id', 'depth')),
+            {(grandchild.id, 0), (child.id, 1), (root.id, 2)}
+        )
+
+    def test_downline_by_depth(self):
+        root, child, grandchild, sibling = self.build_chain()
+        self.create_investment(child, '1000.00', 'confirmed')
+        self.create_investment(sibling, '500.00', 'matured')
+        self.create_investment(grandchild, '300.00', 'completed')
+        self.create_investment(grandchild, '999.00', 'pending')
+
+        self.assertEqual(referrals.downline_count(root), 3)
+        self.assertEqual(referrals.downline_count(root, max_depth=1), 2)
+        with self.assertNumQueries(2):
+            levels = referrals.downline_by_depth(root)
+        self.assertEqual(levels, [
+            {'depth': 1, 'users': 2, 'invested': Decimal('1500.00')},
+            {'depth': 2, 'users': 1, 'invested': Decimal('300.00')},
+        ])
+
+    def test_backfill_matches_registration(self):
+        self.build_chain()
+        incremental = self.links()
+        ReferralClosure.objects.all().delete()
+
+        out = StringIO()
+        call_command('backfill_referral_closure', stdout=out)
+
+        self.assertEqual(self.links(), incremental)
+        self.assertIn('over 2 levels', out.getvalue())
+
+    def test_backfill_stops_on_cycles(self):
+        self.users[0].referred_by = self.users[1]
+        self.users[0].save()
+        self.users[1].referred_by = self.users[0]
+        self.users[1].save()
+
+        levels = referrals.rebuild_closure(max_depth=5)
+
+        self.assertEqual(levels, [4, 2])
+
+    def test_referral_list_reports_downline(self):
+        root, *_ = self.build_chain()
+        client = APIClient()
+        client.force_authenticate(root)
+
+        response = client.get('/api/referrals/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['downline']['total_users'], 3)
+        self.assertEqual([level['users'] for level in response.data['downline']['levels']], [2, 1])
+
+
+class ReferralStatsTest(PairingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.referrer = self.users[0]
+        self.users[1].referred_by = self.referrer
+        self.users[1].save()
+        referral_stats.reconcile()
+
+    def invest(self, user, amount):
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post('/api/investments/create/', {'amount': amount, 'maturity_period': 5}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+
+    def counters(self, user):
+        stats = ReferralStats.objects.get(user=user)
+        return stats.referred_users, stats.referrals, stats.total_earned, stats.available_bonus
+
+    def test_counters_follow_history_changes(self):
+        self.invest(self.users[1], '1000.00')
+        self.assertEqual(self.counters(self.referrer), (1, 1, Decimal('30.00'), Decimal('0.00')))
+
+        history = ReferralHistory.objects.get()
+        before = referral_stats.snapshot(history)
+        history.status = 'active'
+        history.payment_confirmed = True
+        history.save()
+        referral_stats.history_changed(history, before)
+        self.assertEqual(self.counters(self.referrer), (1, 1, Decimal('30.00'), Decimal('30.00')))
+
+        # The referrer's own investment uses up the available bonus
+        self.invest(self.referrer, '500.00')
+        self.assertEqual(self.counters(self.referrer), (1, 1, Decimal('30.00'), Decimal('0.00')))
+        self.assertEqual(ReferralHistory.objects.get().status, 'used')
+
+    def test_investment_uses_history_bonus_not_counters(self):
+        self.invest(self.users[1], '1000.00')
+        ReferralHistory.objects.update(status='active', payment_confirmed=True)
+        ReferralStats.objects.filter(user=self.referrer).update(available_bonus=Decimal('99.00'))
+
+        self.invest(self.referrer, '500.00')
+
+        investment = Investment.objects.get(user=self.referrer)
+        self.assertEqual(investment.referral_bonus_used, Decimal('30.00'))
+        self.assertEqual(investment.return_amount, Decimal('580.00'))
+        self.assertEqual(ReferralHistory.objects.get().status, 'used')
+
+    def test_registration_counts_referred_user(self):
+        APIClient().post('/api/register/', {
+            'username': 'newcomer',
+            'email': 'newcomer@example.com',
+            'phone_number': '0711000009',
+            'password': 'testpass123',
+            'country': 'Kenya',
+            'referral_code': self.referrer.referral_code,
+        }, format='json')
+
+        self.assertEqual(self.counters(self.referrer)[0], 2)
+        self.assertTrue(ReferralStats.objects.filter(user__username='newcomer').exists())
+
+    def test_reconcile_fixes_drift(self):
+        self.invest(self.users[1], '1000.00')
+        ReferralStats.objects.filter(user=self.referrer).update(referrals=7, available_bonus=Decimal('99.00'))
+
+        out = StringIO()
+        call_command('reconcile_referral_stats', '--dry-run', stdout=out)
+        self.assertIn('Found 1 users', out.getvalue())
+        self.assertEqual(self.counters(self.referrer)[1], 7)
+
+        call_command('reconcile_referral_stats', stdout=StringIO())
+        self.assertEqual(self.counters(self.referrer), (1, 1, Decimal('30.00'), Decimal('0.00')))
+        self.assertEqual(referral_stats.reconcile(), [])
+
+    def test_referral_list_serves_counters(self):
+        ReferralStats.objects.filter(user=self.referrer).update(
+            referred_users=5, total_earned=Decimal('12.00'), available_bonus=Decimal('4.00')
+        )
+        client = APIClient()
+        client.force_authenticate(self.referrer)
+
+        response = client.get('/api/referrals/')
+
+        self.assertEqual(response.data['total_referrals'], 5)
+        self.assertEqual(response.data['total_earnings'], Decimal('12.00'))
+        self.assertEqual(response.data['available_bonus'], Decimal('4.00'))
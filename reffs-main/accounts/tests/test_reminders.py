@@ -0,0 +1,217 @@
+from django.utils import timezone
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
+from rest_framework.test import APIClient
+from accounts.models import Investment, NotificationEvent, OutboxMessage, PairedInvestment
+from accounts.reminders import payment_deadlines, sweep_payments
+from accounts.tasks import run_pairing_job, send_payment_reminders
+from accounts.tests.test_pairing_engine import PairingTestCase
+
+
+class PaymentSweepTest(PairingTestCase):
+    def create_pair(self, due_in, payer=1, receiver=0):
+        due, next_at = payment_deadlines(timezone.now() + due_in - timedelta(hours=24))
+        return PairedInvestment.objects.create(
+            matured_investor=self.users[receiver],
+            new_investor=self.users[payer],
+            amount_paired=Decimal('500.00'),
+            payment_due_at=due,
+            next_reminder_at=next_at,
+        )
+
+    def reminders(self, user):
+        return [event.payload for event in NotificationEvent.objects.filter(user=user, kind='payment_reminder')]
+
+    def test_pairing_sets_deadlines(self):
+        self.create_investment(self.users[0], '500.00', 'matured', '500.00')
+        self.create_investment(self.users[1], '500.00', 'pending')
+        run_pairing_job()
+
+        pair = PairedInvestment.objects.get()
+        self.assertAlmostEqual(pair.payment_due_at, pair.paired_at + timedelta(hours=24), delta=timedelta(seconds=5))
+        self.assertEqual(pair.next_reminder_at, pair.payment_due_at - timedelta(hours=6))
+
+    def test_nothing_due_is_one_query(self):
+        self.create_pair(timedelta(hours=12))
+
+        # SAVEPOINT, SELECT, RELEASE
+        with self.assertNumQueries(3):
+            self.assertEqual(sweep_payments(), {'reminded': 0, 'expired': 0})
+
+    def test_escalates_through_tiers(self):
+        pair = self.create_pair(timedelta(hours=5))
+        due = pair.payment_due_at
+
+        self.assertEqual(sweep_payments(), {'reminded': 1, 'expired': 0})
+        pair.refresh_from_db()
+        self.assertEqual((pair.reminder_tier, pair.next_reminder_at), (1, due - timedelta(hours=1)))
+        # Not due again until the final tier
+        self.assertEqual(sweep_payments(), {'reminded': 0, 'expired': 0})
+
+        self.assertEqual(sweep_payments(now=due - timedelta(minutes=30)), {'reminded': 1, 'expired': 0})
+        pair.refresh_from_db()
+        self.assertEqual((pair.reminder_tier, pair.next_reminder_at), (2, due))
+
+        self.assertEqual(sweep_payments(now=due + timedelta(minutes=1)), {'reminded': 0, 'expired': 1})
+        pair.refresh_from_db()
+        self.assertEqual(
+            (pair.reminder_tier, pair.status, pair.payment_status, pair.next_reminder_at), (3, 'expired', 'failed', None)
+        )
+
+        self.assertEqual([r['tier'] for r in self.reminders(self.users[1])], [1, 2, 3])
+        self.assertEqual([(r['role'], r['expired']) for r in self.reminders(self.users[0])], [('receive', True)])
+        # Reminders skip the digest window
+        self.assertTrue(OutboxMessage.objects.filter(task='accounts.tasks.send_user_digest').exists())
+
+    def test_late_sweep_jumps_to_current_tier(self):
+        self.create_pair(timedelta(minutes=30))
+
+        sweep_payments()
+
+        self.assertEqual([r['tier'] for r in self.reminders(self.users[1])], [2])
+
+    def test_paid_pairing_leaves_the_sweep(self):
+        pair = self.create_pair(timedelta(hours=5))
+        pair.payment_status = 'paid'
+        pair.save()
+
+        self.assertIsNone(PairedInvestment.objects.get(id=pair.id).next_reminder_at)
+        self.assertEqual(send_payment_reminders(), 'Sent 0 payment reminders, expired 0 pairings')
+
+    def test_batches_walk_the_whole_due_range(self):
+        for i in range(5):
+            self.create_pair(timedelta(hours=5, minutes=i), payer=1 + i % 3)
+
+        self.assertEqual(sweep_payments(batch_size=2), {'reminded': 5, 'expired': 0})
+        self.assertFalse(PairedInvestment.objects.filter(reminder_tier=0).exists())
+
+
+class ExpiryReleaseTest(PairingTestCase):
+    def pair_book(self, bids):
+        matured = self.create_investment(self.users[0], '1000.00', 'matured', '1000.00')
+        new = [self.create_investment(self.users[1 + i % 3], amount, 'pending') for i, amount in enumerate(bids)]
+        run_pairing_job()
+        return matured, new
+
+    def expire(self, due=None):
+        due = due or PairedInvestment.objects.order_by('id').first().payment_due_at
+        with mock.patch('accounts.pairing.schedule_pairing') as schedule:
+            totals = sweep_payments(now=due + timedelta(minutes=1))
+        return totals, schedule
+
+    def test_expiry_returns_amounts_and_requeues(self):
+        matured, (unpaid, paid) = self.pair_book(['600.00', '400.00'])
+        paid_pair = PairedInvestment.objects.get(new_investment=paid)
+        paid_pair.payment_status = 'paid'
+        paid_pair.save()
+
+        totals, schedule = self.expire()
+
+        self.assertEqual(totals, {'reminded': 0, 'expired': 1})
+        matured.refresh_from_db()
+        unpaid.refresh_from_db()
+        self.assertEqual((matured.remaining_amount, matured.status), (Decimal('600.00'), 'matured'))
+        self.assertEqual((unpaid.remn_amount, unpaid.status), (Decimal('600.00'), 'pending'))
+        schedule.assert_called_once_with(matured_ids=[matured.id], pending_ids=[unpaid.id])
+        self.assertEqual(
+            PairedInvestment.objects.filter(new_investment=unpaid).values_list('status', 'payment_status').get(),
+            ('expired', 'failed')
+        )
+
+        # Released amounts pair again on the next cycle
+        self.create_investment(self.users[3], '600.00', 'pending')
+        run_pairing_job()
+        matured.refresh_from_db()
+        self.assertEqual((matured.remaining_amount, matured.status), (Decimal('0.00'), 'paired'))
+
+    def test_expiry_is_a_bulk_operation(self):
+        self.pair_book(['100.00'] * 10)
+        due = PairedInvestment.objects.first().payment_due_at
+        # SAVEPOINT, SELECT, UPDATE pairings, UPDATE matured, UPDATE bids,
+        # UPDATE reopened bids, INSERT events, INSERT outbox, RELEASE
+        with self.assertNumQueries(9):
+            totals, _ = self.expire(due)
+
+        self.assertEqual(totals['expired'], 10)
+        self.assertEqual(Investment.objects.get(status='matured').remaining_amount, Decimal('1000.00'))
+        self.assertEqual(Investment.objects.filter(status='pending', remn_amount=Decimal('100.00')).count(), 10)
+
+    def test_repaired_bid_can_be_confirmed(self):
+        matured, (bid,) = self.pair_book(['1000.00'])
+        expired = PairedInvestment.objects.get()
+        self.expire()
+        run_pairing_job()
+        repaired = PairedInvestment.objects.exclude(id=expired.id).get()
+        self.assertEqual(repaired.pairing_reference, expired.pairing_reference)
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+
+        # The expired pairing's amount has been paired again
+        response = client.post(f'/api/confirm-payment/{expired.id}/')
+        self.assertEqual(response.status_code, 400)
+        expired.refresh_from_db()
+        self.assertEqual((expired.status, expired.payment_status), ('expired', 'failed'))
+
+        response = client.post(f'/api/confirm-payment/{repaired.id}/')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertTrue(response.data['all_confirmed'])
+        bid.refresh_from_db()
+        self.assertEqual((bid.status, bid.remn_amount), ('confirmed', Decimal('0.00')))
+        self.assertIsNotNone(bid.mature_at)
+
+    def test_partly_confirmed_bid_reopens_for_the_expired_amount_only(self):
+        first = self.create_investment(self.users[0], '500.00', 'matured', '500.00')
+        second = self.create_investment(self.users[2], '500.00', 'matured', '500.00')
+        bid = self.create_investment(self.users[1], '1000.00', 'pending')
+        run_pairing_job()
+        client = APIClient()
+        client.force_authenticate(self.users[0])
+        paid = PairedInvestment.objects.get(matured_investment=first)
+        self.assertEqual(client.post(f'/api/confirm-payment/{paid.id}/').status_code, 200)
+        bid.refresh_from_db()
+        self.assertEqual(bid.remn_amount, Decimal('500.00'))
+
+        totals, schedule = self.expire()
+
+        self.assertEqual(totals['expired'], 1)
+        bid.refresh_from_db()
+        self.assertEqual((bid.remn_amount, bid.status), (Decimal('500.00'), 'pending'))
+        second.refresh_from_db()
+        self.assertEqual((second.remaining_amount, second.status), (Decimal('500.00'), 'matured'))
+        schedule.assert_called_once_with(matured_ids=[second.id], pending_ids=[bid.id])
+
+    def test_legacy_pairing_is_released_once_resolved(self):
+        bid = self.create_investment(self.users[1], '500.00', 'completed')
+        bid.remn_amount = Decimal('0.00')
+        bid.save()
+        due = timezone.now() - timedelta(hours=1)
+        # Pairings made before the matured investment was recorded
+        legacy = PairedInvestment.objects.create(
+            matured_investor=self.users[0], new_investor=self.users[1], amount_paired=Decimal('500.00'),
+            new_investment=bid, payment_due_at=due, next_reminder_at=due,
+        )
+
+        totals, schedule = self.expire(due)
+
+        self.assertEqual(totals['expired'], 1)
+        legacy.refresh_from_db()
+        self.assertEqual((legacy.status, legacy.payment_status), ('expired', 'failed'))
+        bid.refresh_from_db()
+        self.assertEqual((bid.remn_amount, bid.status), (Decimal('0.00'), 'completed'))
+        schedule.assert_called_once_with(matured_ids=[], pending_ids=[])
+
+        matured = self.create_investment(self.users[0], '500.00', 'paired', '500.00')
+        Investment.objects.filter(id=matured.id).update(remaining_amount=Decimal('0.00'))
+        with mock.patch('accounts.pairing.schedule_pairing'):
+            call_command('release_legacy_pairing', legacy.id, '--matured-investment', matured.id, stdout=StringIO())
+
+        matured.refresh_from_db()
+        self.assertEqual((matured.remaining_amount, matured.status), (Decimal('500.00'), 'matured'))
+        bid.refresh_from_db()
+        self.assertEqual((bid.remn_amount, bid.status), (Decimal('500.00'), 'pending'))
+        with self.assertRaises(CommandError):
+            call_command('release_legacy_pairing', legacy.id, '--matured-investment', matured.id, stdout=StringIO())
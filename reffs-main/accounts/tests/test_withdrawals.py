@@ -0,0 +1,69 @@
+from decimal import Decimal
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from accounts import ledger, referral_stats, withdrawals
+from accounts.models import BonusLedgerEntry, ReferralHistory, ReferralStats, WithdrawHistory
+from accounts.tests.test_pairing_engine import PairingTestCase
+
+
+class WithdrawalTest(PairingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.referrer = self.users[0]
+
+    def add_bonuses(self, count, bonus='10.00'):
+        histories = []
+        for _ in range(count):
+            history = ReferralHistory.objects.create(
+                referrer=self.referrer, referred=self.users[1],
+                amount_invested=Decimal(bonus) * 10, bonus_earned=Decimal(bonus), status='pending'
+            )
+            referral_stats.history_created(history)
+            ledger.credit(self.referrer.id, Decimal(bonus), 'referral_bonus', f'referral:{history.id}')
+            histories.append(history)
+        return histories
+
+    def statuses(self):
+        return list(ReferralHistory.objects.order_by('created_at', 'id').values_list('status', 'bonus_earned'))
+
+    def test_uses_oldest_bonuses_and_splits_one_row(self):
+        histories = self.add_bonuses(4)
+
+        withdrawals.withdraw(self.referrer, Decimal('25.00'))
+
+        self.assertEqual(self.statuses(), [
+            ('used', Decimal('10.00')), ('used', Decimal('10.00')),
+            ('pending', Decimal('5.00')), ('pending', Decimal('10.00')),
+        ])
+        split = ReferralHistory.objects.get(id=histories[2].id)
+        self.assertEqual(split.amount_invested, Decimal('50.00'))
+        self.assertEqual(ledger.balance(self.referrer.id), Decimal('15.00'))
+        self.assertEqual(ReferralStats.objects.get(user=self.referrer).total_earned, Decimal('35.00'))
+
+    def test_exact_amount_splits_nothing(self):
+        self.add_bonuses(3)
+
+        self.assertEqual(withdrawals.allocate(self.referrer.id, Decimal('20.00')), (2, None))
+        self.assertEqual([s for s, _ in self.statuses()], ['used', 'used', 'pending'])
+
+    def test_statement_count_does_not_grow_with_rows(self):
+        self.add_bonuses(3)
+        with CaptureQueriesContext(connection) as few:
+            withdrawals.allocate(self.referrer.id, Decimal('25.00'))
+        ReferralHistory.objects.all().delete()
+        self.add_bonuses(60)
+        with CaptureQueriesContext(connection) as many:
+            withdrawals.allocate(self.referrer.id, Decimal('555.00'))
+
+        self.assertEqual(len(many), len(few))
+        self.assertEqual(ReferralHistory.objects.filter(status='used').count(), 55)
+
+    def test_insufficient_balance_changes_nothing(self):
+        self.add_bonuses(2)
+
+        with self.assertRaises(withdrawals.InsufficientBalance):
+            withdrawals.withdraw(self.referrer, Decimal('25.00'))
+
+        self.assertFalse(WithdrawHistory.objects.exists())
+        self.assertFalse(BonusLedgerEntry.objects.filter(kind='withdrawal').exists())
+        self.assertEqual([s for s, _ in self.statuses()], ['pending', 'pending'])
@@ -4,7 +4,7 @@ from .views import (
     UserRegistrationView, UserLoginView, UserProfileView,
     InvestmentCreateView, InvestmentListView,
     ReferralHistoryListView, InvestmentStatementPDFView,
-    ReferralStatementPDFView, system_overview, user_dashboard,
+    ReferralStatementPDFView, system_overview, liquidity_forecast_view, user_dashboard,
     DashboardView, BuySharesView, SellSharesView, ReferralsView,
     CustomLoginView, CustomLogoutView, MyInvestmentsView, sell_shares,
     my_investments, ConfirmPaymentView, InvestmentDetailView,
@@ -36,6 +36,7 @@ urlpatterns = [
 
     # System overview endpoint
     path('system-overview/', system_overview, name='system_overview'),
+    path('liquidity-forecast/', liquidity_forecast_view, name='liquidity_forecast'),
 
     # User dashboard endpoint
     path('user-dashboard/', user_dashboard, name='user_dashboard'),
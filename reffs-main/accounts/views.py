@@ -23,6 +23,9 @@ from .serializers import (
     WithdrawHistorySerializer
 )
 from .models import User, Investment, ReferralHistory,PairedInvestment,Payment, WithdrawHistory
+from .forecast import liquidity_forecast
+from .referrals import downline_by_depth
+from . import ledger, referral_stats, withdrawals
 from django.views.generic import TemplateView
 from django.contrib.auth.views import LoginView, LogoutView
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
@@ -283,16 +286,11 @@ class ReferralHistoryListView(generics.ListAPIView):
         queryset = self.get_queryset()
         serializer = self.get_serializer(queryset, many=True)
         
-        # Calculate statistics
-        total_referrals = User.objects.filter(referred_by=request.user).count()
-        total_earnings = queryset.aggregate(total=Sum('bonus_earned'))['total'] or 0
-        
-        # Calculate available bonus from active referral histories
-        available_bonus = ReferralHistory.objects.filter(
-            referrer=request.user,
-            status='active',
-            payment_confirmed=True
-        ).aggregate(total=Sum('bonus_earned'))['total'] or 0
+        # Statistics come from the user's referral counters
+        stats = referral_stats.get(request.user)
+        total_referrals = stats.referred_users
+        total_earnings = stats.total_earned
+        available_bonus = stats.available_bonus
         
         # Get list of all referred users
         referred_users = User.objects.filter(
@@ -305,12 +303,19 @@ class ReferralHistoryListView(generics.ListAPIView):
             'is_active'
         ).order_by('-date_joined')
         
+        # Whole downline per referral level, from the closure table
+        levels = downline_by_depth(request.user)
+        
         response_data = {
             'referral_history': serializer.data,
             'total_referrals': total_referrals,
             'total_earnings': total_earnings,
             'available_bonus': available_bonus,
-            'referred_users': list(referred_users)
+            'referred_users': list(referred_users),
+            'downline': {
+                'total_users': sum(level['users'] for level in levels),
+                'levels': levels
+            }
         }
         
         return Response(response_data)
@@ -320,85 +325,8 @@ class ConfirmPaymentView(APIView):
 
     def post(self, request, investment_id):
         try:
-            paired_investment = PairedInvestment.objects.get(id=investment_id)
-            
-            # Get the new investment using the pairing reference
-            new_investment = Investment.objects.filter(
-                pairing_reference=paired_investment.pairing_reference,
-                user=paired_investment.new_investor
-            ).first()
-            
-            if not new_investment:
-                return Response({
-                    'error': 'Associated investment not found'
-                }, status=status.HTTP_404_NOT_FOUND)
-            
-            # Update the paired investment status
-            paired_investment.status = 'confirmed'
-            paired_investment.payment_status = 'paid'
-            paired_investment.confirmed_at = timezone.now()
-            paired_investment.save()
-            
-            # Calculate total amount paired so far
-            total_paired = PairedInvestment.objects.filter(
-                pairing_reference=paired_investment.pairing_reference,
-                status='confirmed',
-                payment_status='paid'
-            ).aggregate(total=Sum('amount_paired'))['total'] or Decimal('0.00')
-            
-            # Update remaining amount based on total paired amount
-            new_investment.remn_amount = max(Decimal('0.00'), new_investment.amount - total_paired)
-            new_investment.save()
-            
-            # Check if all paired investments are confirmed
-            all_paired = PairedInvestment.objects.filter(
-                pairing_reference=paired_investment.pairing_reference
-            )
-            all_confirmed = all_paired.exists() and all(
-                pi.status == 'confirmed' and pi.payment_status == 'paid' for pi in all_paired
-            )
-            
-            # Only confirm the investment if all paired investments are confirmed AND remaining amount is 0
-            if all_confirmed and new_investment.remn_amount == Decimal('0.00'):
-                # Update the new investor's investment status
-                new_investment.is_confirmed = True
-                new_investment.confirmed_at = timezone.now()
-                new_investment.status = 'confirmed'
-                new_investment.save()
-                
-                # Start the countdown for the new investment
-                new_investment.start_countdown()
-                
-                # Update referral history for all referrers and make bonus available
-                referral_histories = ReferralHistory.objects.filter(
-                    referred=new_investment.user,
-                    payment_confirmed=False
-                )
-                for history in referral_histories:
-                    history.payment_confirmed = True
-                    history.payment_confirmed_at = timezone.now()
-                    history.status = 'active'
-                    history.save()
-                    
-                    # Update referrer's available bonus
-                    referrer = history.referrer
-                    referrer.referral_earnings += history.bonus_earned
-                    referrer.save()
-                
-                return Response({
-                    'success': True,
-                    'message': 'Payment confirmed and investment confirmed. Referral bonus is now available.',
-                    'all_confirmed': True,
-                    'mature_at': new_investment.mature_at
-                })
-            else:
-                return Response({
-                    'success': True,
-                    'message': 'Payment confirmed but waiting for all payments and remaining amount to be cleared',
-                    'all_confirmed': False,
-                    'remaining_amount': str(new_investment.remn_amount)
-                })
-                
+            with transaction.atomic():
+                return self.confirm(investment_id)
         except PairedInvestment.DoesNotExist:
             return Response({
                 'error': 'Invalid payment or payment already confirmed'
@@ -408,6 +336,93 @@ class ConfirmPaymentView(APIView):
                 'error': f'Failed to confirm payment: {str(e)}'
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def confirm(self, investment_id):
+        # Locked against the payment sweep, which may be expiring it
+        paired_investment = PairedInvestment.objects.select_for_update().get(id=investment_id)
+        
+        # Expired pairings were released and paired again; paid ones are done
+        if paired_investment.payment_status != 'pending':
+            return Response({
+                'error': f'Payment is {paired_investment.payment_status} and can no longer be confirmed'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        
+        # Get the new investment using the pairing reference
+        new_investment = Investment.objects.filter(
+            pairing_reference=paired_investment.pairing_reference,
+            user=paired_investment.new_investor
+        ).first()
+        
+        if not new_investment:
+            return Response({
+                'error': 'Associated investment not found'
+            }, status=status.HTTP_404_NOT_FOUND)
+        
+        # Update the paired investment status
+        paired_investment.status = 'confirmed'
+        paired_investment.payment_status = 'paid'
+        paired_investment.confirmed_at = timezone.now()
+        paired_investment.save()
+        
+        # Calculate total amount paired so far
+        total_paired = PairedInvestment.objects.filter(
+            pairing_reference=paired_investment.pairing_reference,
+            status='confirmed',
+            payment_status='paid'
+        ).aggregate(total=Sum('amount_paired'))['total'] or Decimal('0.00')
+        
+        # Update remaining amount based on total paired amount
+        new_investment.remn_amount = max(Decimal('0.00'), new_investment.amount - total_paired)
+        new_investment.save()
+        
+        # Check if all paired investments are confirmed, leaving out expired ones
+        all_paired = PairedInvestment.objects.filter(
+            pairing_reference=paired_investment.pairing_reference
+        ).exclude(status='expired')
+        all_confirmed = all_paired.exists() and all(
+            pi.status == 'confirmed' and pi.payment_status == 'paid' for pi in all_paired
+        )
+        
+        # Only confirm the investment if all paired investments are confirmed AND remaining amount is 0
+        if all_confirmed and new_investment.remn_amount == Decimal('0.00'):
+            # Update the new investor's investment status
+            new_investment.is_confirmed = True
+            new_investment.confirmed_at = timezone.now()
+            new_investment.status = 'confirmed'
+            new_investment.save()
+            
+            # Start the countdown for the new investment
+            new_investment.start_countdown()
+            
+            # Update referral history for all referrers and make bonus available
+            referral_histories = ReferralHistory.objects.filter(
+                referred=new_investment.user,
+                payment_confirmed=False
+            )
+            for history in referral_histories:
+                before = referral_stats.snapshot(history)
+                history.payment_confirmed = True
+                history.payment_confirmed_at = timezone.now()
+                history.status = 'active'
+                history.save()
+                referral_stats.history_changed(history, before)
+                
+                # Credit the referrer's available bonus
+                ledger.credit(history.referrer_id, history.bonus_earned, 'bonus_confirmed', f'referral:{history.id}')
+            
+            return Response({
+                'success': True,
+                'message': 'Payment confirmed and investment confirmed. Referral bonus is now available.',
+                'all_confirmed': True,
+                'mature_at': new_investment.mature_at
+            })
+        else:
+            return Response({
+                'success': True,
+                'message': 'Payment confirmed but waiting for all payments and remaining amount to be cleared',
+                'all_confirmed': False,
+                'remaining_amount': str(new_investment.remn_amount)
+            })
+
 class InvestmentStatementPDFView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -820,6 +835,21 @@ def system_overview(request):
         'user_details': user_details
     })
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def liquidity_forecast_view(request):
+    """Projected maturity payouts against incoming bids, by day (admin only)"""
+    if not request.user.is_staff:
+        return Response({
+            'error': 'Only admin users can access this endpoint'
+        }, status=status.HTTP_403_FORBIDDEN)
+
+    try:
+        days = int(request.query_params.get('days', 30))
+    except ValueError:
+        return Response({'error': 'days must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(liquidity_forecast(days=days))
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def user_dashboard(request):
@@ -842,25 +872,11 @@ def user_dashboard(request):
         )['total'] or 0
         print(f"Total returns: {total_returns}")  # Debug log
 
-        # Get total referral earnings from ReferralHistory
-        referrals = ReferralHistory.objects.filter(referrer=request.user)
-        
-        # If a referral has no investment, create a placeholder with 0 amount
-        for referral in referrals:
-            if not hasattr(referral, 'amount_invested') or referral.amount_invested is None:
-                referral.amount_invested = 0
-                referral.bonus_earned = 0
-                referral.status = 'pending'
-        
-        total_referral_earnings = referrals.aggregate(total=Sum('bonus_earned'))['total'] or 0
+        # Referral earnings and available bonus (active referrals only) from the counters
+        stats = referral_stats.get(request.user)
+        total_referral_earnings = stats.total_earned
+        available_bonus = stats.available_bonus
         print(f"Total referral earnings: {total_referral_earnings}")  # Debug log
-
-        # Get available bonus (active referrals only)
-        available_bonus = ReferralHistory.objects.filter(
-            referrer=request.user,
-            status='active',
-            payment_confirmed=True
-        ).aggregate(total=Sum('bonus_earned'))['total'] or 0
         print(f"Available bonus: {available_bonus}")  # Debug log
 
         # Get due earnings from matured investments
@@ -957,7 +973,7 @@ def user_dashboard(request):
             'payments': payments,  # Add payments data
             'paired_investments': paired_investments,  # Add paired investments data
             'referral': {
-                'total_referrals': len(referrals),
+                'total_referrals': stats.referrals,
                 'referrals': referrals
             }
         }
@@ -1148,47 +1164,14 @@ class WithdrawBonusView(APIView):
                     'error': 'Invalid withdrawal amount'
                 }, status=status.HTTP_400_BAD_REQUEST)
 
-            # Check if user has enough bonus balance
-            if amount > request.user.referral_earnings:
+            # Lock the user, debit the ledger and use up pending bonuses oldest first
+            try:
+                withdrawal = withdrawals.withdraw(request.user, amount)
+            except withdrawals.InsufficientBalance:
                 return Response({
                     'error': 'Insufficient bonus balance'
                 }, status=status.HTTP_400_BAD_REQUEST)
 
-            # Create withdrawal record
-            withdrawal = WithdrawHistory.objects.create(
-                user=request.user,
-                amount=amount,
-                status='pending'
-            )
-
-            # Update user's referral earnings
-            request.user.referral_earnings -= amount
-            request.user.save()
-
-            # Update referral history records
-            referral_histories = ReferralHistory.objects.filter(
-                referrer=request.user,
-                status='pending'
-            ).order_by('created_at')
-
-            remaining_amount = amount
-            for history in referral_histories:
-                if remaining_amount <= 0:
-                    break
-                
-                if history.bonus_earned <= remaining_amount:
-                    # Mark the entire history record as used
-                    history.status = 'used'
-                    history.used_at = timezone.now()
-                    history.save()
-                    remaining_amount -= history.bonus_earned
-                else:
-                    # Update the existing record with partial usage
-                    history.bonus_earned -= remaining_amount
-                    history.amount_invested = history.amount_invested * (history.bonus_earned / (history.bonus_earned + remaining_amount))
-                    history.save()
-                    remaining_amount = 0
-
             return Response({
                 'message': 'Withdrawal request submitted successfully',
                 'withdrawal': WithdrawHistorySerializer(withdrawal).data
@@ -0,0 +1,71 @@
+"""
+Referral bonus withdrawals.
+
+A withdrawal uses up the referrer's pending ReferralHistory rows oldest
+first. Instead of walking and saving the rows one at a time, allocate()
+finds the first row the withdrawal does not fully cover with a running-sum
+window over (created_at, id). Every row before it is marked used by one
+UPDATE on that key range, and only that boundary row is rewritten with its
+remaining bonus. However many rows a referrer has, a withdrawal costs a
+handful of statements.
+
+withdraw() holds a lock on the user's row for the whole transaction, so
+two withdrawals by the same user run one after the other: each sees the
+balance and the pending rows the previous one left.
+"""
+from django.db import transaction
+from django.db.models import F, Q, Sum, Window
+from django.utils import timezone
+
+from accounts import ledger, referral_stats
+from accounts.models import ReferralHistory, User, WithdrawHistory
+
+
+class InsufficientBalance(Exception):
+    """Raised when a withdrawal is larger than the user's bonus balance"""
+
+
+def allocate(user_id, amount, now=None):
+    """
+    Use up ``amount`` of the user's pending bonuses, oldest first. Returns
+    (rows fully used, id of the row partly used or None).
+    """
+    now = now or timezone.now()
+    pending = ReferralHistory.objects.filter(referrer_id=user_id, status='pending')
+    split = (
+        pending.annotate(running=Window(Sum('bonus_earned'), order_by=[F('created_at').asc(), F('id').asc()]))
+        .filter(running__gt=amount).order_by('created_at', 'id').first()
+    )
+    whole = pending
+    if split is not None:
+        whole = pending.filter(Q(created_at__lt=split.created_at) | Q(created_at=split.created_at, id__lt=split.id))
+    # pending -> used changes none of the referral counters
+    used = whole.update(status='used', used_at=now)
+
+    if split is None:
+        return used, None
+    remaining = amount - (split.running - split.bonus_earned)
+    if remaining <= 0:
+        return used, None
+    before = referral_stats.snapshot(split)
+    bonus_left = split.bonus_earned - remaining
+    split.amount_invested = split.amount_invested * (bonus_left / split.bonus_earned)
+    split.bonus_earned = bonus_left
+    split.save(update_fields=['bonus_earned', 'amount_invested'])
+    referral_stats.history_changed(split, before)
+    return used, split.id
+
+
+def withdraw(user, amount):
+    """
+    Record a withdrawal request of ``amount`` from the user's bonus
+    balance and use up their pending bonuses for it.
+    """
+    with transaction.atomic():
+        User.objects.select_for_update().filter(pk=user.pk).values_list('pk', flat=True).get()
+        if amount > ledger.balance(user.pk):
+            raise InsufficientBalance(f"Withdrawal of {amount} exceeds the bonus balance")
+        withdrawal = WithdrawHistory.objects.create(user=user, amount=amount, status='pending')
+        ledger.debit(user.pk, amount, 'withdrawal', f'withdrawal:{withdrawal.id}')
+        allocate(user.pk, amount)
+    return withdrawal
@@ -228,22 +228,41 @@ CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 
 CELERY_BEAT_SCHEDULE = {
     'check-matured-investments': {
+        # Maturity fires from the timer wheel (accounts.maturity); this sweep
+        # is only a safety net.
         'task': 'accounts.tasks.check_matured_investments',
-        'schedule': 60.0,  # Run every 30 minutes
+        'schedule': 900.0,  # Run every 15 minutes
 
     },
+    'arm-maturity-buckets': {
+        'task': 'accounts.tasks.arm_maturity_buckets',
+        'schedule': 1800.0,  # Run every 30 minutes (half of MATURITY_ARM_HORIZON)
+    },
     'run_pairing_job': {
+        # Pairing is triggered by investment events (accounts.tasks.pair_investments);
+        # the full sweep is only a safety net.
         'task': 'accounts.tasks.run_pairing_job',
-        'schedule': 60.0,  # Run every 5 minutes
+        'schedule': 900.0,  # Run every 15 minutes
      
     },
-    'check-admin-pairing': {
-        'task': 'accounts.tasks.check_admin_pairing',
-        'schedule': 3600.0,  # Run every 5 minutes
+    'drain-outbox': {
+        # Notifications recorded in the transactional outbox (accounts.outbox)
+        'task': 'accounts.tasks.drain_outbox',
+        'schedule': 10.0,  # Run every 10 seconds
+    },
+    'send-notification-digests': {
+        'task': 'accounts.tasks.send_notification_digests',
+        'schedule': 60.0,  # Run every minute
     },
     'send-payment-reminders': {
+        # Reminder tiers and expiry of unpaid pairings (accounts.reminders);
+        # replaces the old check-admin-pairing entry.
         'task': 'accounts.tasks.send_payment_reminders',
-        'schedule': 3600.0,  # Run every hour
+        'schedule': 300.0,  # Run every 5 minutes
+    },
+    'snapshot-bonus-balances': {
+        'task': 'accounts.tasks.snapshot_bonus_balances',
+        'schedule': 600.0,  # Run every 10 minutes
     },
  
     'calculate-daily-statistics': {
@@ -252,6 +271,37 @@ CELERY_BEAT_SCHEDULE = {
     },
 }
 
+# Payments for paired investments (accounts.reminders)
+PAYMENT_WINDOW_HOURS = 24  # time a payer has to pay after pairing
+PAYMENT_REMINDER_HOURS = [6, 1]  # reminders this many hours before the deadline; expiry at the deadline
+PAYMENT_SWEEP_BATCH_SIZE = 500
+
+# Referral codes (accounts.referral_codes): key of the id -> code permutation.
+# Required; the app refuses to start without it. Never change it once codes
+# have been issued. The fallback is for development only.
+REFERRAL_CODE_KEY = os.environ.get('REFERRAL_CODE_KEY', 'django-insecure-referral-code-key' if DEBUG else '')
+
+# Referral bonus ledger (accounts.ledger)
+BONUS_SNAPSHOT_BATCH_SIZE = 1000  # ledger entries folded per snapshot transaction
+
+# Pairing engine
+PAIRING_POLICY = 'fifo'  # fifo, oldest_matured, largest_first, best_fit or min_fragments (accounts.matching)
+PAIRING_MAX_WAIT_SECONDS = 86400  # min_fragments serves bids older than this first, in FIFO order
+PAIRING_LEASE_SECONDS = 300  # renewed before every batch a pairing run writes
+# 'celery' pairs in the Celery tasks; 'resident' hands investment events to the
+# long-lived order book process (python manage.py run_order_book).
+PAIRING_ENGINE = os.environ.get('PAIRING_ENGINE', 'celery')
+PAIRING_BOOK_DIR = BASE_DIR / 'var' / 'orderbook'
+
+# Maturity
+MATURITY_CHUNK_SIZE = 1000  # investments flipped to matured per UPDATE/transaction
+MATURITY_ARM_HORIZON = 3600  # seconds ahead that timer wheel buckets get their ETA task
+
+# Liquidity forecast (accounts.forecast)
+LIQUIDITY_FORECAST_HORIZON_DAYS = 90  # longest maturity period is 60 days
+LIQUIDITY_FORECAST_INTAKE_DAYS = 14  # days of bid intake averaged into the daily rate
+LIQUIDITY_FORECAST_FULL_REFRESH_SECONDS = 3600
+
 # Site URL for email templates and notifications
 SITE_URL = 'http://localhost:8000'  # Change this in production
 
@@ -263,6 +313,35 @@ EMAIL_USE_TLS = True
 EMAIL_HOST_USER = 'your-email@gmail.com'  # Change this
 EMAIL_HOST_PASSWORD = 'your-app-password'  # Change this
 DEFAULT_FROM_EMAIL = 'Referral Investment System <your-email@gmail.com>'
+EMAIL_BATCH_SIZE = 100  # investments notified per dispatch by send_maturity_notification
+
+# Notification dispatch (accounts.notify)
+NOTIFICATION_CHANNELS = {
+    'email': 'accounts.notify.EmailChannel',
+    'sms': 'accounts.notify.SmsChannel',
+}
+NOTIFICATION_CONCURRENCY = 20  # messages in flight at once
+NOTIFICATION_RATE_LIMITS = {  # messages per second, per provider
+    'smtp': 10,
+    'africastalking': 20,
+}
+# Per-user digests (accounts.digests): events are combined into one message once
+# the oldest has waited this long, unless the user chose immediate delivery
+NOTIFICATION_DIGEST_WINDOW_SECONDS = 900
+NOTIFICATION_DIGEST_BATCH_SIZE = 500  # users per flush batch
+# Africa's Talking SMS; SMS is skipped while SMS_API_KEY is empty
+SMS_USERNAME = os.environ.get('SMS_USERNAME', 'sandbox')
+SMS_API_KEY = os.environ.get('SMS_API_KEY', '')
+SMS_SENDER_ID = os.environ.get('SMS_SENDER_ID', '')
+SMS_API_URL = os.environ.get('SMS_API_URL', 'https://api.africastalking.com/version1/messaging')
+
+# Transactional outbox (accounts.outbox)
+OUTBOX_DELIVERY = os.environ.get('OUTBOX_DELIVERY', 'celery')  # 'celery' or 'direct' (run tasks in the drainer)
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE_SECONDS = 10  # doubled after every failed attempt
+OUTBOX_RETRY_MAX_SECONDS = 3600
+OUTBOX_RETENTION_DAYS = 7
 
 # PDF Configuration
 WKHTMLTOPDF_PATH = 'C:\\Program Files\\wkhtmltopdf\\bin\\wkhtmltopdf.exe'  # Windows path